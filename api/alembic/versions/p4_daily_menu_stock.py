@@ -0,0 +1,34 @@
+"""daily_menus.sold_qty: 日次メニューの販売済み数（残数 = max_qty - sold_qty）
+
+既存の注文明細から集計して初期値を入れる。
+
+Revision ID: p4_daily_menu_stock
+Revises: p4_menu_snapshots
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "p4_daily_menu_stock"
+down_revision: Union[str, Sequence[str], None] = "p4_menu_snapshots"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("daily_menus", sa.Column("sold_qty", sa.Integer(), nullable=False, server_default="0"))
+    op.execute(
+        """
+        UPDATE daily_menus SET sold_qty = COALESCE((
+            SELECT SUM(order_items.qty) FROM order_items
+            WHERE order_items.daily_menu_id = daily_menus.id
+        ), 0)
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("daily_menus", "sold_qty")
@@ -0,0 +1,29 @@
+"""menu_snapshots.item_index: 品目ごとの区切り（daily_menu_id と payload 内の文字数）
+
+payload を品目ごとの JSON（remaining_qty の値の直前まで）の連結に変え、配信時は item_index で
+切り分けて残数を足す。既存の行は旧形式なので消す（次の参照またはカタログ更新で作り直される）。
+
+Revision ID: p4_menu_snapshot_item_index
+Revises: p4_realtime_event_seq
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "p4_menu_snapshot_item_index"
+down_revision: Union[str, Sequence[str], None] = "p4_realtime_event_seq"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("DELETE FROM menu_snapshots")
+    op.add_column("menu_snapshots", sa.Column("item_index", sa.Text(), nullable=False, server_default=""))
+
+
+def downgrade() -> None:
+    op.execute("DELETE FROM menu_snapshots")
+    op.drop_column("menu_snapshots", "item_index")
@@ -0,0 +1,32 @@
+"""menu_snapshots: 日付ごとの公開メニュー（/v2/menus）の確定済みJSON
+
+追加方式。行は初回参照時またはカタログ更新時に作られるため、データ移行は不要。
+
+Revision ID: p4_menu_snapshots
+Revises: p4_menu_versions
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "p4_menu_snapshots"
+down_revision: Union[str, Sequence[str], None] = "p4_menu_versions"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "menu_snapshots",
+        sa.Column("serve_date", sa.Date(), primary_key=True),
+        sa.Column("payload", sa.Text(), nullable=False),
+        sa.Column("etag", sa.String(), nullable=False),
+        sa.Column("built_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("menu_snapshots")
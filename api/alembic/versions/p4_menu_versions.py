@@ -0,0 +1,31 @@
+"""menu_versions: 日付ごとのメニュー版数（ETag / Last-Modified 用）
+
+追加方式。既存テーブルには触れない。行は更新系が初めて bump した時に作られる。
+
+Revision ID: p4_menu_versions
+Revises: p3_orders_v1
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "p4_menu_versions"
+down_revision: Union[str, Sequence[str], None] = "p3_orders_v1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "menu_versions",
+        sa.Column("serve_date", sa.Date(), primary_key=True),
+        sa.Column("version", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.text("now()")),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("menu_versions")
@@ -0,0 +1,44 @@
+"""order_counters: 日付ごとの注文番号カウンタ（#MMDD001 の連番）
+
+既存の注文番号の連番部分（#MMDD の後ろ）の最大値から初期値を入れる。削除や欠番があると件数は
+最大値より小さく、件数から始めると既存の番号と重なるため。番号の無い注文しかない日は件数を使う。
+
+Revision ID: p4_order_counters
+Revises: p4_menu_stock
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "p4_order_counters"
+down_revision: Union[str, Sequence[str], None] = "p4_menu_stock"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "order_counters",
+        sa.Column("serve_date", sa.Date(), primary_key=True),
+        sa.Column("last_number", sa.Integer(), nullable=False, server_default="0"),
+    )
+    if op.get_bind().dialect.name == "postgresql":
+        suffix = "CASE WHEN order_id ~ '^#[0-9]{5,}$' THEN CAST(SUBSTRING(order_id FROM 6) AS INTEGER) END"
+        greatest = "GREATEST"
+    else:
+        suffix = "CASE WHEN order_id GLOB '#[0-9][0-9][0-9][0-9][0-9]*' THEN CAST(substr(order_id, 6) AS INTEGER) END"
+        greatest = "MAX"  # SQLite の複数引数 MAX はスカラー関数
+    op.execute(
+        f"""
+        INSERT INTO order_counters (serve_date, last_number)
+        SELECT serve_date, {greatest}(COALESCE(MAX({suffix}), 0), COUNT(*))
+        FROM orders GROUP BY serve_date
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("order_counters")
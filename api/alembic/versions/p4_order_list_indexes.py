@@ -0,0 +1,38 @@
+"""orders: 注文一覧のキーセットページング・絞り込み用の複合索引、order_items.order_id の索引
+
+索引の追加のみ。データ移行は不要。
+
+Revision ID: p4_order_list_indexes
+Revises: p4_idempotency_keys
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "p4_order_list_indexes"
+down_revision: Union[str, Sequence[str], None] = "p4_idempotency_keys"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ORDER_INDEXES = {
+    "ix_orders_serve_date_created_at_id": ["serve_date", "created_at", "id"],
+    "ix_orders_serve_date_status_created_at": ["serve_date", "status", "created_at", "id"],
+    "ix_orders_serve_date_delivery_type_created_at": ["serve_date", "delivery_type", "created_at", "id"],
+    "ix_orders_serve_date_delivery_location_created_at": ["serve_date", "delivery_location", "created_at", "id"],
+    "ix_orders_serve_date_department_created_at": ["serve_date", "department", "created_at", "id"],
+    "ix_orders_serve_date_request_time_created_at": ["serve_date", "request_time", "created_at", "id"],
+}
+
+
+def upgrade() -> None:
+    for name, columns in ORDER_INDEXES.items():
+        op.create_index(name, "orders", columns)
+    op.create_index("ix_order_items_order_id", "order_items", ["order_id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_order_items_order_id", table_name="order_items")
+    for name in reversed(list(ORDER_INDEXES)):
+        op.drop_index(name, table_name="orders")
@@ -0,0 +1,27 @@
+"""realtime_event_seq: リアルタイム配信イベントの通し番号（Postgres のみ）
+
+イベントバス（postgres バックエンド）が NOTIFY 前に採番する。SQLite はプロセス内で採番するため何もしない。
+
+Revision ID: p4_realtime_event_seq
+Revises: p4_order_list_indexes
+Create Date: 2026-10-17
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+revision: str = "p4_realtime_event_seq"
+down_revision: Union[str, Sequence[str], None] = "p4_order_list_indexes"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("CREATE SEQUENCE IF NOT EXISTS realtime_event_seq")
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("DROP SEQUENCE IF EXISTS realtime_event_seq")
@@ -3,12 +3,14 @@ from typing import Optional
 from jose import JWTError, jwt
 from jose.exceptions import ExpiredSignatureError, JWTClaimsError
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from .database import get_db
 from .models import User
 from .schemas import User as UserSchema
+import hashlib
+import hmac
 import logging
 import time
 
@@ -139,3 +141,36 @@ def get_current_user_optional(credentials: Optional[HTTPAuthorizationCredentials
         return get_current_user(credentials, db)
     except HTTPException:
         return None
+
+# SSE（EventSource はヘッダを付けられない）の URL に載せる、用途を限った短命トークン。
+# 管理者 JWT をそのまま ?token= に載せると、プロキシやアクセスログに長く有効な資格情報が残るため。
+STREAM_TOKEN_TTL_SECONDS = int(os.getenv("STREAM_TOKEN_TTL_SECONDS", "300"))
+STREAM_TOKEN_AUD = "stream"
+
+def create_stream_token(scope: str) -> str:
+    """scope（例: "board:2025-06-12"）の購読だけに使える短命トークン"""
+    return create_access_token(
+        {"scope": scope, "iss": JWT_ISS, "aud": STREAM_TOKEN_AUD},
+        expires_delta=timedelta(seconds=STREAM_TOKEN_TTL_SECONDS),
+    )
+
+def verify_stream_token(token: Optional[str], scope: str) -> bool:
+    if not token:
+        return False
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], audience=STREAM_TOKEN_AUD, issuer=JWT_ISS)
+    except JWTError:
+        return False
+    return payload.get("scope") == scope
+
+def order_token(order_id: int) -> str:
+    """注文1件の状態を購読するためのトークン（注文作成時に注文者へ返す。注文 ID は連番で推測できるため）"""
+    return hmac.new(SECRET_KEY.encode(), f"order:{order_id}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def verify_order_token(order_id: int, token: Optional[str]) -> bool:
+    return bool(token) and hmac.compare_digest(order_token(order_id), token)
+
+ORDER_TOKEN_HEADER = "X-Order-Token"
+
+def set_order_token_header(response: Response, order_id: int) -> None:
+    response.headers[ORDER_TOKEN_HEADER] = order_token(order_id)
@@ -4,19 +4,29 @@
 更新系は CORS の allow_methods に合わせて PUT を使用（PATCH不可）。
 詳細: docs/overhaul-design.md
 """
+import hashlib
+import json
 import os
 import uuid
-from datetime import date as date_type
+from datetime import date as date_type, datetime, timedelta, timezone
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from anyio import from_thread
+from fastapi import APIRouter, Depends, Header, HTTPException, UploadFile, File, Request, Response
 from pydantic import BaseModel, ConfigDict, Field
-from sqlalchemy.orm import Session, selectinload
-
-from .database import get_db
-from .auth import get_current_admin
-from . import models
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .database import get_db, dialect_insert
+from .auth import get_current_admin, set_order_token_header
+from . import models, menu_versions, idempotency, order_intake
+from .fast_json import dumps, order_delta
+from .event_bus import event_bus
+from .realtime import board_topic
+from .stock_push import stock_publisher
 
 router = APIRouter(tags=["catalog-v2"])
 
@@ -174,6 +184,7 @@ class PublicMenuItem(BaseModel):
     price: int
     image_url: Optional[str]
     max_qty: int
+    remaining_qty: int
     cafe_time_available: bool
     category: Optional[str]
     option_groups: List[OptionGroupOut] = []
@@ -186,67 +197,232 @@ def _product_query(db: Session):
     )
 
 
-# ----------------------------- Public read -----------------------------
-@router.get("/v2/menus", response_model=List[PublicMenuItem])
-def get_v2_menus(date: date_type, db: Session = Depends(get_db)):
-    """指定日の日次メニュー（商品＋オプション＋有効価格）。お客様画面用。"""
-    rows = (
+def _public_daily_query(db: Session):
+    """DailyMenu→Product→Category を JOIN、OptionGroups→Options を selectin で一括ロード。
+    件数に関わらず3クエリ（daily_menus / option_groups / options）で完結する。"""
+    return (
         db.query(models.DailyMenu)
-        .filter(models.DailyMenu.serve_date == date, models.DailyMenu.is_available == True)  # noqa: E712
-        .order_by(models.DailyMenu.sort_order, models.DailyMenu.id)
+        .options(
+            joinedload(models.DailyMenu.product).options(
+                joinedload(models.Product.category),
+                selectinload(models.Product.option_groups).selectinload(models.OptionGroup.options),
+            )
+        )
+        .filter(models.DailyMenu.is_available == True)  # noqa: E712
+    )
+
+
+def _public_menu_item(dm: models.DailyMenu) -> PublicMenuItem:
+    p = dm.product
+    return PublicMenuItem(
+        daily_menu_id=dm.id, product_id=p.id, name=p.name, description=p.description,
+        price=dm.price_override if dm.price_override is not None else p.base_price,
+        image_url=p.image_url, max_qty=dm.max_qty, remaining_qty=max(0, dm.max_qty - (dm.sold_qty or 0)),
+        cafe_time_available=dm.cafe_time_available, category=p.category.name if p.category else None,
+        option_groups=[OptionGroupOut.model_validate(g) for g in p.option_groups],
+    )
+
+
+def _snapshot_item(dm: models.DailyMenu) -> tuple:
+    """品目の JSON を remaining_qty の値の直前までにして返す（値と閉じ括弧は配信時に足す）"""
+    item = _public_menu_item(dm).model_dump(mode="json")
+    del item["remaining_qty"]
+    return dm.id, json.dumps(item, ensure_ascii=False, separators=(",", ":"))[:-1] + ',"remaining_qty":'
+
+
+def _build_snapshots(db: Session, dates: Iterable[date_type]) -> Dict[date_type, dict]:
+    """指定日の公開メニューを組み立てる（日数に関わらず読み出しは3クエリ）。
+
+    payload は品目ごとの JSON（remaining_qty の値の直前まで）を連結したもの、item_index は
+    品目ごとの "daily_menu_id:文字数" をカンマでつないだもの。配信時は item_index に従って
+    payload を切り分け、残数を足すだけでよい（_render_snapshot）。品目の無い日はどちらも空。
+    """
+    dates = sorted(set(dates))
+    items: Dict[date_type, list] = {d: [] for d in dates}
+    rows = (
+        _public_daily_query(db)
+        .populate_existing()  # 同一セッションで更新直後でも最新の関連を読み直す
+        .filter(models.DailyMenu.serve_date.in_(dates))
+        .order_by(models.DailyMenu.serve_date, models.DailyMenu.sort_order, models.DailyMenu.id)
         .all()
     )
-    out = []
     for dm in rows:
-        p = dm.product
-        if not p or not p.is_active:
-            continue
-        groups = (
-            db.query(models.OptionGroup)
-            .filter(models.OptionGroup.product_id == p.id)
-            .order_by(models.OptionGroup.sort_order, models.OptionGroup.id)
+        if dm.product and dm.product.is_active:
+            items[dm.serve_date].append(_snapshot_item(dm))
+
+    now = datetime.now(timezone.utc)
+    snapshots = {}
+    for d, day_items in items.items():
+        payload = "".join(prefix for _, prefix in day_items)
+        item_index = ",".join(f"{dm_id}:{len(prefix)}" for dm_id, prefix in day_items)
+        etag = 'W/"%s"' % hashlib.sha1(f"{item_index}|{payload}".encode()).hexdigest()[:20]
+        snapshots[d] = {"serve_date": d, "payload": payload, "item_index": item_index, "etag": etag, "built_at": now}
+    return snapshots
+
+
+def _write_snapshots(db: Session, snapshots: List[dict], overwrite: bool = True) -> None:
+    insert = dialect_insert(db)
+    stmt = insert(models.MenuSnapshot).values(snapshots)
+    if overwrite:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.MenuSnapshot.serve_date],
+            set_={"payload": stmt.excluded.payload, "item_index": stmt.excluded.item_index,
+                  "etag": stmt.excluded.etag, "built_at": stmt.excluded.built_at},
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[models.MenuSnapshot.serve_date])
+    db.execute(stmt)
+
+
+def _store_snapshots(db: Session, dates: Iterable[date_type]) -> Dict[date_type, dict]:
+    """カタログ更新と同じトランザクションで、指定日のスナップショットを組み立て直して保存する。
+
+    品目の無い日は保存しない（更新で空になった日は行を消す）。匿名の GET に任意の日付を渡されても
+    行が増えないようにするため。空の日は参照のたびに組み立てる（書き込みは無い）。
+    """
+    snapshots = _build_snapshots(db, dates)
+    empty = [d for d, snap in snapshots.items() if not snap["item_index"]]
+    if empty:
+        db.query(models.MenuSnapshot).filter(models.MenuSnapshot.serve_date.in_(empty)).delete(synchronize_session=False)
+    stored = [snap for snap in snapshots.values() if snap["item_index"]]
+    if stored:
+        _write_snapshots(db, stored)
+    return snapshots
+
+
+def _load_snapshots(db: Session, start: date_type, end: date_type) -> Dict[date_type, dict]:
+    """期間のスナップショットを返す。未構築の日はその場で構築して保存する。
+
+    遅延構築の保存は、組み立て前に読んだ版数が保存直前（menu_versions の行ロック後）も同じ日だけ。
+    その間に同じ日を変えたカタログ更新（空にした更新を含む）があれば、古い内容を書き戻さない。
+    """
+    if start == end:
+        row = db.get(models.MenuSnapshot, start)  # 通常経路は主キー1件読み
+        found = {start: row} if row else {}
+    else:
+        rows = (
+            db.query(models.MenuSnapshot)
+            .filter(models.MenuSnapshot.serve_date >= start, models.MenuSnapshot.serve_date <= end)
             .all()
         )
-        cat = p.category.name if p.category else None
-        out.append(PublicMenuItem(
-            daily_menu_id=dm.id, product_id=p.id, name=p.name, description=p.description,
-            price=dm.price_override if dm.price_override is not None else p.base_price,
-            image_url=p.image_url, max_qty=dm.max_qty, cafe_time_available=dm.cafe_time_available,
-            category=cat, option_groups=[OptionGroupOut.model_validate(g) for g in groups],
-        ))
-    return out
+        found = {r.serve_date: r for r in rows}
+    snapshots = {
+        d: {"serve_date": d, "payload": r.payload, "item_index": r.item_index, "etag": r.etag, "built_at": r.built_at}
+        for d, r in found.items()
+    }
+    missing = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    missing = [d for d in missing if d not in snapshots]
+    if missing:
+        versions = menu_versions.load(db, missing[0], missing[-1])
+        built = _build_snapshots(db, missing)
+        snapshots.update(built)
+        filled = [d for d, snap in built.items() if snap["item_index"]]
+        if filled:
+            current = menu_versions.lock(db, filled)
+            fresh = [built[d] for d in filled if current[d] == versions.get(d, (0, None))[0]]
+            if fresh:
+                _write_snapshots(db, fresh, overwrite=False)
+            db.commit()
+    return snapshots
+
+
+def _catalog_changed(db: Session, dates: Iterable[Optional[date_type]]) -> None:
+    """カタログ更新系の共通フック。版数を上げ、該当日のスナップショットを同じトランザクションで再構築。"""
+    dates = {d for d in dates if d is not None}
+    if not dates:
+        return
+    db.flush()
+    menu_versions.bump(db, *dates)
+    _store_snapshots(db, dates)
 
 
-@router.get("/v2/menus-range")
-def get_v2_menus_range(start: date_type, end: date_type, db: Session = Depends(get_db)):
-    """期間の日次メニューをまとめて返す（お客様画面の週表示用）。days: {date: [items]}"""
+def _remaining_stock(db: Session, start: date_type, end: date_type) -> Dict[int, int]:
+    """daily_menu_id → 残数。daily_menus の在庫カウンタだけを読む（order_items は走査しない）。"""
     rows = (
-        db.query(models.DailyMenu)
-        .filter(models.DailyMenu.serve_date >= start, models.DailyMenu.serve_date <= end,
-                models.DailyMenu.is_available == True)  # noqa: E712
-        .order_by(models.DailyMenu.serve_date, models.DailyMenu.sort_order, models.DailyMenu.id)
+        db.query(models.DailyMenu.id, models.DailyMenu.max_qty, models.DailyMenu.sold_qty)
+        .filter(models.DailyMenu.serve_date >= start, models.DailyMenu.serve_date <= end)
         .all()
     )
-    days: dict = {}
-    for dm in rows:
-        p = dm.product
-        if not p or not p.is_active:
-            continue
-        groups = (
-            db.query(models.OptionGroup)
-            .filter(models.OptionGroup.product_id == p.id)
-            .order_by(models.OptionGroup.sort_order, models.OptionGroup.id)
-            .all()
+    return {r.id: max(0, r.max_qty - r.sold_qty) for r in rows}
+
+
+def _render_snapshot(snapshot: dict, stock: Dict[int, int]) -> str:
+    """保存済みの品目 JSON に現在の残数を足して配列にする（パースも再シリアライズもしない）"""
+    payload, parts, pos = snapshot["payload"], [], 0
+    for entry in filter(None, snapshot["item_index"].split(",")):
+        dm_id, length = entry.split(":")
+        end = pos + int(length)
+        parts.append(f"{payload[pos:end]}{stock.get(int(dm_id), 0)}}}")
+        pos = end
+    return "[" + ",".join(parts) + "]"
+
+
+def _snapshot_validators(snapshots: List[dict], scope: str, stock: Dict[int, int]) -> Dict[str, str]:
+    """スナップショットの ETag と現在の残数から、レスポンスの ETag を作る（残数が変われば変わる）"""
+    parts = [scope] + [f"{s['serve_date'].isoformat()}:{s['etag']}" for s in snapshots]
+    parts += [f"{dm_id}={qty}" for dm_id, qty in sorted(stock.items())]
+    etag = 'W/"%s"' % hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+    return menu_versions.validator_headers(etag, None, "no-cache")
+
+
+def _reserve_stock(db: Session, quantities: Dict[int, int]) -> None:
+    """在庫を1行ずつ条件付きUPDATEで確保する（残数が足りる時だけ成功・テーブルロック無し）。
+
+    呼び出し側のトランザクション内で実行し、失敗時は 409 sold_out（ロールバックで確保分も戻る）。
+    daily_menu_id 順に更新してロック順を固定する。
+    """
+    for dm_id in sorted(quantities):
+        qty = quantities[dm_id]
+        result = db.execute(
+            update(models.DailyMenu)
+            .where(models.DailyMenu.id == dm_id, models.DailyMenu.sold_qty + qty <= models.DailyMenu.max_qty)
+            .values(sold_qty=models.DailyMenu.sold_qty + qty)
+            .execution_options(synchronize_session=False)
         )
-        key = dm.serve_date.isoformat()
-        days.setdefault(key, []).append(PublicMenuItem(
-            daily_menu_id=dm.id, product_id=p.id, name=p.name, description=p.description,
-            price=dm.price_override if dm.price_override is not None else p.base_price,
-            image_url=p.image_url, max_qty=dm.max_qty, cafe_time_available=dm.cafe_time_available,
-            category=p.category.name if p.category else None,
-            option_groups=[OptionGroupOut.model_validate(g) for g in groups],
-        ))
-    return {"range": {"start": start.isoformat(), "end": end.isoformat(), "tz": "Asia/Tokyo"}, "days": days}
+        if result.rowcount != 1:
+            raise HTTPException(status_code=409, detail={
+                "code": "sold_out", "message": "売り切れのため注文できません", "daily_menu_id": dm_id,
+            })
+
+
+# ----------------------------- Public read -----------------------------
+# /v2/menus-range の最大日数（画面は7日表示。旧 /public/menus-range と同じ上限）
+V2_RANGE_MAX_DAYS = 14
+
+
+@router.get("/v2/menus", response_model=List[PublicMenuItem])
+def get_v2_menus(date: date_type, request: Request, db: Session = Depends(get_db)):
+    """指定日の日次メニュー（商品＋オプション＋有効価格＋残数）。お客様画面用。
+
+    menu_snapshots の主キー1件読み＋在庫カウンタの読み出しのみ。ETag 一致なら 304。
+    """
+    snapshot = _load_snapshots(db, date, date)[date]
+    stock = _remaining_stock(db, date, date)
+    headers = _snapshot_validators([snapshot], "v2-menus", stock)
+    if menu_versions.is_not_modified(request, headers["ETag"], None):
+        return menu_versions.not_modified(headers)
+    return Response(_render_snapshot(snapshot, stock), media_type="application/json", headers=headers)
+
+
+@router.get("/v2/menus-range")
+def get_v2_menus_range(start: date_type, end: date_type, request: Request, db: Session = Depends(get_db)):
+    """期間の日次メニューをまとめて返す（お客様画面の週表示用）。days: {date: [items]}"""
+    if (end - start).days > V2_RANGE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range cannot exceed {V2_RANGE_MAX_DAYS} days")
+    if start > end:
+        raise HTTPException(status_code=400, detail="Start date must be before or equal to end date")
+    snapshots = [s for _, s in sorted(_load_snapshots(db, start, end).items())]
+    stock = _remaining_stock(db, start, end)
+    headers = _snapshot_validators(snapshots, "v2-menus-range", stock)
+    if menu_versions.is_not_modified(request, headers["ETag"], None):
+        return menu_versions.not_modified(headers)
+    # 保存済みの JSON をそのままつなげて返す（品目の無い日は含めない）
+    days = ",".join(
+        f'"{s["serve_date"].isoformat()}":{_render_snapshot(s, stock)}'
+        for s in snapshots if s["item_index"]
+    )
+    range_ = dumps({"start": start.isoformat(), "end": end.isoformat(), "tz": "Asia/Tokyo"}).decode()
+    return Response(f'{{"range":{range_},"days":{{{days}}}}}', media_type="application/json", headers=headers)
 
 
 # ----------------------------- Admin: categories -----------------------------
@@ -282,6 +458,7 @@ def update_product(product_id: int, body: ProductIn, admin=Depends(get_current_a
         raise HTTPException(status_code=404, detail="product not found")
     for k, v in body.model_dump().items():
         setattr(p, k, v)
+    _catalog_changed(db, menu_versions.dates_for_products(db, [p.id]))
     db.commit(); db.refresh(p)
     return p
 
@@ -291,7 +468,10 @@ def delete_product(product_id: int, admin=Depends(get_current_admin), db: Sessio
     p = db.query(models.Product).get(product_id)
     if not p:
         raise HTTPException(status_code=404, detail="product not found")
-    db.delete(p); db.commit()
+    dates = menu_versions.dates_for_products(db, [p.id])
+    db.delete(p)
+    _catalog_changed(db, dates)
+    db.commit()
     return {"ok": True}
 
 
@@ -315,7 +495,9 @@ def _daily_query(db: Session):
 @router.post("/admin/catalog/daily-menus", response_model=DailyMenuOut)
 def create_daily_menu(body: DailyMenuIn, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
     dm = models.DailyMenu(**body.model_dump())
-    db.add(dm); db.commit(); db.refresh(dm)
+    db.add(dm)
+    _catalog_changed(db, [dm.serve_date])
+    db.commit(); db.refresh(dm)
     return dm
 
 
@@ -324,9 +506,13 @@ def update_daily_menu(dm_id: int, body: DailyMenuUpdate, admin=Depends(get_curre
     dm = db.query(models.DailyMenu).get(dm_id)
     if not dm:
         raise HTTPException(status_code=404, detail="daily_menu not found")
-    for k, v in body.model_dump(exclude_unset=True).items():
+    changes = body.model_dump(exclude_unset=True)
+    for k, v in changes.items():
         setattr(dm, k, v)
+    _catalog_changed(db, [dm.serve_date])
     db.commit(); db.refresh(dm)
+    if "max_qty" in changes:
+        from_thread.run_sync(stock_publisher.notify, dm.serve_date)
     return dm
 
 
@@ -335,7 +521,9 @@ def delete_daily_menu(dm_id: int, admin=Depends(get_current_admin), db: Session
     dm = db.query(models.DailyMenu).get(dm_id)
     if not dm:
         raise HTTPException(status_code=404, detail="daily_menu not found")
-    db.delete(dm); db.commit()
+    db.delete(dm)
+    _catalog_changed(db, [dm.serve_date])
+    db.commit()
     return {"ok": True}
 
 
@@ -343,7 +531,9 @@ def delete_daily_menu(dm_id: int, admin=Depends(get_current_admin), db: Session
 @router.post("/admin/catalog/option-groups", response_model=OptionGroupOut)
 def create_option_group(body: OptionGroupIn, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
     g = models.OptionGroup(**body.model_dump())
-    db.add(g); db.commit(); db.refresh(g)
+    db.add(g)
+    _catalog_changed(db, menu_versions.dates_for_products(db, [g.product_id]))
+    db.commit(); db.refresh(g)
     return g
 
 
@@ -352,14 +542,20 @@ def delete_option_group(group_id: int, admin=Depends(get_current_admin), db: Ses
     g = db.query(models.OptionGroup).get(group_id)
     if not g:
         raise HTTPException(status_code=404, detail="option_group not found")
-    db.delete(g); db.commit()
+    dates = menu_versions.dates_for_products(db, [g.product_id])
+    db.delete(g)
+    _catalog_changed(db, dates)
+    db.commit()
     return {"ok": True}
 
 
 @router.post("/admin/catalog/options", response_model=OptionOut)
 def create_option(body: OptionIn, admin=Depends(get_current_admin), db: Session = Depends(get_db)):
     o = models.Option(**body.model_dump())
-    db.add(o); db.commit(); db.refresh(o)
+    db.add(o)
+    g = db.query(models.OptionGroup).get(o.option_group_id)
+    _catalog_changed(db, menu_versions.dates_for_products(db, [g.product_id if g else None]))
+    db.commit(); db.refresh(o)
     return o
 
 
@@ -368,7 +564,10 @@ def delete_option(option_id: int, admin=Depends(get_current_admin), db: Session
     o = db.query(models.Option).get(option_id)
     if not o:
         raise HTTPException(status_code=404, detail="option not found")
-    db.delete(o); db.commit()
+    dates = menu_versions.dates_for_products(db, [o.group.product_id if o.group else None])
+    db.delete(o)
+    _catalog_changed(db, dates)
+    db.commit()
     return {"ok": True}
 
 
@@ -420,6 +619,7 @@ def apply_template(template_id: int, date: date_type, replace: bool = False,
             serve_date=date, product_id=it.product_id, price_override=it.price_override,
             max_qty=it.max_qty, sort_order=it.sort_order, is_available=True,
         ))
+    _catalog_changed(db, [date])
     db.commit()
     return (
         _daily_query(db).filter(models.DailyMenu.serve_date == date)
@@ -507,12 +707,19 @@ def set_day_setting(date: date_type, body: DaySettingIn, admin=Depends(get_curre
     ds.hero_image_id = body.hero_image_id
     if body.banner_text is not None:
         ds.banner_text = body.banner_text
+    menu_versions.bump(db, date)
     db.commit(); db.refresh(ds)
     return _day_setting_out(db, ds, date)
 
 
 @router.get("/v2/day-settings", response_model=DaySettingOut)
-def public_day_setting(date: date_type, db: Session = Depends(get_db)):
+def public_day_setting(date: date_type, request: Request, response: Response, db: Session = Depends(get_db)):
+    versions = menu_versions.load(db, date, date)
+    etag, last_modified = menu_versions.stamp("v2-day-settings", date, date, versions)
+    headers = menu_versions.validator_headers(etag, last_modified, "no-cache")
+    if menu_versions.is_not_modified(request, etag, last_modified):
+        return menu_versions.not_modified(headers)
+    response.headers.update(headers)
     ds = db.query(models.DaySetting).get(date)
     return _day_setting_out(db, ds, date)
 
@@ -520,7 +727,7 @@ def public_day_setting(date: date_type, db: Session = Depends(get_db)):
 # ----------------------------- v2 order (with options) -----------------------------
 class V2OrderItemIn(BaseModel):
     daily_menu_id: int
-    qty: int = 1
+    qty: int = Field(default=1, ge=1)
     option_ids: List[int] = []
 
 
@@ -543,14 +750,134 @@ class V2OrderOut(BaseModel):
     status: str
 
 
+def _resolve_v2_lines(db: Session, body: V2OrderIn, cafe_time: bool) -> List[tuple]:
+    """注文行の日次メニュー・商品・オプションを一括で読み、検証して (行, 日次メニュー, [オプション]) を返す。
+
+    行数・オプション数に関わらず、日次メニュー＋商品、オプション群、オプションの3クエリ。
+    商品とオプションは有効（is_active）であること、オプションは商品のオプション群に属すること、
+    群ごとの選択数が min_select〜max_select（is_required なら1以上）であることを確認する。
+    """
+    ids = {it.daily_menu_id for it in body.items}
+    daily = {
+        dm.id: dm for dm in (
+            db.query(models.DailyMenu)
+            .options(
+                joinedload(models.DailyMenu.product)
+                .selectinload(models.Product.option_groups)
+                .selectinload(models.OptionGroup.options)
+            )
+            .filter(models.DailyMenu.id.in_(ids))
+            .all()
+        )
+    }
+    # 公開メニューと同じく、無効化された商品は存在しないものとして扱う
+    missing = sorted(
+        i for i in ids
+        if i not in daily or daily[i].serve_date != body.serve_date or not daily[i].product.is_active
+    )
+    if missing:
+        raise HTTPException(status_code=404, detail={
+            "code": "menu_not_found", "message": "メニューが見つかりません", "daily_menu_ids": missing,
+        })
+
+    lines = []
+    for it in body.items:
+        dm = daily[it.daily_menu_id]
+        if cafe_time and not dm.cafe_time_available:
+            raise HTTPException(status_code=422, detail={"code": "menu_not_available", "message": "このメニューはカフェタイムでは注文できません"})
+        allowed = {opt.id: opt for g in dm.product.option_groups for opt in g.options if opt.is_active}
+        selected = []
+        for oid in dict.fromkeys(it.option_ids):  # 重複指定は1つとして扱う
+            if oid not in allowed:
+                raise HTTPException(status_code=422, detail={
+                    "code": "invalid_option", "message": "選択できないオプションが含まれています", "option_id": oid,
+                })
+            selected.append(allowed[oid])
+        for g in dm.product.option_groups:
+            count = sum(1 for opt in selected if opt.option_group_id == g.id)
+            low = max(g.min_select, 1 if g.is_required else 0) if any(opt.is_active for opt in g.options) else 0
+            if count < low or count > g.max_select:
+                raise HTTPException(status_code=422, detail={
+                    "code": "invalid_option_selection", "message": f"「{g.name}」の選択数が正しくありません",
+                    "option_group_id": g.id,
+                })
+        lines.append((it, dm, selected))
+    return lines
+
+
+def _place_v2_order(db: Session, body: V2OrderIn, delivery_type: models.DeliveryType, cafe_time: bool,
+                    record: Optional[Callable[[V2OrderOut], None]] = None,
+                    on_created: Optional[Callable[[models.OrderSQLAlchemy], None]] = None) -> V2OrderOut:
+    """v2 注文の検証・在庫確保・採番・書き込み（commit は呼び出し側）"""
+    from . import crud
+
+    lines = _resolve_v2_lines(db, body, cafe_time)
+
+    customer_name = f"{body.department}／{body.name}"
+    guest = crud.get_guest_user(db, f"guest_{customer_name}@temp.com", customer_name)
+
+    quantities: Dict[int, int] = {}
+    for it, dm, _ in lines:
+        quantities[dm.id] = quantities.get(dm.id, 0) + it.qty
+    _reserve_stock(db, quantities)
+    order_id = crud.generate_order_id(db, body.serve_date)
+
+    total = 0
+    order_items = []
+    for it, dm, options in lines:
+        base = dm.price_override if dm.price_override is not None else dm.product.base_price
+        oi = models.OrderItem(
+            daily_menu_id=dm.id, product_id=dm.product_id, menu_id=None,
+            name_snapshot=dm.product.name, unit_price_snapshot=base, qty=it.qty,
+            item_options=[
+                models.OrderItemOption(option_id=opt.id, name_snapshot=opt.name, price_delta_snapshot=opt.price_delta)
+                for opt in options
+            ],
+        )
+        order_items.append(oi)
+        total += (base + sum(opt.price_delta for opt in options)) * it.qty
+
+    order = models.OrderSQLAlchemy(
+        user_id=guest.id, serve_date=body.serve_date, delivery_type=delivery_type,
+        request_time=body.request_time, delivery_location=body.delivery_location,
+        total_price=total, status=models.OrderStatus.new, department=body.department,
+        customer_name=body.name, order_id=order_id, note=body.note, order_items=order_items,
+    )
+    db.add(order)
+    db.flush()  # 注文・明細・オプションのスナップショットをまとめて1回で書き込む
+    set_committed_value(order, "user", guest)  # 解決済み。on_created での遅延ロードを避ける
+    if on_created is not None:
+        on_created(order)
+    result = V2OrderOut(id=order.id, order_id=order.order_id, total_price=order.total_price, status=order.status.value)
+    if record is not None:
+        record(result)
+    return result
+
+
 @router.post("/v2/orders/guest", response_model=V2OrderOut)
-def create_v2_guest_order(body: V2OrderIn, db: Session = Depends(get_db)):
-    """新モデル（商品＋オプション）でのゲスト注文。価格は時点スナップショット保存。"""
+def create_v2_guest_order(
+    body: V2OrderIn,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    db: Session = Depends(get_db),
+):
+    """新モデル（商品＋オプション）でのゲスト注文。価格は時点スナップショット保存。
+
+    Idempotency-Key 付きの再送は保存済みレスポンスを返す（注文・採番・在庫に触れない）。
+    """
     import os
     from datetime import datetime
-    from . import crud
     from .time_utils import convert_to_pickup_at, validate_pickup_at
 
+    request_hash = None
+    if idempotency_key is not None:
+        idempotency.check_key(idempotency_key)
+        request_hash = idempotency.fingerprint(body)
+        replayed = idempotency.replay(db, "v2/orders/guest", idempotency_key, request_hash)
+        if replayed is not None:
+            set_order_token_header(replayed, json.loads(replayed.body)["id"])
+            return replayed
+
     if not body.items:
         raise HTTPException(status_code=422, detail={"code": "no_items", "message": "商品が選択されていません"})
 
@@ -575,46 +902,45 @@ def create_v2_guest_order(body: V2OrderIn, db: Session = Depends(get_db)):
     except ValueError:
         delivery_type = models.DeliveryType.desk
 
-    customer_name = f"{body.department}／{body.name}"
-    guest = crud.get_or_create_user(db, f"guest_{customer_name}@temp.com", customer_name)
-    order_id = crud.generate_order_id(db, body.serve_date)
+    delta: Dict[str, Any] = {}
 
-    order = models.OrderSQLAlchemy(
-        user_id=guest.id, serve_date=body.serve_date, delivery_type=delivery_type,
-        request_time=body.request_time, delivery_location=body.delivery_location,
-        total_price=0, status=models.OrderStatus.new, department=body.department,
-        customer_name=body.name, order_id=order_id, note=body.note,
-    )
-    db.add(order)
-    db.flush()
+    def place(session: Session) -> V2OrderOut:
+        record = None
+        if request_hash is not None:
+            record = idempotency.recorder(session, "v2/orders/guest", idempotency_key, request_hash)
+        # 管理画面に差し込む注文は、書き込んだ ORM オブジェクトからその場で組み立てる（commit 後に読み直さない）
+        return _place_v2_order(session, body, delivery_type, cafe_time, record,
+                               on_created=lambda order: delta.update(order_delta(order)))
 
-    total = 0
-    for it in body.items:
-        dm = db.query(models.DailyMenu).get(it.daily_menu_id)
-        if not dm or dm.serve_date != body.serve_date:
-            raise HTTPException(status_code=404, detail={"code": "menu_not_found", "message": "メニューが見つかりません"})
-        if cafe_time and not dm.cafe_time_available:
-            raise HTTPException(status_code=422, detail={"code": "menu_not_available", "message": "このメニューはカフェタイムでは注文できません"})
-        base = dm.price_override if dm.price_override is not None else dm.product.base_price
-        oi = models.OrderItem(
-            order_id=order.id, daily_menu_id=dm.id, product_id=dm.product_id, menu_id=None,
-            name_snapshot=dm.product.name, unit_price_snapshot=base, qty=it.qty,
-        )
-        db.add(oi)
-        db.flush()
-        line = base
-        for oid in it.option_ids:
-            opt = db.query(models.Option).get(oid)
-            if not opt:
-                continue
-            db.add(models.OrderItemOption(
-                order_item_id=oi.id, option_id=opt.id, name_snapshot=opt.name,
-                price_delta_snapshot=opt.price_delta,
-            ))
-            line += opt.price_delta
-        total += line * it.qty
-
-    order.total_price = total
-    db.commit()
-    db.refresh(order)
-    return V2OrderOut(id=order.id, order_id=order.order_id, total_price=order.total_price, status=order.status.value)
+    try:
+        if order_intake.enabled():
+            # 受付モード: 近い時刻の注文とまとめて1回の commit で書き込む（待つ間は接続を返しておく）
+            db.rollback()
+            result = order_intake.run(db, place)
+        else:
+            result = place(db)
+            db.commit()
+    except IntegrityError:
+        # 同じキーの同時再送が先に commit した。こちらはロールバックして、そのレスポンスを返す
+        db.rollback()
+        replayed = idempotency.replay(db, "v2/orders/guest", idempotency_key, request_hash) if request_hash else None
+        if replayed is None:
+            raise
+        set_order_token_header(replayed, json.loads(replayed.body)["id"])
+        return replayed
+
+    _publish_order_created(result, body, delta)
+    # 注文者だけが order:{id} を購読できるように、注文トークンを返す
+    set_order_token_header(response, result.id)
+    return result
+
+
+def _publish_order_created(result: V2OrderOut, body: V2OrderIn, order: Dict[str, Any]) -> None:
+    """管理画面の一覧・在庫の購読者に通知する（スレッドプールからイベントループ側の配信に渡す）"""
+    from_thread.run(event_bus.emit, [board_topic(body.serve_date)], {
+        "type": "order_created",
+        "order_id": result.id,
+        "customer_name": f"{body.department}／{body.name}",
+        "order": order,
+    })
+    from_thread.run_sync(stock_publisher.notify, body.serve_date)
@@ -1,13 +1,49 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import and_, or_, update
 from datetime import date, datetime
-from typing import List, Optional
-from . import models, schemas
+from typing import Callable, Dict, Iterable, List, Optional
+from . import database, models, schemas, menu_versions
+from .database import dialect_insert
+from .menu_cache import public_menu_cache
+from .user_cache import guest_user_cache, remember_after_commit
 from sqlmodel import select
 
+
+class OutOfStockError(Exception):
+    """Raised when a menu does not have enough remaining stock for an order."""
+
+    def __init__(self, menu_id: int):
+        super().__init__(f"menu {menu_id} is sold out")
+        self.menu_id = menu_id
+
+
+class UnknownMenuError(Exception):
+    """Raised when an order references menu ids that do not exist."""
+
+    def __init__(self, menu_ids: List[int]):
+        super().__init__(f"unknown menu ids: {menu_ids}")
+        self.menu_ids = menu_ids
+
 def get_menu_by_id(db: Session, menu_id: int):
     return db.query(models.MenuSQLAlchemy).filter(models.MenuSQLAlchemy.id == menu_id).first()
 
+def get_menus_by_ids(db: Session, menu_ids: Iterable[int]) -> Dict[int, models.MenuSQLAlchemy]:
+    """Fetch all given menus with one IN query, keyed by id"""
+    ids = set(menu_ids)
+    if not ids:
+        return {}
+    menus = db.query(models.MenuSQLAlchemy).filter(models.MenuSQLAlchemy.id.in_(ids)).all()
+    return {menu.id: menu for menu in menus}
+
+def load_order_menus(db: Session, items: List[schemas.OrderItemCreate]) -> Dict[int, models.MenuSQLAlchemy]:
+    """Menus referenced by an order; raises UnknownMenuError listing every missing id"""
+    menus = get_menus_by_ids(db, [item.menu_id for item in items])
+    missing = sorted({item.menu_id for item in items} - menus.keys())
+    if missing:
+        raise UnknownMenuError(missing)
+    return menus
+
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
@@ -25,43 +61,106 @@ def get_or_create_user(db: Session, email: str, name: str = None):
         user = create_user(db, user_data)
     return user
 
+def get_guest_user(db: Session, email: str, name: str) -> models.User:
+    """Resolve a guest user by synthetic email without a separate commit
+
+    Known emails come from the in-process LRU with no query. Otherwise one
+    INSERT .. ON CONFLICT (email) DO NOTHING RETURNING creates the row in the caller's
+    transaction; if the row already exists (or another request created it first) it is
+    read back with one SELECT. The returned User is transient (not in the session);
+    use its id for foreign keys.
+    """
+    info = guest_user_cache.get(email)
+    if info is None:
+        columns = (models.User.id, models.User.name, models.User.email, models.User.seat_id, models.User.created_at)
+        insert = dialect_insert(db)
+        stmt = insert(models.User).values(
+            email=email, name=name, created_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=[models.User.email]).returning(*columns)
+        row = db.execute(stmt).first()
+        if row is not None:
+            info = dict(row._mapping)
+            remember_after_commit(db, email, info)
+        else:
+            info = dict(db.query(*columns).filter(models.User.email == email).one()._mapping)
+            guest_user_cache.put(email, info)
+    return models.User(**info)
+
 def get_menus_by_date(db: Session, serve_date: date):
     return db.query(models.MenuSQLAlchemy).filter(models.MenuSQLAlchemy.serve_date == serve_date).all()
 
-def get_weekly_menus(db: Session, start_date: date, end_date: date):
-    """Get menus for date range - serve_date は Date型なので直接比較が最適"""
+def get_weekly_menus(db: Session, start_date: date, end_date: date) -> List[schemas.MenuWithRemaining]:
+    """Get menus for date range with remaining_qty - serve_date は Date型なので直接比較が最適
+
+    残数は注文作成時に予約済みの menus.sold_qty から求める（order_items の集計は不要）。
+    """
     menus = db.query(models.MenuSQLAlchemy).filter(
         and_(models.MenuSQLAlchemy.serve_date >= start_date, models.MenuSQLAlchemy.serve_date <= end_date)
     ).order_by(models.MenuSQLAlchemy.serve_date.asc(), models.MenuSQLAlchemy.id.asc()).all()
-    
-    menu_with_remaining = []
-    for menu in menus:
-        ordered_qty = db.query(func.sum(models.OrderItem.qty)).join(models.OrderSQLAlchemy).filter(
-            and_(
-                models.OrderItem.menu_id == menu.id,
-                models.OrderSQLAlchemy.serve_date == menu.serve_date,
-                models.OrderSQLAlchemy.status != models.OrderStatus.new
+
+    return [
+        schemas.MenuWithRemaining(
+            id=menu.id,
+            serve_date=menu.serve_date,
+            title=menu.title,
+            price=menu.price,
+            max_qty=menu.max_qty,
+            img_url=menu.img_url,
+            cafe_time_available=bool(menu.cafe_time_available),
+            created_at=menu.created_at,
+            remaining_qty=max(0, menu.max_qty - (menu.sold_qty or 0)),
+        )
+        for menu in menus
+    ]
+
+def reserve_menu_stock(db: Session, items: List[schemas.OrderItemCreate]) -> None:
+    """Reserve stock for order items inside the caller's transaction.
+
+    Each menu is reserved with a single conditional UPDATE that only matches while
+    sold_qty + qty <= max_qty, so concurrent orders cannot oversell and no table lock
+    is taken. Menus are updated in id order to keep row-lock order stable.
+    Raises OutOfStockError if any menu cannot be reserved; the caller's transaction
+    must then be rolled back (closing the session does this).
+    """
+    quantities = {}
+    for item in items:
+        if item.qty < 1:
+            # A non-positive qty would lower sold_qty and free stock beyond max_qty
+            raise ValueError(f"qty must be positive (menu_id={item.menu_id})")
+        quantities[item.menu_id] = quantities.get(item.menu_id, 0) + item.qty
+
+    for menu_id in sorted(quantities):
+        qty = quantities[menu_id]
+        result = db.execute(
+            update(models.MenuSQLAlchemy)
+            .where(
+                models.MenuSQLAlchemy.id == menu_id,
+                models.MenuSQLAlchemy.sold_qty + qty <= models.MenuSQLAlchemy.max_qty,
             )
-        ).scalar() or 0
-        
-        remaining_qty = menu.max_qty - ordered_qty
-        menu_dict = menu.__dict__.copy()
-        menu_dict['remaining_qty'] = max(0, remaining_qty)
-        menu_with_remaining.append(menu_dict)
-    
-    return menu_with_remaining
+            .values(sold_qty=models.MenuSQLAlchemy.sold_qty + qty)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            raise OutOfStockError(menu_id)
 
-def calculate_order_total(db: Session, items: List[schemas.OrderItemCreate]) -> int:
+def calculate_order_total(db: Session, items: List[schemas.OrderItemCreate],
+                          menus: Optional[Dict[int, models.MenuSQLAlchemy]] = None) -> int:
     """Calculate total price for order items"""
+    if menus is None:
+        menus = get_menus_by_ids(db, [item.menu_id for item in items])
     total_price = 0
     for item in items:
-        menu = db.query(models.MenuSQLAlchemy).filter(models.MenuSQLAlchemy.id == item.menu_id).first()
+        menu = menus.get(item.menu_id)
         if menu:
             total_price += menu.price * item.qty
     return total_price
 
-def create_order(db: Session, order: schemas.OrderCreate, user_id: int):
-    total_price = calculate_order_total(db, order.items)
+def create_order(db: Session, order: schemas.OrderCreate, user_id: int,
+                 menus: Optional[Dict[int, models.MenuSQLAlchemy]] = None) -> schemas.Order:
+    if menus is None:
+        menus = load_order_menus(db, order.items)
+    total_price = calculate_order_total(db, order.items, menus)
+    reserve_menu_stock(db, order.items)
     order_id = generate_order_id(db, order.serve_date)
     
     db_order = models.OrderSQLAlchemy(
@@ -73,21 +172,31 @@ def create_order(db: Session, order: schemas.OrderCreate, user_id: int):
         status=models.OrderStatus.new,
         order_id=order_id
     )
+    return _insert_order(db, db_order, order.items, menus)
+
+def _insert_order(db: Session, db_order: models.OrderSQLAlchemy, items: List[schemas.OrderItemCreate],
+                  menus: Dict[int, models.MenuSQLAlchemy], user: Optional[models.User] = None,
+                  on_created: Optional[Callable[[schemas.Order], None]] = None,
+                  commit: bool = True) -> schemas.Order:
+    """Insert an order with all of its items in one flush and commit once.
+
+    The order INSERT is followed by a single batched INSERT for the items. The response
+    is built from the in-memory rows before commit, so nothing is re-read afterwards.
+    on_created runs with the response inside the same transaction, just before commit.
+    With commit=False the caller commits. The public menu cache carries no remaining
+    quantities, so orders leave it alone.
+    """
+    db_order.order_items = [models.OrderItem(menu=menus[item.menu_id], qty=item.qty) for item in items]
     db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-    
-    for item in order.items:
-        db_item = models.OrderItem(
-            order_id=db_order.id,
-            menu_id=item.menu_id,
-            qty=item.qty
-        )
-        db.add(db_item)
-    
-    db.commit()
-    db.refresh(db_order)
-    return db_order
+    db.flush()
+    if user is not None:
+        set_committed_value(db_order, "user", user)  # already resolved; avoid a lazy load
+    result = schemas.Order.model_validate(db_order)
+    if on_created is not None:
+        on_created(result)
+    if commit:
+        db.commit()
+    return result
 
 def get_order(db: Session, order_id: int):
     return db.query(models.OrderSQLAlchemy).filter(models.OrderSQLAlchemy.id == order_id).first()
@@ -100,21 +209,58 @@ def update_order_status(db: Session, order_id: int, status: models.OrderStatus):
         db.refresh(order)
     return order
 
-def get_today_orders(db: Session, serve_date: date, status_filter: Optional[str] = None):
-    from sqlalchemy.orm import joinedload
+# Exact-match filters accepted by get_today_orders (each has a (serve_date, column, created_at, id) index)
+ORDER_FILTER_COLUMNS = ("delivery_type", "delivery_location", "department", "request_time")
+
+def get_today_orders(
+    db: Session,
+    serve_date: date,
+    status_filter: Optional[str] = None,
+    filters: Optional[Dict[str, object]] = None,
+    after: Optional[tuple] = None,
+    limit: Optional[int] = None,
+):
+    """Orders for a serve date in (created_at, id) order.
+
+    `after` is the (created_at, id) of the last order on the previous page; with `limit`
+    this is keyset pagination, so every page is an index range scan regardless of depth.
+    Legacy rows with a NULL created_at sort last (Postgres' default for an ascending
+    index), ordered by id; a cursor from one of them has created_at None.
+    """
+    from sqlalchemy.orm import joinedload, selectinload
     
-    query = db.query(models.OrderSQLAlchemy).options(
-        joinedload(models.OrderSQLAlchemy.user),
-        joinedload(models.OrderSQLAlchemy.order_items).joinedload(models.OrderItem.menu)
-    ).filter(models.OrderSQLAlchemy.serve_date == serve_date)
+    Order = models.OrderSQLAlchemy
+    query = db.query(Order).options(
+        joinedload(Order.user),
+        # Items are loaded with a separate IN query so LIMIT applies to orders, not joined rows
+        selectinload(Order.order_items).joinedload(models.OrderItem.menu)
+    ).filter(Order.serve_date == serve_date)
     
     if status_filter:
         if status_filter == 'confirmed':
-            query = query.filter(models.OrderSQLAlchemy.status != 'new')
+            query = query.filter(Order.status != 'new')
         else:
-            query = query.filter(models.OrderSQLAlchemy.status == status_filter)
-    
-    return query.order_by(models.OrderSQLAlchemy.created_at.asc()).all()
+            query = query.filter(Order.status == status_filter)
+    for column, value in (filters or {}).items():
+        if column not in ORDER_FILTER_COLUMNS:
+            raise ValueError(f"unsupported order filter: {column}")
+        if value is not None:
+            query = query.filter(getattr(Order, column) == value)
+    if after is not None:
+        created_at, order_pk = after
+        if created_at is None:
+            query = query.filter(Order.created_at.is_(None), Order.id > order_pk)
+        else:
+            query = query.filter(or_(
+                Order.created_at > created_at,
+                and_(Order.created_at == created_at, Order.id > order_pk),
+                Order.created_at.is_(None),
+            ))
+    
+    query = query.order_by(Order.created_at.asc().nulls_last(), Order.id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
 
 def create_sample_menus(db: Session):
     """Create sample menu data for testing"""
@@ -155,7 +301,9 @@ def create_sample_menus(db: Session):
             menu = models.MenuSQLAlchemy(**menu_data)
             db.add(menu)
     
+    menu_versions.bump(db, today)
     db.commit()
+    public_menu_cache.invalidate(today)
 
 def get_menus(db: Session, date_filter: date = None):
     """Get menus with optional date filter"""
@@ -256,17 +404,22 @@ def delete_menu_item(db: Session, item_id: int):
     db.commit()
     return True
 
-def create_guest_order(db: Session, order: schemas.OrderCreateWithDepartmentName):
+def create_guest_order(db: Session, order: schemas.OrderCreateWithDepartmentName,
+                       menus: Optional[Dict[int, models.MenuSQLAlchemy]] = None,
+                       on_created: Optional[Callable[[schemas.Order], None]] = None,
+                       commit: bool = True) -> schemas.Order:
     """Create an order without user authentication using customer name"""
     
-    total_price = calculate_order_total(db, order.items)
+    if menus is None:
+        menus = load_order_menus(db, order.items)
+    total_price = calculate_order_total(db, order.items, menus)
     
     customer_name = f"{order.department}／{order.name}"
-    guest_user = get_or_create_user(db, f"guest_{customer_name}@temp.com", customer_name)
+    guest_user = get_guest_user(db, f"guest_{customer_name}@temp.com", customer_name)
     
+    reserve_menu_stock(db, order.items)
     order_id = generate_order_id(db, order.serve_date)
     
-    
     db_order = models.OrderSQLAlchemy(
         user_id=guest_user.id,
         serve_date=order.serve_date,
@@ -280,28 +433,7 @@ def create_guest_order(db: Session, order: schemas.OrderCreateWithDepartmentName
         order_id=order_id,
         note=order.note,
     )
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-    
-    
-    for item in order.items:
-        db_item = models.OrderItem(
-            order_id=db_order.id,
-            menu_id=item.menu_id,
-            qty=item.qty
-        )
-        db.add(db_item)
-    
-    db.commit()
-    db.refresh(db_order)
-    
-    from sqlalchemy.orm import joinedload
-    db_order_with_menus = db.query(models.OrderSQLAlchemy).options(
-        joinedload(models.OrderSQLAlchemy.order_items).joinedload(models.OrderItem.menu)
-    ).filter(models.OrderSQLAlchemy.id == db_order.id).first()
-    
-    return db_order_with_menus
+    return _insert_order(db, db_order, order.items, menus, guest_user, on_created, commit)
 
 def get_menus_sqlalchemy(db: Session, date_filter: Optional[date] = None):
     """Get MenuSQLAlchemy menus with optional date filter
@@ -361,8 +493,10 @@ def create_menu_sqlalchemy(db: Session, menu: schemas.MenuSQLAlchemyCreate):
         cafe_time_available=cafe_time_available
     )
     db.add(db_menu)
+    menu_versions.bump(db, menu.serve_date)
     db.commit()
     db.refresh(db_menu)
+    public_menu_cache.invalidate(db_menu.serve_date)
     
     logger.info(f"SAVED id={db_menu.id} serve_date={db_menu.serve_date}")
     
@@ -385,8 +519,10 @@ def update_menu_sqlalchemy(db: Session, menu_id: int, menu_update: schemas.MenuS
     if menu_update.cafe_time_available is not None:
         menu.cafe_time_available = menu_update.cafe_time_available
     
+    menu_versions.bump(db, menu.serve_date)
     db.commit()
     db.refresh(menu)
+    public_menu_cache.invalidate(menu.serve_date)
     return menu
 
 def delete_menu_sqlalchemy(db: Session, menu_id: int):
@@ -395,16 +531,40 @@ def delete_menu_sqlalchemy(db: Session, menu_id: int):
     if not menu:
         return False
     
+    serve_date = menu.serve_date
     db.delete(menu)
+    menu_versions.bump(db, serve_date)
     db.commit()
+    public_menu_cache.invalidate(serve_date)
     return True
 
 def generate_order_id(db: Session, serve_date: date) -> str:
-    """Generate order ID in #MMDD000 format with race condition protection"""
-    existing_orders = db.query(models.OrderSQLAlchemy).filter(
-        models.OrderSQLAlchemy.serve_date == serve_date
-    ).with_for_update().order_by(models.OrderSQLAlchemy.created_at.asc()).all()
-    
+    """Generate order ID in #MMDD000 format from the per-date counter in order_counters
+
+    A single INSERT .. ON CONFLICT DO UPDATE .. RETURNING increments the day's counter,
+    so only one row is touched and numbers stay unique across API machines.
+    On Postgres the increment commits in its own short transaction, so the counter row
+    lock is released immediately instead of being held until the order commits. Orders
+    for the same date no longer serialize on it; a rolled-back order leaves a gap in the
+    numbering. The increment runs on database.order_counter_engine, a one-connection pool
+    of its own: taking a second connection from the shared pool while this session holds
+    one would deadlock the pool once concurrent orders reach its size. SQLite serializes
+    all writers per database anyway (and a second connection would wait on this
+    session's own write lock), so there the increment stays in the caller's transaction.
+    """
+    insert = dialect_insert(db)
+    stmt = insert(models.OrderCounter).values(serve_date=serve_date, last_number=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.OrderCounter.serve_date],
+        set_={"last_number": models.OrderCounter.last_number + 1},
+    ).returning(models.OrderCounter.last_number)
+    bind = db.get_bind()
+    if bind.dialect.name == "sqlite":
+        number = db.execute(stmt).scalar_one()
+    else:
+        with database.order_counter_engine.connect() as conn:
+            number = conn.execute(stmt).scalar_one()
+            conn.commit()
+
     month_day = serve_date.strftime("%m%d")
-    order_number = str(len(existing_orders) + 1).zfill(3)
-    return f"#{month_day}{order_number}"
+    return f"#{month_day}{str(number).zfill(3)}"
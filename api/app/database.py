@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlmodel import SQLModel
@@ -12,12 +13,28 @@ if DATABASE_URL.startswith("postgres://"):
 elif DATABASE_URL.startswith("postgresql://"):
     DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
 
+# Postgres の接続数はプロセスごとに DB_POOL_SIZE + DB_MAX_OVERFLOW（既定 6 + 6）を同期・非同期の
+# エンジンで半分ずつ使う（ほかに採番用とイベントバス用に1本ずつ）。pooler 側の上限はこれ×プロセス数で見積もる
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "6"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "6"))
+
 if DATABASE_URL.startswith("postgresql"):
     # Postgres(Supabase)。pooler(pgbouncer)経由でも動くよう prepared statement を無効化
     engine = create_engine(
         DATABASE_URL,
-        pool_size=5,
-        max_overflow=10,
+        pool_size=max(1, DB_POOL_SIZE // 2),
+        max_overflow=DB_MAX_OVERFLOW // 2,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        connect_args={"prepare_threshold": None},
+    )
+    # 注文番号の採番専用（crud.generate_order_id）。注文中のセッションが接続を持ったまま共有プールから
+    # 2本目を待つと、同時注文がプール上限に達したところで互いに待ち合って詰まるため、プールを分ける。
+    # 採番は UPSERT 1文ですぐ commit するので1本で足りる
+    order_counter_engine = create_engine(
+        DATABASE_URL,
+        pool_size=1,
+        max_overflow=0,
         pool_timeout=30,
         pool_pre_ping=True,
         connect_args={"prepare_threshold": None},
@@ -25,14 +42,44 @@ if DATABASE_URL.startswith("postgresql"):
 else:
     # SQLite（ローカル/旧構成）
     engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20, pool_timeout=60)
+    order_counter_engine = None
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 非同期エンジン（async def のルート用）。同期エンジンは alembic・シードスクリプト・同期ルート用に残す。
+# Postgres は psycopg(v3) の async、SQLite は aiosqlite。
+if DATABASE_URL.startswith("postgresql"):
+    async_engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=max(1, DB_POOL_SIZE - DB_POOL_SIZE // 2),
+        max_overflow=DB_MAX_OVERFLOW - DB_MAX_OVERFLOW // 2,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        connect_args={"prepare_threshold": None},
+    )
+else:
+    async_engine = create_async_engine(DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+# run_sync 内で同期の crud を使うため autoflush は同期側と揃える。commit 後の属性アクセスで
+# 暗黙の再読込み（await できない I/O）が起きないよう expire_on_commit=False
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
     Base.metadata.create_all(engine)
 
+def dialect_insert(db):
+    """ON CONFLICT 付き INSERT（upsert）用に、接続先に応じた insert() を返す"""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def get_db():
     db = SessionLocal()
     try:
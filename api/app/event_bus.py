@@ -0,0 +1,214 @@
+"""注文・状態・配達イベントのプロセス間配信（pub/sub）。
+
+ConnectionManager はプロセス内の WebSocket しか知らないため、uvicorn のワーカーや Fly のマシンを
+増やすと、別プロセスで作られた注文が管理画面に届かない。イベントはいったんこのバスに publish し、
+各プロセスのバスが受け取ったものを自プロセスの接続へ配る（subscribe したハンドラを呼ぶ）。
+
+- postgres: Postgres の NOTIFY / LISTEN（チャンネル EVENT_BUS_CHANNEL, 既定 crowdlunch_events）。
+  自プロセスの publish も LISTEN 経由で受け取るため、配信は各プロセスで1回ずつ。
+  LISTEN は接続を張ったままにする必要があり、pgbouncer の transaction pooling 越しでは通知が届かない。
+  接続先は EVENT_BUS_DATABASE_URL（DB への直結か session pooling の URL）で、未指定なら DATABASE_URL。
+  起動時に自分宛ての確認用 NOTIFY を送り、EVENT_BUS_STARTUP_TIMEOUT_SECONDS（既定5秒）以内に
+  LISTEN で受け取れなければ起動を失敗させる（黙って他プロセスのイベントが届かなくなるのを防ぐ）
+- memory: プロセス内でそのままハンドラを呼ぶ（SQLite・テスト用）
+
+order_created は管理画面に差し込む注文そのもの（order）を載せる。NOTIFY に載らない大きさなら
+order を外して送り、受け取った端末は一覧を取り直す。
+
+イベントには publish 時に単調増加の通し番号 seq を付ける（postgres はシーケンス
+realtime_event_seq。採番から NOTIFY までを advisory lock で直列化し、届く順と seq の順を揃える）。
+端末は seq の小さいイベントを重複として捨てるため、この直列化は外せない。ロックを持つのは
+採番・NOTIFY・commit の間だけで、publish はリクエストの接続プールではなくバス専用の接続（1本）で行う。
+端末は最後に受け取った seq を覚えておき、再接続時に続きを再送してもらう（realtime 参照）。
+
+リクエスト処理からは emit() を使う（失敗してもレスポンスに影響させない）。
+
+EVENT_BUS=postgres|memory。未指定なら DATABASE_URL が Postgres のとき postgres。
+
+Postgres での動作確認は tests の test_postgres_event_bus_round_trip（TEST_POSTGRES_URL を指定したときだけ実行）。
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+EVENT_BUS_CHANNEL = os.getenv("EVENT_BUS_CHANNEL", "crowdlunch_events")
+# NOTIFY のペイロード上限は 8000 バイト
+MAX_NOTIFY_PAYLOAD = 7900
+RECONNECT_DELAY = 1.0
+STARTUP_TIMEOUT = float(os.getenv("EVENT_BUS_STARTUP_TIMEOUT_SECONDS", "5"))
+
+# (seq, topics, message)。message は seq を含む JSON 文字列
+Handler = Callable[[int, List[str], str], Awaitable[None]]
+
+
+def encode(seq: int, event: dict) -> str:
+    return json.dumps({**event, "seq": seq}, ensure_ascii=False)
+
+
+class EventBus:
+    def __init__(self):
+        self._handlers: List[Handler] = []
+
+    def subscribe(self, handler: Handler) -> None:
+        """受け取ったイベント (seq, topics, message) を渡す先（このプロセスの配信）"""
+        self._handlers.append(handler)
+
+    async def publish(self, topics: Iterable[str], event: dict) -> None:
+        raise NotImplementedError
+
+    async def emit(self, topics: Iterable[str], event: dict) -> None:
+        """commit 済みの変更の通知用。publish の失敗（接続プール枯渇・DB エラーなど）はログに残すだけで、
+        呼び出し側のレスポンスを変えない（500 を返すと、保存済みの注文を端末が再送してしまう）"""
+        try:
+            await self.publish(topics, event)
+        except Exception:
+            logger.exception("event publish failed: %s", event.get("type"))
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def _deliver(self, seq: int, topics: List[str], message: str) -> None:
+        for handler in self._handlers:
+            try:
+                await handler(seq, topics, message)
+            except Exception:
+                logger.exception("event handler failed")
+
+
+class InMemoryEventBus(EventBus):
+    def __init__(self):
+        super().__init__()
+        self._seq = itertools.count(1)
+
+    async def publish(self, topics: Iterable[str], event: dict) -> None:
+        seq = next(self._seq)
+        await self._deliver(seq, list(topics), encode(seq, event))
+
+
+class PostgresEventBus(EventBus):
+    def __init__(self, url: str, channel: str = EVENT_BUS_CHANNEL, engine: Optional[AsyncEngine] = None):
+        super().__init__()
+        # SQLAlchemy の URL（postgresql+psycopg://）を libpq の接続文字列にする
+        self.url = make_url(url).set(drivername="postgresql+psycopg")
+        self.conninfo = self.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        self.channel = channel
+        self._engine = engine
+        self._listener: Optional[asyncio.Task] = None
+        self._probes: dict = {}
+
+    @property
+    def engine(self) -> AsyncEngine:
+        """publish 用の接続（1本）。リクエストの接続プールとは分ける"""
+        if self._engine is None:
+            self._engine = create_async_engine(
+                self.url, pool_size=1, max_overflow=0, pool_pre_ping=True,
+                connect_args={"prepare_threshold": None},
+            )
+        return self._engine
+
+    async def publish(self, topics: Iterable[str], event: dict) -> None:
+        topics = list(topics)
+        async with self.engine.connect() as conn:
+            # commit まで保持されるロックで採番〜NOTIFY を直列化（NOTIFY は commit 順に届く）
+            await conn.execute(select(func.pg_advisory_xact_lock(func.hashtext(self.channel))))
+            seq = (await conn.execute(text("SELECT nextval('realtime_event_seq')"))).scalar_one()
+            message = encode(seq, event)
+            payload = json.dumps({"seq": seq, "topics": topics, "message": message}, ensure_ascii=False)
+            if len(payload.encode("utf-8")) > MAX_NOTIFY_PAYLOAD and "order" in event:
+                # 明細の多い注文。差分を外して送り、受け取った管理画面には一覧を取り直させる
+                message = encode(seq, {k: v for k, v in event.items() if k != "order"})
+                payload = json.dumps({"seq": seq, "topics": topics, "message": message}, ensure_ascii=False)
+            if len(payload.encode("utf-8")) > MAX_NOTIFY_PAYLOAD:
+                # NOTIFY に載らない大きさ。他プロセスには届かないが、このプロセスの接続には配る
+                logger.warning("event too large for NOTIFY (%d bytes); delivering locally only", len(payload))
+                await conn.commit()
+                await self._deliver(seq, topics, message)
+                return
+            await conn.execute(select(func.pg_notify(self.channel, payload)))
+            await conn.commit()
+
+    async def start(self, timeout: float = STARTUP_TIMEOUT) -> None:
+        """LISTEN を張り、確認用の NOTIFY が戻ってくるまで待つ。届かなければ RuntimeError"""
+        if self._listener is not None:
+            return
+        conn = await self._listen_connection()
+        self._listener = asyncio.create_task(self._listen(conn))
+        probe = uuid.uuid4().hex
+        received = self._probes[probe] = asyncio.get_running_loop().create_future()
+        try:
+            async with self.engine.connect() as notify_conn:
+                await notify_conn.execute(select(func.pg_notify(self.channel, json.dumps({"probe": probe}))))
+                await notify_conn.commit()
+            await asyncio.wait_for(received, timeout)
+        except Exception as e:
+            await self.stop()
+            raise RuntimeError(
+                "event bus LISTEN did not receive its own NOTIFY; EVENT_BUS_DATABASE_URL must be a direct "
+                "(or session-pooled) Postgres connection, not a transaction pooler"
+            ) from e
+        finally:
+            self._probes.pop(probe, None)
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    async def _listen_connection(self):
+        import psycopg
+
+        conn = await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True)
+        await conn.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    async def _listen(self, conn) -> None:
+        while True:
+            try:
+                if conn is None:
+                    conn = await self._listen_connection()
+                async with conn:
+                    async for notify in conn.notifies():
+                        event = json.loads(notify.payload)
+                        if "probe" in event:
+                            # 起動確認用（他プロセスの確認は無視する）
+                            received = self._probes.get(event["probe"])
+                            if received is not None and not received.done():
+                                received.set_result(True)
+                            continue
+                        await self._deliver(event["seq"], event["topics"], event["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 接続断など。切れている間のイベントは失われる（端末側は再取得で追いつく）
+                logger.exception("event bus listener failed; reconnecting")
+                await asyncio.sleep(RECONNECT_DELAY)
+            conn = None
+
+
+def create_event_bus() -> EventBus:
+    backend = os.getenv("EVENT_BUS") or ("postgres" if database.DATABASE_URL.startswith("postgresql") else "memory")
+    if backend == "postgres":
+        return PostgresEventBus(os.getenv("EVENT_BUS_DATABASE_URL") or database.DATABASE_URL)
+    return InMemoryEventBus()
+
+
+event_bus = create_event_bus()
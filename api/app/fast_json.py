@@ -0,0 +1,133 @@
+"""読み取り専用の一覧エンドポイント向けの高速 JSON レスポンス。
+
+/admin/orders/today・/orders・/v2/menus 系は、ORM から直接 dict を組み立てて
+FastJSONResponse で返す（response_model による再検証と jsonable_encoder を通さない）。
+orjson（pyproject の依存）を使い、入っていない環境では標準 json にフォールバックする。
+FAST_JSON=stdlib で明示的に標準 json に切り替えられる。
+
+出力は schemas.Order の JSON と同じ形になるように組み立てる（日時の UTC は "Z" 表記）。
+
+    cd api && python -m scripts.bench_order_serialization
+"""
+import json
+import os
+from datetime import date, datetime
+from typing import Any, Iterable, List, Optional
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # wheel の無い環境など
+    orjson = None
+
+FAST_JSON = os.getenv("FAST_JSON", "orjson")
+
+
+def use_orjson() -> bool:
+    return orjson is not None and FAST_JSON != "stdlib"
+
+
+def dumps(content: Any) -> bytes:
+    if use_orjson():
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _iso(v: Optional[datetime]) -> Optional[str]:
+    """pydantic の JSON 出力と同じ ISO 8601 表記（UTC は末尾 Z）"""
+    if v is None:
+        return None
+    s = v.isoformat()
+    return s[:-6] + "Z" if s.endswith("+00:00") else s
+
+
+def _date(v: Optional[date]) -> Optional[str]:
+    return v.isoformat() if v is not None else None
+
+
+def _menu(m) -> Optional[dict]:
+    if m is None:
+        return None  # v2 の明細は旧メニューを持たない
+    return {
+        "serve_date": _date(m.serve_date),
+        "title": m.title,
+        "price": m.price,
+        "max_qty": m.max_qty,
+        "img_url": m.img_url,
+        "id": m.id,
+        "created_at": _iso(m.created_at),
+    }
+
+
+def order_payload(o) -> dict:
+    """OrderSQLAlchemy（user・order_items.menu をロード済み）→ schemas.Order 形の dict"""
+    u = o.user
+    return {
+        "serve_date": _date(o.serve_date),
+        "delivery_type": o.delivery_type.value if o.delivery_type else None,
+        "request_time": o.request_time,
+        "delivery_location": o.delivery_location,
+        "pickup_at": None,
+        "id": o.id,
+        "user_id": o.user_id,
+        "total_price": o.total_price,
+        "status": o.status.value if o.status else None,
+        "created_at": _iso(o.created_at),
+        "user": {
+            "name": u.name,
+            "email": u.email,
+            "seat_id": u.seat_id,
+            "id": u.id,
+            "created_at": _iso(u.created_at),
+        } if u is not None else None,
+        "order_items": [
+            {"menu_id": it.menu_id, "qty": it.qty, "id": it.id, "menu": _menu(it.menu)}
+            for it in o.order_items
+        ],
+        "order_id": o.order_id,
+        "department": o.department,
+        "customer_name": o.customer_name,
+        "delivered_at": _iso(o.delivered_at),
+        "note": o.note,
+    }
+
+
+def orders_payload(orders: Iterable) -> List[dict]:
+    return [order_payload(o) for o in orders]
+
+
+def order_delta(o) -> dict:
+    """管理画面の一覧に差し込む新規注文（order_created イベント用）。
+
+    order_payload と同じ形に、明細ごとの品名・単価（スナップショット、旧モデルはメニューの値）と
+    オプションを足したもの。OrderSQLAlchemy のほか schemas.Order（オプションなし）も受け付ける。
+    """
+    payload = order_payload(o)
+    for item, it in zip(payload["order_items"], o.order_items):
+        menu = it.menu
+        name = getattr(it, "name_snapshot", None)
+        unit_price = getattr(it, "unit_price_snapshot", None)
+        item["name"] = name if name is not None else (menu.title if menu is not None else None)
+        item["unit_price"] = unit_price if unit_price is not None else (menu.price if menu is not None else None)
+        item["options"] = [
+            {"option_id": opt.option_id, "name": opt.name_snapshot, "price_delta": opt.price_delta_snapshot}
+            for opt in getattr(it, "item_options", ())
+        ]
+    return payload
+
+
+def order_change(o) -> dict:
+    """状態・配達完了の変化分（status_updated / delivery_completed イベント用）"""
+    return {
+        "order_id": o.id,
+        "status": o.status.value if o.status else None,
+        "delivered_at": _iso(o.delivered_at),
+    }
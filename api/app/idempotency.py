@@ -0,0 +1,79 @@
+"""注文送信の Idempotency-Key（再送で二重注文しない）。
+
+POST /orders/guest・/v2/orders/guest で Idempotency-Key ヘッダが付いていれば、
+注文と同じトランザクション内で idempotency_keys に (scope, key) → レスポンス本文を保存する。
+同じキーの再送は注文・注文番号・在庫に一切触れず、保存済みレスポンスをそのまま返す。
+同時に届いた再送は主キー衝突で後から commit した方がロールバックされ、先に保存された
+レスポンスを返す。保存期間は IDEMPOTENCY_TTL_HOURS（既定24時間）。期限切れの行は注文の
+トランザクションでは消さず、定期ジョブ（purge_expired、main の scheduler から
+IDEMPOTENCY_PURGE_MINUTES ごと）でまとめて消す。
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from fastapi import HTTPException, Response
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+
+from . import models
+
+IDEMPOTENCY_TTL = timedelta(hours=float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+IDEMPOTENCY_PURGE_MINUTES = float(os.getenv("IDEMPOTENCY_PURGE_MINUTES", "60"))
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(body: BaseModel) -> str:
+    """同じキーで別内容の注文が送られてきたことを検出するためのリクエスト指紋"""
+    return hashlib.sha1(body.model_dump_json().encode()).hexdigest()
+
+
+def check_key(key: str) -> None:
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail={
+            "code": "invalid_idempotency_key", "message": "Idempotency-Key が不正です",
+        })
+
+
+def replay(db: Session, scope: str, key: str, request_hash: str) -> Optional[Response]:
+    """保存済みなら、そのレスポンスを返す（主キー1件読み）。無ければ None。"""
+    row = db.get(models.IdempotencyKey, (scope, key))
+    if row is None:
+        return None
+    expires_at = row.expires_at if row.expires_at.tzinfo else row.expires_at.replace(tzinfo=timezone.utc)
+    if expires_at <= datetime.now(timezone.utc):
+        return None
+    if row.request_hash != request_hash:
+        raise HTTPException(status_code=422, detail={
+            "code": "idempotency_key_reused", "message": "この Idempotency-Key は別の注文で使用済みです",
+        })
+    return Response(
+        content=row.response_body, status_code=row.status_code, media_type="application/json",
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+def recorder(db: Session, scope: str, key: str, request_hash: str, status_code: int = 200) -> Callable[[BaseModel], None]:
+    """注文作成の commit 直前に呼ぶ保存処理を返す（注文と同じトランザクションで書き込む）"""
+    def record(result: BaseModel) -> None:
+        now = datetime.now(timezone.utc)
+        # 同じキーの期限切れの行だけを主キーで消す（再利用できるように）。他の期限切れは purge_expired に任せる
+        db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.scope == scope, models.IdempotencyKey.key == key,
+            models.IdempotencyKey.expires_at <= now,
+        ).delete(synchronize_session=False)
+        db.add(models.IdempotencyKey(
+            scope=scope, key=key, request_hash=request_hash, status_code=status_code,
+            response_body=result.model_dump_json(), expires_at=now + IDEMPOTENCY_TTL,
+        ))
+    return record
+
+
+def purge_expired(db: Session) -> int:
+    """期限切れのキーをまとめて消す（expires_at の索引で範囲削除）。消した件数を返す"""
+    deleted = db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.expires_at <= datetime.now(timezone.utc)
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
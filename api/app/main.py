@@ -1,23 +1,59 @@
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, File, UploadFile, Form, Response, Request
+from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, File, UploadFile, Form, Header, Query, Response, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from anyio import from_thread
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from datetime import date, datetime, timedelta
+from contextlib import asynccontextmanager
 from typing import List, Optional
+import base64
 import json
 import os
 import uuid
 from pathlib import Path
 import logging
 
-from .database import get_db, engine, create_db_and_tables
+from .database import get_db, get_async_db, engine, create_db_and_tables, AsyncSessionLocal
 from .models import Base
-from . import crud, schemas, auth, models
+from . import crud, schemas, auth, models, menu_versions, idempotency, order_intake, order_export
+from .menu_cache import public_menu_cache
+from .realtime import manager, board_topic, order_topic, sse_events
+from .event_bus import event_bus
+from .stock_push import stock_publisher
+from .fast_json import FastJSONResponse, orders_payload, order_delta, order_change
 from .time_utils import validate_delivery_time
 
-app = FastAPI(title="Crowd Lunch API", version="1.0.0")
+# イベントはバス経由で全プロセスに届き、各プロセスが自分の WebSocket 接続へ配る
+event_bus.subscribe(manager.deliver)
+
+
+async def purge_idempotency_keys():
+    """期限切れの Idempotency-Key を消す定期ジョブ（注文のトランザクションから切り離すため）"""
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.run_sync(idempotency.purge_expired)
+    except Exception:
+        logging.exception("idempotency key purge failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await event_bus.start()
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(purge_idempotency_keys, "interval", minutes=idempotency.IDEMPOTENCY_PURGE_MINUTES)
+    scheduler.start()
+    yield
+    scheduler.shutdown(wait=False)
+    await stock_publisher.stop()
+    await event_bus.stop()
+
+
+app = FastAPI(title="Crowd Lunch API", version="1.0.0", lifespan=lifespan)
 
 app.router.redirect_slashes = False
 
@@ -45,7 +81,8 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,
     allow_origin_regex=ALLOW_ORIGIN_REGEX,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["authorization", "content-type", "accept"],
+    allow_headers=["authorization", "content-type", "accept", "idempotency-key"],
+    expose_headers=["x-next-cursor", "content-disposition", "x-order-token"],
     allow_credentials=False,
     max_age=600,
 )
@@ -71,26 +108,6 @@ app.mount("/media", StaticFiles(directory=str(MEDIA_DIR)), name="media")
 
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
-
-manager = ConnectionManager()
-
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
@@ -240,18 +257,18 @@ async def login_redirect(redirect_uri: str, state: str = None):
 
 
 @app.get("/weekly-menus", response_model=List[schemas.WeeklyMenuResponse])
-async def get_weekly_menus(db: Session = Depends(get_db)):
+async def get_weekly_menus(db: AsyncSession = Depends(get_async_db)):
     from datetime import timezone, timedelta as td
     jst = timezone(td(hours=9))
     today = datetime.now(jst).date()
     start_date = today - timedelta(days=1)  # Include yesterday to show 8/6
     end_date = today + timedelta(days=6)
     
-    menus = crud.get_weekly_menus(db, start_date, end_date)
+    menus = await db.run_sync(crud.get_weekly_menus, start_date, end_date)
     
     weekly_menus = {}
     for menu in menus:
-        serve_date = menu['serve_date']
+        serve_date = menu.serve_date
         if serve_date not in weekly_menus:
             weekly_menus[serve_date] = []
         weekly_menus[serve_date].append(menu)
@@ -266,31 +283,65 @@ async def get_weekly_menus(db: Session = Depends(get_db)):
     return result
 
 
+def _serialize_public_menu(m) -> dict:
+    return {
+        "id": m.id,
+        "serve_date": crud.to_jst_key(m.serve_date),
+        "title": m.title,
+        "price": m.price,
+        "max_qty": m.max_qty,
+        "img_url": m.img_url,
+        "cafe_time_available": m.cafe_time_available,
+        "created_at": m.created_at.isoformat() if m.created_at else None,
+    }
+
+
+def _cached_public_menus(db: Session, start: date, end: date, versions: menu_versions.Versions) -> dict:
+    """serve_date ごとの公開メニューをキャッシュから返し、欠けている日だけ1クエリでまとめて読む"""
+    result = {}
+    missing = []
+    d = start
+    while d <= end:
+        cached = public_menu_cache.get(d, versions.get(d, (0, None))[0])
+        if cached is None:
+            missing.append(d)
+        else:
+            result[d] = cached
+        d += timedelta(days=1)
+
+    if missing:
+        generations = {d: public_menu_cache.generation(d) for d in missing}
+        loaded = {d: [] for d in missing}
+        for m in crud.get_weekly_menus(db, missing[0], missing[-1]):
+            if m.serve_date in loaded:
+                loaded[m.serve_date].append(_serialize_public_menu(m))
+        for d, payload in loaded.items():
+            public_menu_cache.put(d, payload, generations[d], versions.get(d, (0, None))[0])
+            result[d] = payload
+    return result
+
+
 @app.get("/public/menus")
-async def get_public_menus_by_date(date: date = None, db: Session = Depends(get_db)):
+async def get_public_menus_by_date(request: Request, date: date = None, db: AsyncSession = Depends(get_async_db)):
     from fastapi.responses import JSONResponse
     
-    menus = crud.get_menus_sqlalchemy(db, date)
-    payload = []
-    for m in menus:
-        sd = getattr(m, "serve_date", None)
-        sd_key = sd.strftime("%Y-%m-%d") if sd else None
-        payload.append({
-            "id": m.id,
-            "serve_date": sd_key,
-            "title": m.title,
-            "price": m.price,
-            "max_qty": m.max_qty,
-            "img_url": m.img_url,
-            "cafe_time_available": m.cafe_time_available,
-            "created_at": m.created_at.isoformat() if m.created_at else None,
-        })
-    # 現在は no-store、将来は must-revalidate + ETag に移行予定
-    return JSONResponse(content=payload, headers={"Cache-Control": "no-store"})
+    if not date:
+        payload = [_serialize_public_menu(m) for m in await db.run_sync(crud.get_menus_sqlalchemy, None)]
+        return JSONResponse(content=payload, headers={"Cache-Control": "no-store"})
+
+    # 版数だけ読んで ETag を判定。一致すればメニュー本体は読まずに 304
+    versions = await db.run_sync(menu_versions.load, date, date)
+    etag, last_modified = menu_versions.stamp("public-menus", date, date, versions)
+    headers = menu_versions.validator_headers(etag, last_modified, "no-cache")
+    if menu_versions.is_not_modified(request, etag, last_modified):
+        return menu_versions.not_modified(headers)
+
+    payload = (await db.run_sync(_cached_public_menus, date, date, versions))[date]
+    return JSONResponse(content=payload, headers=headers)
 
 
 @app.get("/public/menus-range")
-async def get_public_menus_range(start: date, end: date, request: Request, db: Session = Depends(get_db)):
+async def get_public_menus_range(start: date, end: date, request: Request, db: AsyncSession = Depends(get_async_db)):
     from datetime import date, datetime, timedelta, timezone
     from fastapi.responses import JSONResponse
     import os
@@ -301,40 +352,25 @@ async def get_public_menus_range(start: date, end: date, request: Request, db: S
     if start > end:
         raise HTTPException(status_code=400, detail="Start date must be before or equal to end date")
 
-    menus = crud.get_weekly_menus(db, start, end)
-
-    days = {}
-    d = start
-    while d <= end:
-        days[d.strftime("%Y-%m-%d")] = []
-        d += timedelta(days=1)
-
-    def serialize_menu(m, sd_key):
-        return {
-            "id": getattr(m, "id", None) if hasattr(m, "id") else m.get("id"),
-            "serve_date": sd_key,
-            "title": getattr(m, "title", None) if hasattr(m, "title") else m.get("title"),
-            "price": getattr(m, "price", None) if hasattr(m, "price") else m.get("price"),
-            "max_qty": getattr(m, "max_qty", None) if hasattr(m, "max_qty") else m.get("max_qty"),
-            "img_url": getattr(m, "img_url", None) if hasattr(m, "img_url") else m.get("img_url"),
-            "cafe_time_available": getattr(m, "cafe_time_available", None) if hasattr(m, "cafe_time_available") else m.get("cafe_time_available"),
-            "created_at": (getattr(m, "created_at", None) if hasattr(m, "created_at") else m.get("created_at")).isoformat() if (getattr(m, "created_at", None) if hasattr(m, "created_at") else m.get("created_at")) else None,
-        }
-
-    for m in menus:
-        sd = getattr(m, "serve_date", None) if hasattr(m, "serve_date") else m.get("serve_date")
-        sd_key = crud.to_jst_key(sd)
-        if sd_key in days:           # ★範囲外は増やさない (important-comment)
-            days[sd_key].append(serialize_menu(m, sd_key))
-
     # Preview detection with fallback
     PREVIEW = os.getenv("APP_ENV") == "preview"
     if not PREVIEW:
         origin = request.headers.get("origin", "")
         PREVIEW = bool(re.match(r"^https://deploy-preview-\d+--(crowd-lunch|cheery-dango-2fd190)\.netlify\.app$", origin))
     
-    headers = {"Cache-Control": "no-store"} if PREVIEW else {"Cache-Control": "public, max-age=0, must-revalidate"}
-    # 現在は no-store/must-revalidate、将来は ETag + Last-Modified に移行予定
+    versions = await db.run_sync(menu_versions.load, start, end)
+    if PREVIEW:
+        headers = {"Cache-Control": "no-store"}
+    else:
+        etag, last_modified = menu_versions.stamp("public-menus-range", start, end, versions)
+        headers = menu_versions.validator_headers(etag, last_modified, "public, max-age=0, must-revalidate")
+        if menu_versions.is_not_modified(request, etag, last_modified):
+            return menu_versions.not_modified(headers)
+
+    days = {
+        d.strftime("%Y-%m-%d"): payload
+        for d, payload in sorted((await db.run_sync(_cached_public_menus, start, end, versions)).items())
+    }
 
     return JSONResponse(
         content={
@@ -344,8 +380,23 @@ async def get_public_menus_range(start: date, end: date, request: Request, db: S
         headers=headers,
     )
 
+@app.get("/admin/cache/public-menus")
+async def get_public_menu_cache_stats(admin: dict = Depends(auth.get_current_admin)):
+    """公開メニューキャッシュのヒット/ミス数"""
+    return public_menu_cache.stats()
+
+@app.get("/admin/realtime")
+async def get_realtime_stats(admin: dict = Depends(auth.get_current_admin)):
+    """WebSocket の接続数・送信待ち件数・切断した遅い端末の数、在庫通知の送信数"""
+    return {**manager.stats(), "stock_push": stock_publisher.stats()}
+
+@app.get("/admin/order-intake")
+async def get_order_intake_stats(admin: dict = Depends(auth.get_current_admin)):
+    """注文受付モード（グループコミット）の有効/無効と commit 数・注文数"""
+    return {"enabled": order_intake.enabled(), "committers": order_intake.stats()}
+
 @app.get("/menus", response_model=List[schemas.MenuSQLAlchemyResponse])
-async def get_menus_by_date(
+def get_menus_by_date(
     date: date = None,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db),
@@ -358,13 +409,22 @@ async def get_menus_by_date(
          description="Create a new order. **Authentication required**: Include Bearer token in Authorization header.")
 async def create_order(
     order: schemas.OrderCreate,
+    response: Response,
     current_user: schemas.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     import os
     from .logging import log_order_event
     from datetime import time
     
+    try:
+        menus = await db.run_sync(crud.load_order_menus, order.items)
+    except crud.UnknownMenuError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={"code": "menu_not_found", "message": "メニューが見つかりません", "menu_ids": e.menu_ids}
+        )
+    
     if os.getenv("TESTING") != "true":
         from .time_utils import get_jst_time, convert_to_pickup_at, validate_pickup_at
         current_jst = get_jst_time()
@@ -396,22 +456,31 @@ async def create_order(
         
         if pickup_at.hour >= 14:
             for item in order.items:
-                menu = crud.get_menu_by_id(db, item.menu_id)
-                if menu and not menu.cafe_time_available:
+                menu = menus[item.menu_id]
+                if not menu.cafe_time_available:
                     log_order_event("reject", code="menu_not_available", menu_id=item.menu_id, user_id=current_user.id, now=current_jst.isoformat())
                     raise HTTPException(
                         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                         detail={"code": "menu_not_available", "message": "このメニューはカフェタイムでは注文できません"}
                     )
     
-    db_order = crud.create_order(db, order, current_user.id)
+    try:
+        db_order = await db.run_sync(crud.create_order, order, current_user.id, menus)
+    except crud.OutOfStockError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"code": "sold_out", "message": "売り切れのため注文できません", "menu_id": e.menu_id}
+        )
     
-    await manager.broadcast(json.dumps({
+    await event_bus.emit([board_topic(order.serve_date)], {
         "type": "order_created",
         "order_id": db_order.id,
-        "user_id": current_user.id
-    }))
+        "user_id": current_user.id,
+        "order": order_delta(db_order)
+    })
+    stock_publisher.notify(order.serve_date)
     
+    auth.set_order_token_header(response, db_order.id)
     return db_order
 
 @app.post("/orders/guest", response_model=schemas.Order,
@@ -419,12 +488,36 @@ async def create_order(
          description="Create a guest order with department and name. No authentication required.")
 async def create_guest_order(
     order: schemas.OrderCreateWithDepartmentName,
-    db: Session = Depends(get_db)
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    db: AsyncSession = Depends(get_async_db)
 ):
     import os
     from .logging import log_order_event
     from datetime import time
     
+    # 同じ Idempotency-Key の再送は保存済みレスポンスを返す（注文・採番・在庫に触れない）
+    request_hash = None
+    if idempotency_key is not None:
+        idempotency.check_key(idempotency_key)
+        request_hash = idempotency.fingerprint(order)
+        replayed = await db.run_sync(idempotency.replay, "orders/guest", idempotency_key, request_hash)
+        if replayed is not None:
+            return _with_order_token(replayed)
+    
+    def recorder(session: Session):
+        if request_hash is None:
+            return None
+        return idempotency.recorder(session, "orders/guest", idempotency_key, request_hash)
+    
+    try:
+        menus = await db.run_sync(crud.load_order_menus, order.items)
+    except crud.UnknownMenuError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={"code": "menu_not_found", "message": "メニューが見つかりません", "menu_ids": e.menu_ids}
+        )
+    
     if os.getenv("TESTING") != "true":
         from .time_utils import get_jst_time, convert_to_pickup_at, validate_pickup_at
         current_jst = get_jst_time()
@@ -456,28 +549,60 @@ async def create_guest_order(
         
         if pickup_at.hour >= 14:
             for item in order.items:
-                menu = crud.get_menu_by_id(db, item.menu_id)
-                if menu and not menu.cafe_time_available:
+                menu = menus[item.menu_id]
+                if not menu.cafe_time_available:
                     log_order_event("reject", code="menu_not_available", menu_id=item.menu_id, department=order.department, name=order.name, now=current_jst.isoformat())
                     raise HTTPException(
                         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                         detail={"code": "menu_not_available", "message": "このメニューはカフェタイムでは注文できません"}
                     )
     
-    db_order = crud.create_guest_order(db, order)
-    
-    await manager.broadcast(json.dumps({
+    try:
+        if order_intake.enabled():
+            # 受付モード: 近い時刻の注文とまとめて1回の commit で書き込む（待つ間は接続を返しておく）
+            await db.rollback()
+            db_order = await order_intake.run_async(db, lambda session: crud.create_guest_order(
+                session, order, on_created=recorder(session), commit=False
+            ))
+        else:
+            db_order = await db.run_sync(
+                lambda session: crud.create_guest_order(session, order, menus, on_created=recorder(session))
+            )
+    except crud.OutOfStockError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"code": "sold_out", "message": "売り切れのため注文できません", "menu_id": e.menu_id}
+        )
+    except IntegrityError:
+        # 同じキーの同時再送が先に commit した。こちらの注文はロールバックして、そのレスポンスを返す
+        await db.rollback()
+        replayed = await db.run_sync(idempotency.replay, "orders/guest", idempotency_key, request_hash) if request_hash else None
+        if replayed is None:
+            raise
+        return _with_order_token(replayed)
+    
+    await event_bus.emit([board_topic(order.serve_date)], {
         "type": "order_created",
         "order_id": db_order.id,
-        "customer_name": f"{order.department}／{order.name}"
-    }))
+        "customer_name": f"{order.department}／{order.name}",
+        "order": order_delta(db_order)
+    })
+    stock_publisher.notify(order.serve_date)
     
+    auth.set_order_token_header(response, db_order.id)
     return db_order
 
+def _with_order_token(replayed: Response) -> Response:
+    """保存済みレスポンスの再送にも、その注文の購読トークンを付ける"""
+    auth.set_order_token_header(replayed, json.loads(replayed.body)["id"])
+    return replayed
+
+# 同期セッション（get_db）を使うルートは def にして、スレッドプールで動かす（イベントループを止めない）。
+# 配信・在庫通知は from_thread でイベントループ側に渡す
 @app.get("/orders/{order_id}", response_model=schemas.Order,
         summary="Get Order (Requires Bearer Token)",
         description="Retrieve a specific order by ID. **Authentication required**: Include Bearer token in Authorization header.")
-async def get_order(
+def get_order(
     order_id: int,
     current_user: schemas.User = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
@@ -492,7 +617,7 @@ async def get_order(
     return order
 
 @app.patch("/orders/{order_id}/status", response_model=schemas.Order)
-async def update_order_status(
+def update_order_status(
     order_id: int,
     status_update: schemas.OrderStatusUpdate,
     admin: dict = Depends(auth.get_current_admin),
@@ -503,16 +628,15 @@ async def update_order_status(
     if not order:
         raise HTTPException(status_code=404, detail="注文が見つかりません")
     
-    await manager.broadcast(json.dumps({
+    from_thread.run(event_bus.emit, [order_topic(order.id), board_topic(order.serve_date)], {
         "type": "status_updated",
-        "order_id": order.id,
-        "status": order.status.value
-    }))
+        **order_change(order)
+    })
     
     return order
 
 @app.patch("/admin/orders/{order_id}/delivery-completion", response_model=schemas.Order)
-async def toggle_delivery_completion(
+def toggle_delivery_completion(
     order_id: int,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
@@ -534,44 +658,125 @@ async def toggle_delivery_completion(
     db.commit()
     db.refresh(order)
     
-    await manager.broadcast(json.dumps({
+    from_thread.run(event_bus.emit, [order_topic(order.id), board_topic(order.serve_date)], {
         "type": "delivery_completed",
-        "order_id": order.id,
-        "delivered_at": order.delivered_at.isoformat() if order.delivered_at else None
-    }))
+        **order_change(order)
+    })
     
     return order
 
+ORDER_PAGE_MAX = 500
+ORDER_PAGE_DEFAULT = 200
+
+
+def _encode_order_cursor(order) -> str:
+    # created_at が NULL の旧データは空文字にする（一覧の末尾に並ぶ。crud.get_today_orders 参照）
+    created_at = order.created_at.isoformat() if order.created_at else ""
+    raw = f"{created_at}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_order_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, order_pk = raw.rsplit("|", 1)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(order_pk)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={"code": "invalid_cursor", "message": "cursor が不正です"}
+        )
+
+
+async def _list_orders(db: AsyncSession, serve_date: date, status_filter: Optional[str], filters: dict,
+                       cursor: Optional[str], limit: int) -> FastJSONResponse:
+    """日付の注文一覧。(created_at, id) のキーセットで limit 件ずつ（既定 ORDER_PAGE_DEFAULT）ページングし、
+    続きがあれば次ページの cursor を X-Next-Cursor で返す"""
+    after = _decode_order_cursor(cursor) if cursor else None
+
+    def load(session: Session):
+        orders = crud.get_today_orders(session, serve_date, status_filter, filters, after, limit + 1)
+        next_cursor = None
+        if len(orders) > limit:
+            orders = orders[:limit]
+            next_cursor = _encode_order_cursor(orders[-1])
+        return orders_payload(orders), next_cursor
+
+    # 一覧は検証済みの ORM から直接組み立てる（response_model の再検証を省く）
+    payload, next_cursor = await db.run_sync(load)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return FastJSONResponse(payload, headers=headers)
+
+
 @app.get("/admin/orders/today", response_model=List[schemas.Order])
 async def get_today_orders(
     date_filter: date = None,
+    status: Optional[str] = None,
+    delivery_type: Optional[models.DeliveryType] = None,
+    delivery_location: Optional[str] = None,
+    department: Optional[str] = None,
+    request_time: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(ORDER_PAGE_DEFAULT, ge=1, le=ORDER_PAGE_MAX),
     admin: dict = Depends(auth.get_current_admin),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     
     target_date = date_filter or date.today()
-    orders = crud.get_today_orders(db, target_date)
-    
-    
-    return orders
+    filters = {"delivery_type": delivery_type, "delivery_location": delivery_location,
+               "department": department, "request_time": request_time}
+    return await _list_orders(db, target_date, status, filters, cursor, limit)
 
 @app.get("/orders", response_model=List[schemas.Order],
         summary="Get Orders by Date (Requires Bearer Token)",
-        description="Retrieve orders for a specific date. **Authentication required**: Include Bearer token in Authorization header.")
+        description="Retrieve orders for a specific date. **Authentication required**: Include Bearer token in Authorization header. "
+                    "Results are paged by `limit` (default 200); the next page's `cursor` is returned in the `X-Next-Cursor` header.")
 async def get_orders_by_date(
     date: date,
     status: Optional[str] = None,
+    delivery_type: Optional[models.DeliveryType] = None,
+    delivery_location: Optional[str] = None,
+    department: Optional[str] = None,
+    request_time: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(ORDER_PAGE_DEFAULT, ge=1, le=ORDER_PAGE_MAX),
     admin: dict = Depends(auth.get_current_admin),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     
-    orders = crud.get_today_orders(db, date, status_filter=status)
-    
-    
-    return orders
+    filters = {"delivery_type": delivery_type, "delivery_location": delivery_location,
+               "department": department, "request_time": request_time}
+    return await _list_orders(db, date, status, filters, cursor, limit)
+
+EXPORT_MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+
+@app.get("/admin/orders/export",
+        summary="Export Orders (Requires Bearer Token)",
+        description="Stream orders served between `start` and `end` (inclusive) with item and option snapshots, as CSV (one row per item) or NDJSON (one order per line).")
+async def export_orders(
+    start: date,
+    end: date,
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    admin: dict = Depends(auth.get_current_admin),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if end < start:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={"code": "invalid_range", "message": "終了日は開始日以降を指定してください"}
+        )
+    # 送信中もこのセッションでカーソルを読み進め、送り終えたら order_export 側で閉じる
+    stream = order_export.stream_csv if export_format == "csv" else order_export.stream_ndjson
+    filename = f"orders_{start.isoformat()}_{end.isoformat()}.{export_format}"
+    return StreamingResponse(
+        stream(db, start, end),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 @app.get("/admin/menus", response_model=List[schemas.MenuResponse])
-async def get_menus(
+def get_menus(
     date_filter: date = None,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
@@ -581,7 +786,7 @@ async def get_menus(
     return menus
 
 @app.post("/admin/menus", response_model=schemas.MenuResponse)
-async def create_menu(
+def create_menu(
     menu: schemas.MenuCreate,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
@@ -591,7 +796,7 @@ async def create_menu(
     return db_menu
 
 @app.patch("/admin/menus/{menu_id}", response_model=schemas.MenuResponse)
-async def update_menu(
+def update_menu(
     menu_id: int,
     menu_update: schemas.MenuUpdate,
     admin: dict = Depends(auth.get_current_admin),
@@ -605,7 +810,7 @@ async def update_menu(
     return db_menu
 
 @app.delete("/admin/menus/{menu_id}")
-async def delete_menu(
+def delete_menu(
     menu_id: int,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
@@ -618,7 +823,7 @@ async def delete_menu(
     return {"message": "メニューが削除されました"}
 
 @app.post("/admin/menus/{menu_id}/items", response_model=schemas.MenuItemResponse)
-async def create_menu_item(
+def create_menu_item(
     menu_id: int,
     item: schemas.MenuItemCreate,
     admin: dict = Depends(auth.get_current_admin),
@@ -629,7 +834,7 @@ async def create_menu_item(
     return db_item
 
 @app.patch("/admin/menu-items/{item_id}", response_model=schemas.MenuItemResponse)
-async def update_menu_item(
+def update_menu_item(
     item_id: int,
     item_update: schemas.MenuItemUpdate,
     admin: dict = Depends(auth.get_current_admin),
@@ -643,7 +848,7 @@ async def update_menu_item(
     return db_item
 
 @app.delete("/admin/menu-items/{item_id}")
-async def delete_menu_item(
+def delete_menu_item(
     item_id: int,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
@@ -656,7 +861,7 @@ async def delete_menu_item(
     return {"message": "メニューアイテムが削除されました"}
 
 @app.post("/admin/fix-delivery-locations")
-async def fix_delivery_locations(
+def fix_delivery_locations(
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
 ):
@@ -693,7 +898,7 @@ async def fix_delivery_locations(
     response_model=schemas.MenuSQLAlchemyResponse,
     status_code=status.HTTP_201_CREATED
 )
-async def create_menu_by_date(
+def create_menu_by_date(
     serve_date: date = Form(...),
     title: str = Form(...),
     price: int = Form(...),
@@ -709,7 +914,7 @@ async def create_menu_by_date(
         if image.content_type not in allowed_types:
             raise HTTPException(status_code=400, detail="JPEG、PNG、WebP画像のみアップロード可能です")
         
-        content = await image.read()
+        content = image.file.read()
         if len(content) > 5 * 1024 * 1024:
             raise HTTPException(status_code=400, detail="画像ファイルサイズは5MB以下にしてください")
         
@@ -734,7 +939,7 @@ async def create_menu_by_date(
     return db_menu
 
 @app.put("/menus/{menu_id}", response_model=schemas.MenuSQLAlchemyResponse)
-async def update_menu_by_date(
+def update_menu_by_date(
     menu_id: int,
     title: str = Form(None),
     price: int = Form(None),
@@ -771,7 +976,7 @@ async def update_menu_by_date(
         if image.content_type not in allowed_types:
             raise HTTPException(status_code=400, detail="JPEG、PNG、WebP画像のみアップロード可能です")
         
-        content = await image.read()
+        content = image.file.read()
         if len(content) > 5 * 1024 * 1024:
             raise HTTPException(status_code=400, detail="画像ファイルサイズは5MB以下にしてください")
         
@@ -804,6 +1009,8 @@ async def update_menu_by_date(
             raise HTTPException(status_code=404, detail="メニューが見つかりません")
         
         logger.info(f"PUT /menus/{menu_id} - Success (200) - Updated menu: {db_menu.title}")
+        if max_qty is not None:
+            from_thread.run_sync(stock_publisher.notify, db_menu.serve_date)
         return db_menu
         
     except HTTPException as e:
@@ -814,7 +1021,7 @@ async def update_menu_by_date(
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
 @app.delete("/menus/{menu_id}")
-async def delete_menu_by_date(
+def delete_menu_by_date(
     menu_id: int,
     admin: dict = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
@@ -831,7 +1038,6 @@ async def upload_background_image(
     date: date,
     file: UploadFile = File(...),
     admin: dict = Depends(auth.get_current_admin),
-    db: Session = Depends(get_db)
 ):
     
     if not file.content_type.startswith("image/"):
@@ -853,12 +1059,87 @@ async def upload_background_image(
         "date": date
     }
 
+def _event_stream(request: Request, topics: List[str], token: Optional[str], last_event_id: Optional[str],
+                  rejected_message: str) -> StreamingResponse:
+    """WebSocket と同じ購読を SSE で返す。Last-Event-ID（= seq）があれば続きから再送する"""
+    connection = manager.open_stream()
+    accepted, rejected = manager.subscribe(connection.key, topics, token)
+    if rejected:
+        manager.disconnect(connection.key)
+        raise HTTPException(status_code=401, detail={"code": "invalid_token", "message": rejected_message})
+    manager.resume(connection.key, int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+    return StreamingResponse(
+        sse_events(connection, is_disconnected=request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/events/orders/{order_id}",
+        summary="Order Status Events (SSE)",
+        description="Server-Sent Events stream of status and delivery changes for one order. Requires the order token returned in the `X-Order-Token` header when the order was placed, passed as `token`. Resumes from the `Last-Event-ID` header.")
+async def order_events(
+    order_id: int,
+    request: Request,
+    token: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    if not auth.verify_order_token(order_id, token):
+        raise HTTPException(status_code=401, detail={"code": "invalid_token", "message": "注文トークンが必要です"})
+    return _event_stream(request, [order_topic(order_id)], token, last_event_id, "注文トークンが必要です")
+
+@app.post("/admin/events/board/token",
+         summary="Issue Board Stream Token (Admin)",
+         description="Issue a short-lived token that can only subscribe to one day's order board, for `GET /admin/events/board?token=`. **Authentication required**: Include Bearer token in Authorization header.")
+async def issue_board_stream_token(
+    date_filter: date = None,
+    admin: dict = Depends(auth.get_current_admin),
+):
+    target_date = date_filter or date.today()
+    return {"token": auth.create_stream_token(board_topic(target_date)), "expires_in": auth.STREAM_TOKEN_TTL_SECONDS}
+
+@app.get("/admin/events/board",
+        summary="Order Board Events (SSE, Admin)",
+        description="Server-Sent Events stream of the day's order board. Send the admin token in the Authorization header, or — since EventSource cannot send headers — pass a stream token from `POST /admin/events/board/token` as `token`. Admin tokens are not accepted in the URL.")
+async def board_events(
+    request: Request,
+    date_filter: date = None,
+    token: Optional[str] = None,
+    authorization: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    target_date = date_filter or date.today()
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    elif not auth.verify_stream_token(token, board_topic(target_date)):
+        # URL はアクセスログに残るため、管理者トークンは受け付けない（ストリームトークンのみ）
+        raise HTTPException(status_code=401, detail={"code": "invalid_token", "message": "ストリームトークンが必要です"})
+    return _event_stream(request, [board_topic(target_date)], token, last_event_id, "管理者トークンが必要です")
+
 @app.websocket("/ws/orders")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
             data = await websocket.receive_text()
-            await websocket.send_text(f"Message received: {data}")
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict) or message.get("type") not in ("subscribe", "unsubscribe"):
+                manager.send(websocket, f"Message received: {data}")
+                continue
+            topics = message.get("topics")
+            topics = topics if isinstance(topics, list) else []
+            if message["type"] == "subscribe":
+                accepted, rejected = manager.subscribe(websocket, topics, message.get("token"))
+                manager.send(websocket, json.dumps({
+                    "type": "subscribed", "topics": accepted, "rejected": rejected, "seq": manager.latest_seq,
+                }))
+                last_seq = message.get("last_seq")
+                manager.resume(websocket, last_seq if isinstance(last_seq, int) else None)
+            else:
+                manager.unsubscribe(websocket, topics)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
@@ -0,0 +1,102 @@
+"""旧 /public/menus・/public/menus-range 用のインプロセスキャッシュ。
+
+serve_date ごとにシリアライズ済みペイロード（dict の list）を保持する。
+メニューの作成/更新/削除など、その日の内容が変わる更新系から invalidate() で該当日だけを破棄する。
+ペイロードに残数は含まないので、注文では破棄しない（昼の注文集中時にもヒットし続けるように）。
+エントリには menu_versions の版数も記録し、他マシンでの更新は版数の不一致で検知する。
+TTL（PUBLIC_MENU_CACHE_TTL 秒, 既定30秒）は安全網。
+
+日付は匿名の GET から任意に指定できるため、保持する日数は PUBLIC_MENU_CACHE_MAX_DATES（既定60）までの
+LRU とし、put のたびに期限切れのエントリも捨てる。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import List, Optional, Tuple
+
+PUBLIC_MENU_CACHE_TTL = float(os.getenv("PUBLIC_MENU_CACHE_TTL", "30"))
+PUBLIC_MENU_CACHE_MAX_DATES = int(os.getenv("PUBLIC_MENU_CACHE_MAX_DATES", "60"))
+
+
+class PublicMenuCache:
+    def __init__(self, ttl: float = PUBLIC_MENU_CACHE_TTL, maxsize: int = PUBLIC_MENU_CACHE_MAX_DATES):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[date, Tuple[float, int, List[dict]]]" = OrderedDict()
+        # 読み込み中に invalidate された日の結果を書き戻さないための世代番号。
+        # invalidate のたびに全体で単調増加する値を振り、maxsize を超えたら古い日から捨てる。
+        # 捨てた日の世代は _floor（捨てた中の最大）とみなすので、読み込み中の古い結果は書き戻されない
+        self._generations: "OrderedDict[date, int]" = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def generation(self, serve_date: date) -> int:
+        with self._lock:
+            return self._generations.get(serve_date, self._floor)
+
+    def get(self, serve_date: date, version: int = 0) -> Optional[List[dict]]:
+        with self._lock:
+            entry = self._entries.get(serve_date)
+            if entry and entry[1] == version and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(serve_date)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, serve_date: date, payload: List[dict], generation: int, version: int = 0) -> None:
+        with self._lock:
+            if self._generations.get(serve_date, self._floor) != generation:
+                return
+            now = time.monotonic()
+            for d in [d for d, entry in self._entries.items() if now - entry[0] >= self.ttl]:
+                del self._entries[d]
+            self._entries[serve_date] = (now, version, payload)
+            self._entries.move_to_end(serve_date)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _bump(self, serve_date: date) -> None:
+        self._clock += 1
+        self._generations[serve_date] = self._clock
+        self._generations.move_to_end(serve_date)
+        while len(self._generations) > self.maxsize:
+            _, evicted = self._generations.popitem(last=False)
+            self._floor = max(self._floor, evicted)
+
+    def invalidate(self, *serve_dates: Optional[date]) -> None:
+        with self._lock:
+            for serve_date in serve_dates:
+                if serve_date is None:
+                    continue
+                self._entries.pop(serve_date, None)
+                self._bump(serve_date)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            for serve_date in list(self._entries):
+                self._bump(serve_date)
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "ttl_seconds": self.ttl,
+                "max_dates": self.maxsize,
+            }
+
+
+public_menu_cache = PublicMenuCache()
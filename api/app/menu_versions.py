@@ -0,0 +1,129 @@
+"""メニュー系GETの条件付きリクエスト（ETag + Last-Modified）。
+
+menu_versions テーブルに serve_date ごとの版数を持ち、menus / daily_menus /
+products / option_groups / options / day_settings を更新するトランザクション内で
+bump() する。GET 側は版数だけを読んで ETag を組み立て、If-None-Match /
+If-Modified-Since が一致すればメニュー本体のクエリもシリアライズもせず 304 を返す。
+複数マシンでも同じDBの版数を見るため整合する。
+"""
+import hashlib
+from datetime import date, datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import dialect_insert
+from .time_utils import get_jst_time
+
+Versions = Dict[date, Tuple[int, datetime]]
+
+
+def bump(db: Session, *serve_dates: Optional[date]) -> None:
+    """指定日の版数を +1（無ければ作成）。呼び出し側のトランザクションで commit される。"""
+    dates = sorted({d for d in serve_dates if d is not None})  # ロック順を固定してデッドロック回避
+    if not dates:
+        return
+    now = datetime.now(timezone.utc)
+    insert = dialect_insert(db)
+    stmt = insert(models.MenuVersion).values(
+        [{"serve_date": d, "version": 1, "updated_at": now} for d in dates]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.MenuVersion.serve_date],
+        set_={"version": models.MenuVersion.version + 1, "updated_at": now},
+    )
+    db.execute(stmt)
+
+
+def lock(db: Session, serve_dates: Iterable[date]) -> Dict[date, int]:
+    """指定日の版数行をロックして現在の版数を返す（無ければ 0 で作成）。
+
+    同じ日を bump する更新が進行中なら、その commit を待ってから新しい版数を返す。
+    ロックは呼び出し側のトランザクションの終わりまで保持される。
+    """
+    dates = sorted(set(serve_dates))  # bump と同じロック順
+    if not dates:
+        return {}
+    insert = dialect_insert(db)
+    stmt = insert(models.MenuVersion).values(
+        [{"serve_date": d, "version": 0, "updated_at": datetime.now(timezone.utc)} for d in dates]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.MenuVersion.serve_date],
+        set_={"version": models.MenuVersion.version},
+    ).returning(models.MenuVersion.serve_date, models.MenuVersion.version)
+    return {row.serve_date: row.version for row in db.execute(stmt)}
+
+
+def dates_for_products(db: Session, product_ids: Iterable[Optional[int]], since: Optional[date] = None) -> List[date]:
+    """商品/オプションの変更が影響する日付（その商品を提供する since 以降の日付。既定は JST の今日）。
+
+    過去の日付は注文を受けないため版数もスナップショットも更新しない（編集のたびに全履歴を再構築しない）。
+    """
+    ids = {pid for pid in product_ids if pid is not None}
+    if not ids:
+        return []
+    if since is None:
+        since = get_jst_time().date()
+    rows = (
+        db.query(models.DailyMenu.serve_date)
+        .filter(models.DailyMenu.product_id.in_(ids), models.DailyMenu.serve_date >= since)
+        .distinct()
+        .all()
+    )
+    return [r.serve_date for r in rows]
+
+
+def load(db: Session, start: date, end: date) -> Versions:
+    rows = (
+        db.query(models.MenuVersion)
+        .filter(models.MenuVersion.serve_date >= start, models.MenuVersion.serve_date <= end)
+        .all()
+    )
+    return {r.serve_date: (r.version, r.updated_at) for r in rows}
+
+
+def stamp(scope: str, start: date, end: date, versions: Versions) -> Tuple[str, Optional[datetime]]:
+    """(ETag, Last-Modified) を返す。scope はエンドポイントごとにペイロード形状が違うため含める。"""
+    parts = [scope, start.isoformat(), end.isoformat()]
+    parts += [f"{d.isoformat()}:{v}" for d, (v, _) in sorted(versions.items())]
+    etag = 'W/"%s"' % hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+    last_modified = None
+    for _, updated_at in versions.values():
+        if updated_at.tzinfo is None:  # SQLite は tz を落とす（保存値は UTC）
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        if last_modified is None or updated_at > last_modified:
+            last_modified = updated_at
+    return etag, last_modified
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match があれば If-Modified-Since は無視（RFC 9110）。比較は弱い比較
+        candidates = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in candidates or etag.removeprefix("W/") in candidates
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return int(last_modified.timestamp()) <= int(since.timestamp())
+    return False
+
+
+def validator_headers(etag: str, last_modified: Optional[datetime], cache_control: str) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+def not_modified(headers: Dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
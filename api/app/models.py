@@ -3,7 +3,7 @@ from typing import Optional
 from datetime import date, datetime, time
 import enum
 
-from sqlalchemy import Column, Integer, String, Text, Date, Time, DateTime, ForeignKey, Enum, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Text, Date, Time, DateTime, ForeignKey, Enum, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -36,6 +36,7 @@ class MenuSQLAlchemy(Base):
     title = Column(String, nullable=False)
     price = Column(Integer, nullable=False)
     max_qty = Column(Integer, nullable=False)
+    sold_qty = Column(Integer, nullable=False, default=0, server_default="0")  # reserve_menu_stock で加算
     img_url = Column(String)
     cafe_time_available = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
@@ -63,11 +64,21 @@ class OrderSQLAlchemy(Base):
     user = relationship("User")
     order_items = relationship("OrderItem", back_populates="order")
 
+    # 管理画面の注文一覧: 日付内を (created_at, id) のキーセットでページングし、各絞り込みも索引で引く
+    __table_args__ = (
+        Index("ix_orders_serve_date_created_at_id", "serve_date", "created_at", "id"),
+        Index("ix_orders_serve_date_status_created_at", "serve_date", "status", "created_at", "id"),
+        Index("ix_orders_serve_date_delivery_type_created_at", "serve_date", "delivery_type", "created_at", "id"),
+        Index("ix_orders_serve_date_delivery_location_created_at", "serve_date", "delivery_location", "created_at", "id"),
+        Index("ix_orders_serve_date_department_created_at", "serve_date", "department", "created_at", "id"),
+        Index("ix_orders_serve_date_request_time_created_at", "serve_date", "request_time", "created_at", "id"),
+    )
+
 class OrderItem(Base):
     __tablename__ = "order_items"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True)
     menu_id = Column(Integer, ForeignKey("menus.id"), nullable=True)  # 旧モデル用（v2はNULL）
     qty = Column(Integer, nullable=False)
     # Phase 3: 新モデル対応（追加カラム・すべてnullableで後方互換）
@@ -128,7 +139,10 @@ class Product(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     category = relationship("Category", back_populates="products")
-    option_groups = relationship("OptionGroup", back_populates="product")
+    option_groups = relationship(
+        "OptionGroup", back_populates="product",
+        order_by=lambda: (OptionGroup.sort_order, OptionGroup.id),
+    )
 
 
 class OptionGroup(Base):
@@ -144,7 +158,7 @@ class OptionGroup(Base):
     sort_order = Column(Integer, nullable=False, default=0)
 
     product = relationship("Product", back_populates="option_groups")
-    options = relationship("Option", back_populates="group")
+    options = relationship("Option", back_populates="group", order_by=lambda: (Option.sort_order, Option.id))
 
 
 class Option(Base):
@@ -171,6 +185,7 @@ class DailyMenu(Base):
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     price_override = Column(Integer, nullable=True)
     max_qty = Column(Integer, nullable=False, default=30)
+    sold_qty = Column(Integer, nullable=False, default=0, server_default="0")  # 注文作成時に条件付きUPDATEで加算
     sort_order = Column(Integer, nullable=False, default=0)
     is_available = Column(Boolean, nullable=False, default=True)
     available_from = Column(Time, nullable=True)
@@ -206,6 +221,47 @@ class DaySetting(Base):
     hero_image = relationship("MediaAsset")
 
 
+class MenuSnapshot(Base):
+    """日付ごとの公開メニュー（/v2/menus）の確定済みJSON。カタログ更新時に同じトランザクションで再構築する。"""
+    __tablename__ = "menu_snapshots"
+
+    serve_date = Column(Date, primary_key=True)
+    # PublicMenuItem（有効価格・オプション解決済み）の JSON を remaining_qty の値の直前まで品目ごとに連結したもの
+    payload = Column(Text, nullable=False)
+    item_index = Column(Text, nullable=False, default="")  # 品目ごとの "daily_menu_id:payload 内の文字数"
+    etag = Column(String, nullable=False)
+    built_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class MenuVersion(Base):
+    """日付ごとのメニュー版数（ETag/Last-Modified 用）。menus/daily_menus/products/options/day_settings の更新で +1。"""
+    __tablename__ = "menu_versions"
+
+    serve_date = Column(Date, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class OrderCounter(Base):
+    """日付ごとの注文番号カウンタ（#MMDD001 の連番）。UPSERT で +1（Postgres は注文とは別の短いトランザクション）。"""
+    __tablename__ = "order_counters"
+
+    serve_date = Column(Date, primary_key=True)
+    last_number = Column(Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(Base):
+    """注文送信の Idempotency-Key と、その時返したレスポンス（期限付き）"""
+    __tablename__ = "idempotency_keys"
+
+    scope = Column(String, primary_key=True)  # 例: "orders/guest"
+    key = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(Text, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
 class MenuTemplate(Base):
     """献立テンプレ（サーバ保存）。weekday=0..6 で曜日デフォルト、NULL で任意名テンプレ。"""
     __tablename__ = "menu_templates"
@@ -0,0 +1,157 @@
+"""注文の期間エクスポート（CSV / NDJSON）をストリーミングで返す。
+
+orders ⟕ order_items ⟕ order_item_options を1本の SELECT で (serve_date, created_at, id) 順に読み、
+サーバーサイドカーソル（yield_per）で EXPORT_BATCH 行ずつ受け取りながら注文単位にまとめて書き出す。
+保持するのは処理中の1注文と送信前のバッファだけなので、期間内の注文数によらずメモリ使用量は一定。
+
+- CSV: 注文明細1行（オプションは「名前(+差額)」を "; " 区切りで1列）。Excel 向けに BOM 付き UTF-8。
+  = + - @ タブ CR で始まるセルは先頭に ' を付け、Excel に数式として解釈させない（氏名・部署などは
+  お客様の入力そのままのため）
+- NDJSON: 注文1行。items・options をネストしたオブジェクト
+
+品名・単価は注文時点のスナップショット（旧モデルの明細はスナップショットが無いため menus の値）。
+"""
+import csv
+import io
+import os
+from datetime import date
+from typing import AsyncIterator, Iterable, List, Optional
+
+from sqlalchemy import Select, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .fast_json import dumps
+
+EXPORT_BATCH = int(os.getenv("ORDER_EXPORT_BATCH", "500"))
+
+Order = models.OrderSQLAlchemy
+Item = models.OrderItem
+ItemOption = models.OrderItemOption
+
+CSV_COLUMNS = [
+    "id", "order_id", "serve_date", "created_at", "status", "delivery_type", "request_time",
+    "delivery_location", "department", "customer_name", "total_price", "delivered_at", "note",
+    "item_id", "menu_id", "daily_menu_id", "product_id", "item_name", "unit_price", "qty", "options",
+]
+ORDER_FIELDS = CSV_COLUMNS[:13]
+
+
+def export_statement(start: date, end: date) -> Select:
+    return (
+        select(
+            Order.id, Order.order_id, Order.serve_date, Order.created_at, Order.status, Order.delivery_type,
+            Order.request_time, Order.delivery_location, Order.department, Order.customer_name,
+            Order.total_price, Order.delivered_at, Order.note,
+            Item.id.label("item_id"), Item.menu_id, Item.daily_menu_id, Item.product_id, Item.qty,
+            func.coalesce(Item.name_snapshot, models.MenuSQLAlchemy.title).label("item_name"),
+            func.coalesce(Item.unit_price_snapshot, models.MenuSQLAlchemy.price).label("unit_price"),
+            ItemOption.id.label("option_row_id"), ItemOption.option_id,
+            ItemOption.name_snapshot.label("option_name"), ItemOption.price_delta_snapshot.label("price_delta"),
+        )
+        .select_from(Order)
+        .outerjoin(Item, Item.order_id == Order.id)
+        .outerjoin(models.MenuSQLAlchemy, models.MenuSQLAlchemy.id == Item.menu_id)
+        .outerjoin(ItemOption, ItemOption.order_item_id == Item.id)
+        .where(Order.serve_date >= start, Order.serve_date <= end)
+        .order_by(Order.serve_date, Order.created_at, Order.id, Item.id, ItemOption.id)
+        .execution_options(yield_per=EXPORT_BATCH)
+    )
+
+
+def _value(v):
+    if v is None:
+        return None
+    if hasattr(v, "value"):  # Enum
+        return v.value
+    if hasattr(v, "isoformat"):
+        return v.isoformat()
+    return v
+
+
+async def _orders(db: AsyncSession, start: date, end: date) -> AsyncIterator[dict]:
+    """結合行を注文ごとの dict（items → options をネスト）にまとめて順に返す"""
+    result = await db.stream(export_statement(start, end))
+    order: Optional[dict] = None
+    item: Optional[dict] = None
+    try:
+        async for row in result:
+            if order is None or order["id"] != row.id:
+                if order is not None:
+                    yield order
+                order = {field: _value(getattr(row, field)) for field in ORDER_FIELDS}
+                order["items"] = []
+                item = None
+            if row.item_id is None:
+                continue
+            if item is None or item["id"] != row.item_id:
+                item = {
+                    "id": row.item_id, "menu_id": row.menu_id, "daily_menu_id": row.daily_menu_id,
+                    "product_id": row.product_id, "name": row.item_name, "unit_price": row.unit_price,
+                    "qty": row.qty, "options": [],
+                }
+                order["items"].append(item)
+            if row.option_row_id is not None:
+                item["options"].append({
+                    "option_id": row.option_id, "name": row.option_name, "price_delta": row.price_delta,
+                })
+        if order is not None:
+            yield order
+    finally:
+        await result.close()
+
+
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_cell(v):
+    """CSV インジェクション対策。数式として解釈されうる文字列セルを ' で無効化する"""
+    if isinstance(v, str) and v.startswith(FORMULA_PREFIXES):
+        return "'" + v
+    return v
+
+
+def _csv_rows(order: dict) -> Iterable[List]:
+    head = [order[field] for field in ORDER_FIELDS]
+    if not order["items"]:
+        yield head + [None] * (len(CSV_COLUMNS) - len(head))
+    for item in order["items"]:
+        options = "; ".join(f"{o['name']}({o['price_delta']:+d})" for o in item["options"])
+        yield head + [
+            item["id"], item["menu_id"], item["daily_menu_id"], item["product_id"],
+            item["name"], item["unit_price"], item["qty"], options,
+        ]
+
+
+async def stream_csv(db: AsyncSession, start: date, end: date) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    pending = 0
+    try:
+        async for order in _orders(db, start, end):
+            writer.writerows([_csv_cell(v) for v in row] for row in _csv_rows(order))
+            pending += 1
+            if pending >= EXPORT_BATCH:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        yield buffer.getvalue().encode("utf-8")
+    finally:
+        await db.close()
+
+
+async def stream_ndjson(db: AsyncSession, start: date, end: date) -> AsyncIterator[bytes]:
+    chunk: List[bytes] = []
+    try:
+        async for order in _orders(db, start, end):
+            chunk.append(dumps(order))
+            if len(chunk) >= EXPORT_BATCH:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
+    finally:
+        await db.close()
@@ -0,0 +1,154 @@
+"""昼のピーク向けの注文受付モード（グループコミット）。
+
+ORDER_GROUP_COMMIT=1 のとき、/orders/guest・/v2/orders/guest の書き込みは専用スレッドに渡し、
+数ミリ秒（ORDER_GROUP_COMMIT_WINDOW_MS, 既定5ms）以内に届いた注文を最大
+ORDER_GROUP_COMMIT_MAX 件（既定32）まとめて1トランザクション・1 commit で書き込む。
+注文ごとに SAVEPOINT を切るため、在庫切れなどで失敗した注文だけがロールバックされ、
+結果（成功／例外）は注文ごとに呼び出し側へ返る。無効時は従来どおり注文ごとに commit する。
+
+計測: stats() の commits / orders、scripts/bench_group_commit.py。
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple, TypeVar, Union
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from . import database
+from .user_cache import pending_snapshot, restore_pending
+
+ENABLED = os.getenv("ORDER_GROUP_COMMIT") == "1"
+WINDOW = float(os.getenv("ORDER_GROUP_COMMIT_WINDOW_MS", "5")) / 1000
+MAX_BATCH = int(os.getenv("ORDER_GROUP_COMMIT_MAX", "32"))
+
+T = TypeVar("T")
+Work = Callable[[Session], T]
+
+
+class GroupCommitter:
+    def __init__(self, bind, window: float = WINDOW, max_batch: int = MAX_BATCH):
+        self.bind = bind
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Tuple[Work, Future]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="order-group-commit", daemon=True)
+        self._thread.start()
+        self.commits = 0
+        self.orders = 0
+        self.largest_batch = 0
+
+    def submit(self, work: Work) -> Future:
+        future: Future = Future()
+        self._queue.put((work, future))
+        return future
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch: List[Tuple[Work, Future]]) -> None:
+        db = Session(bind=self.bind, autoflush=False)
+        outcomes = []
+        try:
+            if self.bind.dialect.name == "sqlite":
+                # pysqlite は SAVEPOINT の前に BEGIN を出さないため、明示的に開始する
+                db.connection().exec_driver_sql("BEGIN")
+            for work, future in batch:
+                snapshot = pending_snapshot(db)
+                savepoint = db.begin_nested()
+                try:
+                    result = work(db)
+                    savepoint.commit()
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    savepoint.rollback()
+                    restore_pending(db, snapshot)
+                    outcomes.append((future, None, e))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            db.close()
+        self.commits += 1
+        self.orders += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "commits": self.commits,
+            "orders": self.orders,
+            "largest_batch": self.largest_batch,
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+        }
+
+
+_committers: Dict[object, GroupCommitter] = {}
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return ENABLED
+
+
+def committer_for(db: Union[Session, AsyncSession]) -> GroupCommitter:
+    """リクエストのセッションと同じ接続先に書き込む committer（接続先ごとに1つ）"""
+    bind = db.get_bind()
+    with _lock:
+        if bind not in _committers:
+            _committers[bind] = GroupCommitter(_sync_bind(bind))
+        return _committers[bind]
+
+
+def _sync_bind(bind: Engine) -> Engine:
+    """AsyncSession の接続先は専用スレッドから使えないため、同じ URL の同期エンジンに置き換える"""
+    if not bind.dialect.is_async:
+        return bind
+    if bind is database.async_engine.sync_engine:
+        return database.engine
+    url = bind.url
+    if url.get_backend_name() == "sqlite":
+        return create_engine(
+            url.set(drivername="sqlite"), connect_args={"check_same_thread": False, "timeout": 30}
+        )
+    # postgresql+psycopg は create_engine で同期ドライバになる
+    return create_engine(url, pool_pre_ping=True, connect_args={"prepare_threshold": None})
+
+
+def run(db: Union[Session, AsyncSession], work: Work) -> T:
+    """work(session) を次のバッチで実行し、commit 後に結果を返す（例外はそのまま送出）"""
+    return committer_for(db).submit(work).result()
+
+
+async def run_async(db: Union[Session, AsyncSession], work: Work) -> T:
+    return await asyncio.wrap_future(committer_for(db).submit(work))
+
+
+def stats() -> List[dict]:
+    with _lock:
+        return [c.stats() for c in _committers.values()]
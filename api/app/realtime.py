@@ -0,0 +1,348 @@
+"""/ws/orders の WebSocket 配信。
+
+端末は購読するトピックを送り、そのトピックへの publish だけを受け取る。
+
+- order:{id}         … 1件の注文の状態変化（ConfirmPage。注文 ID は連番なので、注文作成時に
+                       X-Order-Token ヘッダで返す注文トークンか管理者トークンが必要）
+- board:{serve_date} … その日の注文一覧の変化（管理画面。管理者トークンか、そのボード用の
+                       短命なストリームトークン（auth.create_stream_token）が必要）。
+                       新規注文は明細・オプション付きの注文、状態変化は status・delivered_at を載せる
+- stock:{serve_date} … その日のメニューの在庫変化（全ワーカーからの分をまとめ、端末へは
+                       STOCK_PUSH_INTERVAL_SECONDS（既定1秒）に1回、最新の1件だけを送る）
+
+    → {"type": "subscribe", "topics": ["order:12"], "token": "<注文トークン・管理者トークン>", "last_seq": 41}
+    ← {"type": "subscribed", "topics": ["order:12"], "rejected": [], "seq": 45}
+    → {"type": "unsubscribe", "topics": ["order:12"]}
+
+イベントには通し番号 seq が付き（event_bus 参照）、直近 REPLAY_BUFFER_SIZE 件（既定1000）を
+リングバッファに残す。再接続時に last_seq を送ると、それ以降の購読トピックのイベントを順に再送する。
+バッファから既に消えた・このプロセスの起動前の範囲なら {"type": "resync_required", "seq": 45} を返すので、
+端末は一覧を取り直す。
+
+接続ごとに上限付きの送信キュー（WS_SEND_QUEUE_SIZE, 既定100件）と、それを送り出す専用タスクを持つ。
+publish() / broadcast() はキューに積むだけで送信を待たないため、遅い端末が他の管理画面の配信を遅らせない。
+キューが溢れた接続（受信が追いつかない端末）と、送信に失敗・WS_SEND_TIMEOUT_SECONDS（既定5秒）
+以上かかった接続は切断して一覧から外す。端末側は再接続すればよい。
+
+WebSocket がつながらない端末向けに、同じ購読を Server-Sent Events でも受けられる（sse_events）。
+イベントの id は seq で、ブラウザが再接続時に送る Last-Event-ID から続きを再送する。
+無通信が続くとプロキシに切られるため、SSE_KEEPALIVE_SECONDS（既定15秒）ごとにコメント行を送る。
+クライアントの切断は SSE_DISCONNECT_POLL_SECONDS（既定1秒）ごとに確認し、キープアライブを待たずに購読を外す。
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import date
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, WebSocket
+from fastapi.security import HTTPAuthorizationCredentials
+
+from . import auth
+
+logger = logging.getLogger(__name__)
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "5"))
+REPLAY_BUFFER_SIZE = int(os.getenv("REPLAY_BUFFER_SIZE", "1000"))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_DISCONNECT_POLL = float(os.getenv("SSE_DISCONNECT_POLL_SECONDS", "1"))
+SSE_RETRY_MS = 3000
+# stock:{date} の配信間隔（stock_push と共通）
+STOCK_PUSH_INTERVAL = float(os.getenv("STOCK_PUSH_INTERVAL_SECONDS", "1"))
+
+# 受信が追いつかない端末を切るときのクローズコード（1013: Try Again Later）
+CLOSE_SLOW_CONSUMER = 1013
+
+MAX_TOPICS_PER_CONNECTION = 50
+ADMIN_TOPIC_PREFIXES = ("board:",)
+# 毎回その時点の全量を載せるトピック。端末へは最新の1件だけを間隔を空けて送ればよい
+COALESCED_TOPIC_PREFIXES = ("stock:",)
+ORDER_TOPIC_PREFIX = "order:"
+
+
+def order_topic(order_id: int) -> str:
+    return f"order:{order_id}"
+
+
+def board_topic(serve_date: date) -> str:
+    return f"board:{serve_date.isoformat()}"
+
+
+def stock_topic(serve_date: date) -> str:
+    return f"stock:{serve_date.isoformat()}"
+
+
+def _topic_token_ok(topic: str, token: Optional[str]) -> bool:
+    """管理者以外の購読: order:{id} は注文トークン、board:{date} はそのボード用のストリームトークン"""
+    if topic.startswith(ORDER_TOPIC_PREFIX):
+        order_id = topic[len(ORDER_TOPIC_PREFIX):]
+        return order_id.isdigit() and auth.verify_order_token(int(order_id), token)
+    return auth.verify_stream_token(token, topic)
+
+
+def is_admin_token(token: Optional[str]) -> bool:
+    if not token:
+        return False
+    try:
+        auth.get_current_admin(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token))
+    except HTTPException:
+        return False
+    return True
+
+
+class Connection:
+    """配信先1つ分。WebSocket は writer タスクが、SSE はレスポンスの生成側がキューを読む"""
+
+    def __init__(self, websocket: Optional[WebSocket], queue_size: int):
+        self.websocket = websocket
+        self.queue: "asyncio.Queue[str]" = asyncio.Queue(queue_size)
+        self.task: Optional[asyncio.Task] = None
+        self.topics: Set[str] = set()
+        self.closed = asyncio.Event()
+
+    @property
+    def key(self) -> Hashable:
+        """ConnectionManager での登録キー（WebSocket 自身、SSE は Connection 自身）"""
+        return self.websocket if self.websocket is not None else self
+
+
+class ConnectionManager:
+    def __init__(self, queue_size: int = WS_SEND_QUEUE_SIZE, send_timeout: float = WS_SEND_TIMEOUT,
+                 replay_size: int = REPLAY_BUFFER_SIZE, coalesce_interval: float = STOCK_PUSH_INTERVAL):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.coalesce_interval = coalesce_interval
+        self._coalesced: Dict[str, str] = {}
+        self._coalesce_tasks: Dict[str, asyncio.Task] = {}
+        self._coalesce_sent: Dict[str, float] = {}
+        self.active_connections: Dict[Hashable, Connection] = {}
+        self.subscribers: Dict[str, Set[Connection]] = {}
+        self.dropped = 0
+        self.latest_seq = 0
+        self._replay: "deque[Tuple[int, Tuple[str, ...], str]]" = deque(maxlen=replay_size)
+
+    async def connect(self, websocket: WebSocket) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, self.queue_size)
+        connection.task = asyncio.create_task(self._writer(connection))
+        self.active_connections[websocket] = connection
+        return connection
+
+    def open_stream(self) -> Connection:
+        """SSE 用の配信先を登録する（送信はレスポンス側が connection.queue を読む）"""
+        connection = Connection(None, self.queue_size)
+        self.active_connections[connection.key] = connection
+        return connection
+
+    def disconnect(self, websocket: Hashable) -> None:
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        self._remove_topics(connection, list(connection.topics))
+        connection.closed.set()
+        if connection.task is not None and connection.task is not asyncio.current_task():
+            connection.task.cancel()
+
+    def subscribe(self, websocket: Hashable, topics: Iterable[str], token: Optional[str] = None) -> Tuple[List[str], List[str]]:
+        """購読を追加し、(受け付けたトピック, 拒否したトピック) を返す"""
+        connection = self.active_connections.get(websocket)
+        accepted: List[str] = []
+        rejected: List[str] = []
+        admin: Optional[bool] = None
+        for topic in topics:
+            if not isinstance(topic, str) or connection is None:
+                rejected.append(topic)
+                continue
+            if topic.startswith(ADMIN_TOPIC_PREFIXES) or topic.startswith(ORDER_TOPIC_PREFIX):
+                if admin is None:
+                    admin = is_admin_token(token)
+                if not admin and not _topic_token_ok(topic, token):
+                    rejected.append(topic)
+                    continue
+            if topic not in connection.topics and len(connection.topics) >= MAX_TOPICS_PER_CONNECTION:
+                rejected.append(topic)
+                continue
+            connection.topics.add(topic)
+            self.subscribers.setdefault(topic, set()).add(connection)
+            accepted.append(topic)
+        return accepted, rejected
+
+    def unsubscribe(self, websocket: Hashable, topics: Iterable[str]) -> None:
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self._remove_topics(connection, [t for t in topics if t in connection.topics])
+
+    def _remove_topics(self, connection: Connection, topics: List[str]) -> None:
+        for topic in topics:
+            connection.topics.discard(topic)
+            subscribers = self.subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.subscribers[topic]
+
+    def send(self, websocket: Hashable, message: str) -> None:
+        """1接続にだけ送る（送信は writer タスクが行う）"""
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, message)
+
+    async def broadcast(self, message: str) -> None:
+        """全接続に送る（購読に関係なく）"""
+        for connection in list(self.active_connections.values()):
+            self._enqueue(connection, message)
+
+    async def publish(self, topics: Iterable[str], message: str) -> None:
+        """いずれかのトピックを購読している接続にだけ送る（複数一致しても1回）"""
+        targets: Set[Connection] = set()
+        for topic in topics:
+            targets.update(self.subscribers.get(topic, ()))
+        for connection in targets:
+            self._enqueue(connection, message)
+
+    async def deliver(self, seq: int, topics: List[str], message: str) -> None:
+        """イベントバスから受け取ったイベントを再送用に残してから配る"""
+        self._replay.append((seq, tuple(topics), message))
+        self.latest_seq = max(self.latest_seq, seq)
+        if self.coalesce_interval > 0 and len(topics) == 1 and topics[0].startswith(COALESCED_TOPIC_PREFIXES):
+            self._coalesce(topics[0], message)
+            return
+        await self.publish(topics, message)
+
+    def _coalesce(self, topic: str, message: str) -> None:
+        """どのワーカーが送ったイベントもまとめて、端末へはトピックごとに coalesce_interval に1回、最新の1件だけ送る"""
+        self._coalesced[topic] = message
+        if topic in self._coalesce_tasks:
+            return
+        delay = self._coalesce_sent.get(topic, float("-inf")) + self.coalesce_interval - time.monotonic()
+        if delay <= 0:
+            self._flush_coalesced(topic)
+        else:
+            self._coalesce_tasks[topic] = asyncio.create_task(self._flush_coalesced_later(topic, delay))
+
+    async def _flush_coalesced_later(self, topic: str, delay: float) -> None:
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._coalesce_tasks.pop(topic, None)
+        self._flush_coalesced(topic)
+
+    def _flush_coalesced(self, topic: str) -> None:
+        message = self._coalesced.pop(topic, None)
+        self._coalesce_sent[topic] = time.monotonic()
+        if message is not None:
+            for connection in list(self.subscribers.get(topic, ())):
+                self._enqueue(connection, message)
+
+    def replay(self, websocket: Hashable, last_seq: int) -> bool:
+        """last_seq より後の購読トピックのイベントを再送する。欠けがあれば False（要再取得）"""
+        connection = self.active_connections.get(websocket)
+        if connection is None or last_seq > self.latest_seq:
+            return False
+        missed = [event for event in self._replay if event[0] > last_seq]
+        expected = last_seq + 1
+        for seq, _, _ in missed:
+            if seq != expected:
+                return False
+            expected += 1
+        if expected <= self.latest_seq:
+            return False
+        for _, topics, message in missed:
+            if connection.topics.intersection(topics):
+                self._enqueue(connection, message)
+        return True
+
+    def resume(self, websocket: Hashable, last_seq: Optional[int]) -> None:
+        """subscribe 直後の応答。last_seq があれば続きを再送し、できなければ resync_required を送る"""
+        if last_seq is None or self.replay(websocket, last_seq):
+            return
+        self.send(websocket, json.dumps({"type": "resync_required", "seq": self.latest_seq}))
+
+    def _enqueue(self, connection: Connection, message: str) -> None:
+        try:
+            connection.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning("websocket send queue full; dropping slow consumer")
+            self._drop(connection, CLOSE_SLOW_CONSUMER)
+
+    async def _writer(self, connection: Connection) -> None:
+        while True:
+            message = await connection.queue.get()
+            try:
+                await asyncio.wait_for(connection.websocket.send_text(message), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 切断済み・送信タイムアウト。以降この接続には送らない
+                self._drop(connection, CLOSE_SLOW_CONSUMER)
+                return
+
+    def _drop(self, connection: Connection, code: int) -> None:
+        if self.active_connections.get(connection.key) is not connection:
+            return
+        self.dropped += 1
+        self.disconnect(connection.key)
+        if connection.websocket is not None:
+            asyncio.create_task(self._close(connection.websocket, code))
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int) -> None:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass  # 既に切れている
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.active_connections),
+            "topics": len(self.subscribers),
+            "latest_seq": self.latest_seq,
+            "replay_buffered": len(self._replay),
+            "queued": sum(c.queue.qsize() for c in self.active_connections.values()),
+            "coalescing": len(self._coalesce_tasks),
+            "dropped": self.dropped,
+            "queue_size": self.queue_size,
+            "send_timeout_seconds": self.send_timeout,
+        }
+
+
+manager = ConnectionManager()
+
+
+def _sse_frame(message: str) -> str:
+    seq = json.loads(message).get("seq")
+    event_id = f"id: {seq}\n" if seq is not None else ""
+    return f"{event_id}data: {message}\n\n"
+
+
+async def sse_events(connection: Connection, manager: ConnectionManager = manager,
+                     keepalive: float = SSE_KEEPALIVE,
+                     is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+                     poll: float = SSE_DISCONNECT_POLL) -> AsyncIterator[str]:
+    """open_stream() した配信先のイベントを SSE の形式で返し続ける（切断・遅延で切られたら終わる）
+
+    is_disconnected（Request.is_disconnected）は poll 秒ごとに確認する。
+    """
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        deadline = time.monotonic() + keepalive
+        while not connection.closed.is_set():
+            if is_disconnected is not None and await is_disconnected():
+                break
+            try:
+                message = await asyncio.wait_for(
+                    connection.queue.get(), max(0.0, min(poll, deadline - time.monotonic()))
+                )
+            except asyncio.TimeoutError:
+                if time.monotonic() >= deadline:
+                    deadline = time.monotonic() + keepalive
+                    yield ": keep-alive\n\n"
+                continue
+            deadline = time.monotonic() + keepalive
+            yield _sse_frame(message)
+    finally:
+        manager.disconnect(connection.key)
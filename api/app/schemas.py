@@ -41,7 +41,7 @@ class MenuWithRemaining(Menu):
 
 class OrderItemBase(BaseModel):
     menu_id: int
-    qty: int
+    qty: int = Field(ge=1)
 
 class OrderItemCreate(OrderItemBase):
     pass
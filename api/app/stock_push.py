@@ -0,0 +1,95 @@
+"""在庫の変化を stock:{serve_date} の購読者（メニュー画面）に送る。
+
+注文の作成や管理画面での max_qty 変更のたびに notify(serve_date) を呼ぶ。送るのは変化の通知ではなく
+その日の残数そのもの（旧メニュー menus と v2 の daily_menus の id → 残数）なので、端末は受け取った値で
+表示を置き換えるだけでよく、メニューを取り直さない。
+
+    {"type": "stock_changed", "serve_date": "2025-06-12", "menus": {"12": 3}, "daily_menus": {"5": 0}}
+
+日付ごとに STOCK_PUSH_INTERVAL_SECONDS（既定1秒）に1回までに間引く。前回の送信から間隔が空いていれば
+すぐに送り、間隔内の変化はまとめて、間隔が明けたときに1回だけ送る。残数は送る直前に読むので、
+まとめた間の変化はすべて反映される。
+
+ここでの間引きはプロセスごとなので、ワーカーが N 個なら残数の読み出しと publish は最大 N 回／秒になる。
+端末に届く回数は受信側（realtime.ConnectionManager が stock トピックを同じ間隔でまとめる）で
+ワーカー数によらず1回／秒に抑える。イベントは毎回全量なので、まとめて最新の1件だけ送っても欠けない。
+"""
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Dict
+
+from sqlalchemy.orm import Session
+
+from . import database, models
+from .event_bus import event_bus
+from .realtime import STOCK_PUSH_INTERVAL, stock_topic
+
+logger = logging.getLogger(__name__)
+
+
+def stock_levels(db: Session, serve_date: date) -> dict:
+    """その日の残数。在庫カウンタ（max_qty・sold_qty）だけを読む"""
+    menus = (
+        db.query(models.MenuSQLAlchemy.id, models.MenuSQLAlchemy.max_qty, models.MenuSQLAlchemy.sold_qty)
+        .filter(models.MenuSQLAlchemy.serve_date == serve_date)
+        .all()
+    )
+    daily_menus = (
+        db.query(models.DailyMenu.id, models.DailyMenu.max_qty, models.DailyMenu.sold_qty)
+        .filter(models.DailyMenu.serve_date == serve_date)
+        .all()
+    )
+    return {
+        "menus": {str(r.id): max(0, r.max_qty - (r.sold_qty or 0)) for r in menus},
+        "daily_menus": {str(r.id): max(0, r.max_qty - (r.sold_qty or 0)) for r in daily_menus},
+    }
+
+
+class StockPublisher:
+    def __init__(self, interval: float = STOCK_PUSH_INTERVAL):
+        self.interval = interval
+        # 残数を読むセッション（テストでは差し替える）
+        self.session_factory = database.AsyncSessionLocal
+        self._pending: Dict[date, asyncio.Task] = {}
+        self._last_sent: Dict[date, float] = {}
+        self.sent = 0
+
+    def notify(self, serve_date: date) -> None:
+        """serve_date の在庫が変わった。送信が予約済みならそれにまとめる（イベントループ上で呼ぶこと）"""
+        if serve_date in self._pending:
+            return
+        delay = max(0.0, self._last_sent.get(serve_date, float("-inf")) + self.interval - time.monotonic())
+        self._pending[serve_date] = asyncio.create_task(self._flush(serve_date, delay))
+
+    async def _flush(self, serve_date: date, delay: float) -> None:
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            # 読み始める前に外す。読んだ後の変化は次の notify で改めて送る
+            self._pending.pop(serve_date, None)
+        self._last_sent[serve_date] = time.monotonic()
+        try:
+            async with self.session_factory() as db:
+                levels = await db.run_sync(stock_levels, serve_date)
+            await event_bus.publish([stock_topic(serve_date)], {
+                "type": "stock_changed", "serve_date": serve_date.isoformat(), **levels,
+            })
+            self.sent += 1
+        except Exception:
+            logger.exception("stock push failed for %s", serve_date)
+
+    async def stop(self) -> None:
+        tasks = list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "sent": self.sent, "interval_seconds": self.interval}
+
+
+stock_publisher = StockPublisher()
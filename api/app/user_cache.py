@@ -0,0 +1,85 @@
+"""ゲスト注文用の email → ユーザー情報のインプロセス LRU。
+
+ゲストユーザーは「部署／氏名」から作る合成 email で一意に決まり、削除もされないため、
+一度確定した行はプロセス内で覚えておけば再注文時にユーザー系のクエリが要らない。
+新規に INSERT した行はトランザクションが commit されるまで session.info に保留し、
+after_commit で LRU に載せる（ロールバックされた行を覚えないため。rollback や close で
+終わったトランザクションの保留分は捨てる）。
+件数上限は GUEST_USER_CACHE_SIZE（既定1024）。
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+GUEST_USER_CACHE_SIZE = int(os.getenv("GUEST_USER_CACHE_SIZE", "1024"))
+
+_PENDING = "pending_guest_users"
+
+
+class GuestUserCache:
+    def __init__(self, maxsize: int = GUEST_USER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email: str) -> Optional[dict]:
+        with self._lock:
+            info = self._entries.get(email)
+            if info is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(email)
+            self.hits += 1
+            return info
+
+    def put(self, email: str, info: dict) -> None:
+        with self._lock:
+            self._entries[email] = info
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "maxsize": self.maxsize}
+
+
+guest_user_cache = GuestUserCache()
+
+
+def remember_after_commit(db: Session, email: str, info: dict) -> None:
+    """このセッションの commit 後に LRU へ載せる（INSERT した行用）"""
+    pending: Dict[str, dict] = db.info.setdefault(_PENDING, {})
+    pending[email] = info
+
+
+@event.listens_for(Session, "after_commit")
+def _promote_pending(session: Session) -> None:
+    for email, info in session.info.pop(_PENDING, {}).items():
+        guest_user_cache.put(email, info)
+
+
+def pending_snapshot(db: Session) -> Dict[str, dict]:
+    return dict(db.info.get(_PENDING, {}))
+
+
+def restore_pending(db: Session, snapshot: Dict[str, dict]) -> None:
+    """SAVEPOINT をロールバックした時に、その中で保留した行を捨てる"""
+    db.info[_PENDING] = snapshot
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_pending(session: Session, transaction) -> None:
+    # commit されずに終わった（rollback / close）トランザクションの保留分は捨てる
+    if transaction.parent is None:
+        session.info.pop(_PENDING, None)
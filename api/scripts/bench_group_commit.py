@@ -0,0 +1,96 @@
+"""注文受付モード（グループコミット）の有無での commit 数・レイテンシ比較
+
+一時ファイルの SQLite に対して /orders/guest と /v2/orders/guest へ同時注文のバーストを送り、
+commit 回数と p50 / p99 レイテンシを表示する。本番DBには接続しない。
+
+    cd api && python -m scripts.bench_group_commit
+"""
+import logging
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+os.environ["TESTING"] = "true"  # 受付時間の検証を省く
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app import models, order_intake
+from app.database import Base, get_db
+from app.main import app
+
+BURSTS = 5
+ORDERS_PER_BURST = 40
+
+
+def run(enabled: bool, path: str):
+    engine = create_engine(
+        f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 30},
+        pool_size=ORDERS_PER_BURST, max_overflow=ORDERS_PER_BURST,
+    )
+    Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    order_intake.ENABLED = enabled
+
+    db = SessionLocal()
+    serve_date = date(2099, 1, 1)
+    menu = models.MenuSQLAlchemy(serve_date=serve_date, title="bench", price=500, max_qty=10_000)
+    product = models.Product(name="bench bowl", base_price=800)
+    db.add_all([menu, product])
+    db.flush()
+    daily = models.DailyMenu(serve_date=serve_date, product_id=product.id, max_qty=10_000)
+    db.add(daily)
+    db.commit()
+    menu_id, daily_id = menu.id, daily.id
+    db.close()
+
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+    latencies = []
+
+    def place(i):
+        if i % 2:
+            url, body = "/v2/orders/guest", {"items": [{"daily_menu_id": daily_id, "qty": 1}]}
+        else:
+            url, body = "/orders/guest", {"delivery_type": "desk", "request_time": "12:00",
+                                          "items": [{"menu_id": menu_id, "qty": 1}]}
+        body.update({"serve_date": str(serve_date), "department": "bench", "name": f"user {i % 50}"})
+        t0 = time.perf_counter()
+        response = client.post(url, json=body)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        return response.status_code
+
+    with TestClient(app) as client, ThreadPoolExecutor(max_workers=ORDERS_PER_BURST) as pool:
+        statuses = []
+        for burst in range(BURSTS):
+            statuses += pool.map(place, range(burst * ORDERS_PER_BURST, (burst + 1) * ORDERS_PER_BURST))
+    app.dependency_overrides.pop(get_db, None)
+    engine.dispose()
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return statuses.count(200), len(commits), statistics.median(latencies), p99
+
+
+if __name__ == "__main__":
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    print(f"{BURSTS} bursts x {ORDERS_PER_BURST} concurrent orders")
+    print(f"{'mode':>14} {'ok':>6} {'commits':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for enabled in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            ok, commits, p50, p99 = run(enabled, os.path.join(tmp, "bench.db"))
+        name = "group-commit" if enabled else "per-order"
+        print(f"{name:>14} {ok:>6} {commits:>8} {p50:>8.1f} {p99:>8.1f}")
@@ -0,0 +1,69 @@
+"""注文エクスポート（/admin/orders/export）のメモリ使用量が注文数によらず一定かを確かめる
+
+一時ファイルの SQLite に注文を入れ、order_export の CSV / NDJSON ストリームを最後まで読み切ったときの
+tracemalloc のピークと所要時間を、注文数を変えて表示する。本番DBには接続しない。
+
+    cd api && python -m scripts.bench_order_export
+"""
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app import models, order_export
+from app.database import Base
+
+SIZES = (100, 10_000, 100_000)
+
+
+def seed(path: str, orders: int, serve_date: date) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    now = datetime(2099, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User).values(id=1, name="bench", email="bench@example.com"))
+        conn.execute(insert(models.OrderSQLAlchemy), [{
+            "id": n + 1, "user_id": 1, "serve_date": serve_date, "delivery_type": models.DeliveryType.desk,
+            "request_time": "12:00", "total_price": 1000, "status": models.OrderStatus.new,
+            "created_at": now + timedelta(seconds=n), "order_id": f"#{n:06d}", "department": "開発",
+            "customer_name": f"ベンチ {n}",
+        } for n in range(orders)])
+        conn.execute(insert(models.OrderItem), [{
+            "id": n + 1, "order_id": n + 1, "qty": 1, "name_snapshot": "ベンチ丼", "unit_price_snapshot": 800,
+        } for n in range(orders)])
+        conn.execute(insert(models.OrderItemOption), [{
+            "order_item_id": n + 1, "name_snapshot": "大盛", "price_delta_snapshot": 200,
+        } for n in range(orders)])
+    engine.dispose()
+
+
+async def drain(path: str, stream, serve_date: date):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session = async_sessionmaker(engine, class_=AsyncSession)()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    size = 0
+    async for chunk in stream(session, serve_date, serve_date):
+        size += len(chunk)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await engine.dispose()
+    return elapsed, peak, size
+
+
+if __name__ == "__main__":
+    serve_date = date(2099, 1, 1)
+    print(f"{'orders':>8} {'format':>7} {'sec':>7} {'peak KiB':>9} {'MiB out':>8}")
+    for orders in SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            seed(path, orders, serve_date)
+            for name, stream in (("csv", order_export.stream_csv), ("ndjson", order_export.stream_ndjson)):
+                elapsed, peak, size = asyncio.run(drain(path, stream, serve_date))
+                print(f"{orders:>8} {name:>7} {elapsed:>7.2f} {peak / 1024:>9.1f} {size / 2**20:>8.1f}")
@@ -0,0 +1,90 @@
+"""注文一覧（/admin/orders/today・/orders）のシリアライズ方式ベンチマーク
+
+500件の注文を schemas.Order の response_model 経路（検証＋dump＋標準json）と、
+fast_json の dict 直組み立て（orjson / 標準json）で JSON 化し、所要時間とメモリ確保量を比べる。
+インメモリSQLiteを使うため本番DBには接続しない。
+
+    cd api && python -m scripts.bench_order_serialization
+"""
+import json
+import time
+import tracemalloc
+from datetime import date
+from typing import List
+
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app import crud, fast_json, models, schemas
+from app.database import Base
+
+ORDERS = 500
+ROUNDS = 20
+
+
+def seed(db, serve_date: date):
+    menus = [models.MenuSQLAlchemy(serve_date=serve_date, title=f"menu {i}", price=800, max_qty=1000) for i in range(3)]
+    db.add_all(menus)
+    db.flush()
+    for n in range(ORDERS):
+        user = models.User(name=f"bench {n}", email=f"bench_{n}@example.com")
+        db.add(user)
+        db.flush()
+        order = models.OrderSQLAlchemy(
+            user_id=user.id, serve_date=serve_date, delivery_type=models.DeliveryType.desk,
+            request_time="12:00", total_price=1600, status=models.OrderStatus.paid,
+            order_id=f"#{n:04d}", department="開発", customer_name=f"ベンチ {n}",
+        )
+        db.add(order)
+        db.flush()
+        db.add_all([models.OrderItem(order_id=order.id, menu_id=m.id, qty=1) for m in menus[:2]])
+    db.commit()
+
+
+def response_model_path(orders) -> bytes:
+    adapter = TypeAdapter(List[schemas.Order])
+    content = adapter.dump_python(adapter.validate_python(orders, from_attributes=True), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def fast_path(orders) -> bytes:
+    return fast_json.FastJSONResponse(fast_json.orders_payload(orders)).body
+
+
+def measure(fn, orders):
+    fn(orders)  # ウォームアップ
+    t0 = time.perf_counter()
+    for _ in range(ROUNDS):
+        body = fn(orders)
+    elapsed = (time.perf_counter() - t0) * 1000 / ROUNDS
+
+    tracemalloc.start()
+    fn(orders)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(body)
+
+
+if __name__ == "__main__":
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    serve_date = date(2099, 1, 1)
+    seed(db, serve_date)
+    orders = crud.get_today_orders(db, serve_date)
+
+    paths = [("response_model+json", response_model_path)]
+    if fast_json.orjson is not None:
+        fast_json.FAST_JSON = "orjson"
+        paths.append(("dict+orjson", fast_path))
+    print(f"{ORDERS} orders, {ROUNDS} rounds")
+    print(f"{'path':>20} {'ms/req':>10} {'peak KiB':>10} {'bytes':>10}")
+    for name, fn in paths:
+        ms, peak, size = measure(fn, orders)
+        print(f"{name:>20} {ms:>10.2f} {peak / 1024:>10.1f} {size:>10}")
+    fast_json.FAST_JSON = "stdlib"
+    ms, peak, size = measure(fast_path, orders)
+    print(f"{'dict+json':>20} {ms:>10.2f} {peak / 1024:>10.1f} {size:>10}")
+    db.close()
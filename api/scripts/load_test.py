@@ -1,7 +1,8 @@
 import requests
+import sys
 import threading
 import time
-from datetime import date
+from datetime import date, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def create_order(order_data, order_id):
@@ -77,5 +78,72 @@ def load_test_concurrent_orders(num_orders=10):
     
     print(f"Generated order IDs: {sorted(order_ids)}")
 
+def create_admin_headers():
+    """Admin bearer token signed with the server's SECRET_KEY (run from api/: python -m scripts.load_test)"""
+    from app.auth import create_access_token
+
+    token = create_access_token(data={
+        "sub": "loadtest@example.com",
+        "role": "admin",
+        "iss": "crowd-lunch",
+        "aud": "admin",
+        "iat": int(time.time()),
+    }, expires_delta=timedelta(minutes=15))
+    return {"Authorization": f"Bearer {token}"}
+
+def load_test_stock_reservation(num_orders=200, max_qty=40):
+    """Fire num_orders concurrent single-item orders at a fresh menu with max_qty stock.
+
+    Stock is reserved with a conditional UPDATE, so exactly max_qty orders must succeed
+    and the rest must be rejected with 409 sold_out.
+    """
+    print(f"Starting stock test: {num_orders} concurrent orders against max_qty={max_qty}...")
+
+    serve_date = date.today().strftime('%Y-%m-%d')
+    response = requests.post('http://localhost:8000/menus', data={
+        "serve_date": serve_date,
+        "title": f"在庫テスト {int(time.time())}",
+        "price": 500,
+        "max_qty": max_qty,
+    }, headers=create_admin_headers(), timeout=10)
+    response.raise_for_status()
+    menu_id = response.json()["id"]
+
+    def place_order(i):
+        order_data = {
+            "serve_date": serve_date,
+            "delivery_type": "desk",
+            "request_time": "12:30",
+            "department": f"在庫テスト部{i}",
+            "name": f"テストユーザー{i}",
+            "items": [{"menu_id": menu_id, "qty": 1}],
+        }
+        try:
+            return requests.post('http://localhost:8000/orders/guest', json=order_data, timeout=30).status_code
+        except Exception as e:
+            print(f"Order {i}: Exception - {str(e)}")
+            return None
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        statuses = list(executor.map(place_order, range(num_orders)))
+    end_time = time.time()
+
+    successes = statuses.count(200)
+    sold_out = statuses.count(409)
+    print(f"\n=== Stock Reservation Results ===")
+    print(f"Successful orders: {successes}")
+    print(f"Rejected as sold out: {sold_out}")
+    print(f"Other failures: {num_orders - successes - sold_out}")
+    print(f"Total time: {end_time - start_time:.2f} seconds")
+
+    if successes == max_qty:
+        print(f"✅ Stock test passed: exactly {max_qty} orders accepted")
+        return True
+    print(f"⚠️  OVERSELL/UNDERSELL DETECTED: expected {max_qty} successes, got {successes}")
+    return False
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "stock":
+        sys.exit(0 if load_test_stock_reservation(200, 40) else 1)
     load_test_concurrent_orders(15)
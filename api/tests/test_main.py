@@ -1,10 +1,13 @@
+import os
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlmodel import SQLModel
 from app.main import app
-from app.database import get_db, Base
+from app.stock_push import stock_publisher
+from app.database import get_db, get_async_db, Base
 from app.models import User, MenuSQLAlchemy as Menu, OrderSQLAlchemy as Order, OrderItem
 from datetime import date, time
 
@@ -46,7 +49,17 @@ def override_get_db():
     finally:
         db.close()
 
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db")
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+# 在庫通知は応答の後で残数を読むため、QueryCounter が数えない別エンジンで読ませる
+stock_publisher.session_factory = async_sessionmaker(create_async_engine("sqlite+aiosqlite:///./test.db"), class_=AsyncSession)
 
 @pytest.fixture(scope="module")
 def client():
@@ -351,3 +364,1460 @@ def test_invalid_jwt_scenarios(client):
     
     response = client.get("/orders/1", headers={"Authorization": "Bearer malformed.token"})
     assert response.status_code == 401
+
+class QueryCounter:
+    """Count SQL statements executed on the test engines (sync and async)"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        from sqlalchemy import event
+        for bind in (engine, async_engine.sync_engine):
+            event.listen(bind, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        for bind in (engine, async_engine.sync_engine):
+            event.remove(bind, "before_cursor_execute", self._on_execute)
+
+def test_weekly_menus_query_count_is_constant(client):
+    from app.crud import get_weekly_menus
+
+    db = TestingSessionLocal()
+    small_day, large_day = date(2099, 1, 5), date(2099, 2, 5)
+    for serve_date, count in ((small_day, 2), (large_day, 20)):
+        for i in range(count):
+            db.add(Menu(serve_date=serve_date, title=f"Bench {i}", price=500, max_qty=10))
+    db.commit()
+
+    with QueryCounter() as small:
+        small_menus = get_weekly_menus(db, small_day, small_day)
+    with QueryCounter() as large:
+        large_menus = get_weekly_menus(db, large_day, large_day)
+
+    assert len(small_menus) == 2
+    assert len(large_menus) == 20
+    assert small.count == large.count == 1
+    assert all(m.remaining_qty == 10 for m in large_menus)
+    db.close()
+
+def test_public_menus_cache_hits_and_invalidation(client):
+    from app.crud import create_menu_sqlalchemy, update_menu_sqlalchemy
+    from app.menu_cache import public_menu_cache
+    from app.schemas import MenuSQLAlchemyCreate, MenuSQLAlchemyUpdate
+
+    serve_date = date(2099, 3, 2)
+    db = TestingSessionLocal()
+    menu = create_menu_sqlalchemy(db, MenuSQLAlchemyCreate(
+        serve_date=serve_date, title="Cache Menu", price=700, max_qty=5
+    ))
+
+    hits, misses = public_menu_cache.hits, public_menu_cache.misses
+    first = client.get(f"/public/menus?date={serve_date}").json()
+    with QueryCounter() as counter:
+        second = client.get(f"/public/menus-range?start={serve_date}&end={serve_date}").json()
+    assert first == second["days"][str(serve_date)]
+    assert counter.count == 1  # menu_versions の読み出しのみ
+    assert public_menu_cache.misses == misses + 1
+    assert public_menu_cache.hits == hits + 1
+
+    update_menu_sqlalchemy(db, menu.id, MenuSQLAlchemyUpdate(title="Cache Menu v2"))
+    refreshed = client.get(f"/public/menus?date={serve_date}").json()
+    assert refreshed[0]["title"] == "Cache Menu v2"
+    assert public_menu_cache.misses == misses + 2
+
+    stats = client.get("/admin/cache/public-menus", headers={"Authorization": f"Bearer {create_admin_token()}"})
+    assert stats.status_code == 200
+    assert stats.json()["hits"] >= 1
+    db.close()
+
+def test_guest_order_keeps_public_menu_cache(client):
+    from app.menu_cache import public_menu_cache
+
+    serve_date = date(2099, 3, 3)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Order Cache Menu", price=600, max_qty=5)
+    db.add(menu)
+    db.commit()
+    db.refresh(menu)
+    db.close()
+
+    client.get(f"/public/menus?date={serve_date}")
+    other_generation = public_menu_cache.generation(date(2099, 3, 4))
+    response = client.post("/orders/guest", json={
+        "serve_date": str(serve_date),
+        "delivery_type": "pickup",
+        "request_time": "12:00",
+        "department": "Cache",
+        "name": "Tester",
+        "items": [{"menu_id": menu.id, "qty": 1}],
+    })
+    assert response.status_code == 200
+    # 公開メニューに残数は載らないので、注文ではキャッシュを捨てない
+    assert public_menu_cache.get(serve_date) is not None
+    assert public_menu_cache.generation(date(2099, 3, 4)) == other_generation
+
+
+def test_async_routes_do_not_use_the_sync_session():
+    import inspect
+    from fastapi.routing import APIRoute
+    from app.database import get_db
+
+    # 認証の依存（get_current_user）はスレッドプールで動くので、エンドポイント本体だけを見る
+    blocking = [route.path for route in app.routes if isinstance(route, APIRoute)
+                and inspect.iscoroutinefunction(route.endpoint)
+                and any(d.call is get_db for d in route.dependant.dependencies)]
+    assert blocking == []
+
+
+def test_public_menu_cache_is_bounded():
+    from app.menu_cache import PublicMenuCache
+
+    cache = PublicMenuCache(ttl=30, maxsize=3)
+    days = [date(2099, 4, d) for d in range(1, 6)]
+    for d in days[:3]:
+        cache.put(d, [{"id": d.day}], cache.generation(d))
+    assert cache.get(days[0]) == [{"id": 1}]  # 最近使った日は残る
+    for d in days[3:]:
+        cache.put(d, [{"id": d.day}], cache.generation(d))
+    assert cache.stats()["entries"] == 3
+    assert cache.get(days[1]) is None and cache.get(days[2]) is None
+    assert cache.get(days[0]) == [{"id": 1}]
+
+    # 世代番号も maxsize までしか持たない。捨てた日の読み込み途中の結果は書き戻さない
+    loading = cache.generation(days[0])
+    for d in days:
+        cache.invalidate(d)
+    assert len(cache._generations) == 3
+    cache.put(days[0], [{"id": "stale"}], loading)
+    assert cache.get(days[0]) is None
+
+    # 期限切れは put のときに捨てる
+    expiring = PublicMenuCache(ttl=0, maxsize=3)
+    expiring.put(days[0], [], expiring.generation(days[0]))
+    expiring.put(days[1], [], expiring.generation(days[1]))
+    assert list(expiring._entries) == [days[1]]
+
+def test_guest_order_rejects_oversell(client):
+    serve_date = date(2099, 3, 5)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Stock Menu", price=600, max_qty=3)
+    db.add(menu)
+    db.commit()
+    db.refresh(menu)
+    db.close()
+
+    order = {
+        "serve_date": str(serve_date),
+        "delivery_type": "pickup",
+        "request_time": "12:00",
+        "department": "Stock",
+        "name": "Tester",
+        "items": [{"menu_id": menu.id, "qty": 2}],
+    }
+    assert client.post("/orders/guest", json=order).status_code == 200
+    response = client.post("/orders/guest", json=order)
+    assert response.status_code == 409
+    assert response.json()["detail"]["code"] == "sold_out"
+
+    order["items"] = [{"menu_id": menu.id, "qty": 1}]
+    assert client.post("/orders/guest", json=order).status_code == 200
+    from app.crud import get_weekly_menus
+    db = TestingSessionLocal()
+    assert get_weekly_menus(db, serve_date, serve_date)[0].remaining_qty == 0
+    db.close()
+
+def test_guest_order_rejects_non_positive_qty(client):
+    serve_date = date(2099, 3, 6)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Negative Menu", price=500, max_qty=2)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+
+    order = {
+        "serve_date": str(serve_date), "delivery_type": "pickup", "request_time": "12:00",
+        "department": "Stock", "name": "Tester",
+    }
+    for qty in (-5, 0):
+        assert client.post("/orders/guest", json={**order, "items": [{"menu_id": menu_id, "qty": qty}]}).status_code == 422
+    assert client.post("/orders/guest", json={**order, "items": [{"menu_id": menu_id, "qty": 5}]}).status_code == 409
+
+    from app import crud, schemas
+    db = TestingSessionLocal()
+    with pytest.raises(ValueError):
+        crud.reserve_menu_stock(db, [schemas.OrderItemCreate.model_construct(menu_id=menu_id, qty=-5)])
+    db.rollback()
+    assert db.get(Menu, menu_id).sold_qty == 0
+    db.close()
+
+def test_order_list_matches_response_model(client):
+    from app import crud, schemas
+
+    serve_date = date(2099, 3, 6)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="List Menu", price=700, max_qty=10)
+    db.add(menu)
+    db.commit()
+    db.refresh(menu)
+    db.close()
+    for name in ("A", "B"):
+        client.post("/orders/guest", json={
+            "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+            "department": "List", "name": name, "items": [{"menu_id": menu.id, "qty": 2}],
+        })
+
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    response = client.get(f"/orders?date={serve_date}", headers=headers)
+    assert response.status_code == 200
+    db = TestingSessionLocal()
+    expected = [schemas.Order.model_validate(o).model_dump(mode="json") for o in crud.get_today_orders(db, serve_date)]
+    db.close()
+    assert len(expected) == 2
+    assert response.json() == expected
+    assert client.get(f"/admin/orders/today?date_filter={serve_date}", headers=headers).json() == expected
+
+def test_order_ids_come_from_per_date_counter(client):
+    from app.crud import generate_order_id
+
+    db = TestingSessionLocal()
+    first, second = date(2099, 3, 7), date(2099, 3, 8)
+    assert generate_order_id(db, first) == "#0307001"
+    assert generate_order_id(db, first) == "#0307002"
+    assert generate_order_id(db, second) == "#0308001"
+    db.rollback()
+    # SQLite は注文と同じトランザクションで採番する（Postgres は別トランザクションで即 commit）
+    assert generate_order_id(db, first) == "#0307001"  # ロールバックした番号は再利用される
+    db.rollback()
+    db.close()
+
+def test_order_counter_migration_seeds_from_max_number():
+    import importlib.util
+    from pathlib import Path
+    from alembic.migration import MigrationContext
+    from alembic.operations import Operations
+    from sqlalchemy import text
+
+    path = Path(__file__).resolve().parents[1] / "alembic" / "versions" / "p4_order_counters.py"
+    spec = importlib.util.spec_from_file_location("p4_order_counters", path)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+
+    scratch = create_engine("sqlite://")
+    with scratch.begin() as conn:
+        conn.execute(text("CREATE TABLE orders (id INTEGER PRIMARY KEY, serve_date DATE, order_id VARCHAR)"))
+        conn.execute(text(
+            "INSERT INTO orders (serve_date, order_id) VALUES "
+            "('2099-03-07', '#0307001'), ('2099-03-07', '#0307005'), "  # 002〜004 は削除済み
+            "('2099-03-08', NULL), ('2099-03-08', NULL)"  # 番号の無い旧データは件数
+        ))
+        with Operations.context(MigrationContext.configure(conn)):
+            migration.upgrade()
+        counters = dict(conn.execute(text("SELECT serve_date, last_number FROM order_counters")).all())
+    assert counters == {"2099-03-07": 5, "2099-03-08": 2}
+
+def test_guest_order_is_not_reread_after_insert(client):
+    serve_date = date(2099, 3, 9)
+    db = TestingSessionLocal()
+    menus = [Menu(serve_date=serve_date, title=f"Bulk Menu {i}", price=500 + i, max_qty=10) for i in range(3)]
+    db.add_all(menus)
+    db.commit()
+    menu_ids = [m.id for m in menus]
+    db.close()
+
+    with QueryCounter() as counter:
+        response = client.post("/orders/guest", json={
+            "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+            "department": "Bulk", "name": "Tester",
+            "items": [{"menu_id": menu_id, "qty": 1} for menu_id in menu_ids],
+        })
+    assert response.status_code == 200
+    body = response.json()
+    assert [it["menu"]["title"] for it in body["order_items"]] == ["Bulk Menu 0", "Bulk Menu 1", "Bulk Menu 2"]
+    assert body["total_price"] == 1503
+    assert body["user"]["name"] == "Bulk／Tester"
+    # 注文は1回の INSERT、作成後の再読込みは無い（明細の一括INSERTは Postgres では1文にまとまる）
+    assert len([st for st in counter.statements if st.startswith("INSERT INTO orders")]) == 1
+    assert not any("FROM orders" in st or "FROM order_items" in st for st in counter.statements)
+
+def test_guest_order_loads_menus_once(client):
+    serve_date = date(2099, 3, 10)
+    db = TestingSessionLocal()
+    menus = [Menu(serve_date=serve_date, title=f"Batch Menu {i}", price=400, max_qty=10) for i in range(3)]
+    db.add_all(menus)
+    db.commit()
+    menu_ids = [m.id for m in menus]
+    db.close()
+    order = {
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "Batch", "name": "Tester", "items": [{"menu_id": menu_id, "qty": 1} for menu_id in menu_ids],
+    }
+    assert client.post("/orders/guest", json=order).status_code == 200
+
+    with QueryCounter() as counter:
+        assert client.post("/orders/guest", json=order).status_code == 200
+    assert len([st for st in counter.statements if "FROM menus" in st]) == 1
+
+    unknown = client.post("/orders/guest", json={**order, "items": [
+        {"menu_id": menu_ids[0], "qty": 1}, {"menu_id": 999998, "qty": 1}, {"menu_id": 999999, "qty": 1},
+    ]})
+    assert unknown.status_code == 404
+    assert unknown.json()["detail"]["code"] == "menu_not_found"
+    assert unknown.json()["detail"]["menu_ids"] == [999998, 999999]
+
+def test_repeat_guest_costs_no_user_queries(client):
+    from app.user_cache import guest_user_cache
+
+    serve_date = date(2099, 3, 11)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Repeat Menu", price=500, max_qty=2)
+    db.add(menu)
+    db.commit()
+    db.refresh(menu)
+    db.close()
+    order = {
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "Repeat", "name": "Tester", "items": [{"menu_id": menu.id, "qty": 1}],
+    }
+    email = "guest_Repeat／Tester@temp.com"
+
+    with QueryCounter() as first:
+        assert client.post("/orders/guest", json=order).status_code == 200
+    assert guest_user_cache.get(email)["name"] == "Repeat／Tester"
+    assert len([st for st in first.statements if "users" in st]) == 1  # INSERT .. ON CONFLICT DO NOTHING
+
+    with QueryCounter() as repeat:
+        response = client.post("/orders/guest", json=order)
+    assert response.status_code == 200
+    assert response.json()["user"]["name"] == "Repeat／Tester"
+    assert not any("users" in st for st in repeat.statements)
+
+    sold_out = client.post("/orders/guest", json={**order, "name": "Rolled Back"})
+    assert sold_out.status_code == 409  # 在庫切れでロールバックされたユーザーは覚えない
+    assert guest_user_cache.get("guest_Repeat／Rolled Back@temp.com") is None
+
+def test_guest_order_idempotency_key_replays_response(client):
+    serve_date = date(2099, 3, 12)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Retry Menu", price=500, max_qty=5)
+    db.add(menu)
+    db.commit()
+    db.refresh(menu)
+    db.close()
+    order = {
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "Retry", "name": "Tester", "items": [{"menu_id": menu.id, "qty": 2}],
+    }
+    headers = {"Idempotency-Key": "retry-key-1"}
+
+    first = client.post("/orders/guest", json=order, headers=headers)
+    assert first.status_code == 200
+    with QueryCounter() as counter:
+        retry = client.post("/orders/guest", json=order, headers=headers)
+    assert retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+    assert counter.count == 1  # 保存済みキーの読み出しのみ
+    assert client.post("/orders/guest", json={**order, "name": "Other"}, headers=headers).status_code == 422
+
+    db = TestingSessionLocal()
+    assert db.query(Order).filter(Order.serve_date == serve_date).count() == 1
+    assert db.get(Menu, menu.id).sold_qty == 2
+    db.close()
+
+def test_idempotency_keys_are_purged_outside_orders(client):
+    from datetime import datetime, timedelta, timezone
+    from app import idempotency, models
+
+    serve_date = date(2099, 3, 14)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Purge Menu", price=500, max_qty=5)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    past = datetime.now(timezone.utc) - timedelta(hours=1)
+    db.add_all([models.IdempotencyKey(
+        scope="orders/guest", key=key, request_hash="old", status_code=200, response_body="{}", expires_at=past,
+    ) for key in ("expired-other", "expired-reused")])
+    db.commit()
+    db.close()
+
+    order = {
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "Purge", "name": "Tester", "items": [{"menu_id": menu_id, "qty": 1}],
+    }
+    # 期限切れのキーは再利用でき、注文のトランザクションは他の期限切れの行を消さない
+    assert client.post("/orders/guest", json=order, headers={"Idempotency-Key": "expired-reused"}).status_code == 200
+    db = TestingSessionLocal()
+    assert db.get(models.IdempotencyKey, ("orders/guest", "expired-other")) is not None
+    assert idempotency.purge_expired(db) == 1
+    assert db.get(models.IdempotencyKey, ("orders/guest", "expired-other")) is None
+    assert db.get(models.IdempotencyKey, ("orders/guest", "expired-reused")).request_hash != "old"
+    db.close()
+
+def test_group_commit_intake_reports_each_order(client, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from app import order_intake
+
+    serve_date = date(2099, 3, 13)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Burst Menu", price=500, max_qty=6)
+    db.add(menu)
+    db.commit()
+    db.refresh(menu)
+    db.close()
+
+    monkeypatch.setattr(order_intake, "ENABLED", True)
+    committer = order_intake.committer_for(TestingSessionLocal())
+    monkeypatch.setattr(committer, "window", 0.05)
+    commits_before = committer.commits
+
+    def place(i):
+        return client.post("/orders/guest", json={
+            "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+            "department": "Burst", "name": f"Tester {i}", "items": [{"menu_id": menu.id, "qty": 1}],
+        })
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(place, range(8)))
+    statuses = sorted(r.status_code for r in responses)
+    assert statuses == [200] * 6 + [409] * 2
+    assert committer.commits - commits_before < 8, committer.stats()
+    order_ids = {r.json()["order_id"] for r in responses if r.status_code == 200}
+    assert len(order_ids) == 6
+
+    db = TestingSessionLocal()
+    assert db.query(Order).filter(Order.serve_date == serve_date).count() == 6
+    assert db.get(Menu, menu.id).sold_qty == 6
+    db.close()
+
+def test_public_menus_conditional_get(client):
+    from app.crud import create_menu_sqlalchemy, update_menu_sqlalchemy
+    from app.schemas import MenuSQLAlchemyCreate, MenuSQLAlchemyUpdate
+
+    serve_date = date(2099, 4, 1)
+    db = TestingSessionLocal()
+    menu = create_menu_sqlalchemy(db, MenuSQLAlchemyCreate(
+        serve_date=serve_date, title="ETag Menu", price=900, max_qty=5
+    ))
+
+    first = client.get(f"/public/menus?date={serve_date}")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert first.headers["last-modified"]
+
+    with QueryCounter() as counter:
+        repeat = client.get(f"/public/menus?date={serve_date}", headers={"If-None-Match": etag})
+    assert repeat.status_code == 304
+    assert repeat.content == b""
+    assert counter.count == 1  # menu_versions の読み出しのみ
+
+    since = client.get(
+        f"/public/menus-range?start={serve_date}&end={serve_date}",
+        headers={"If-Modified-Since": first.headers["last-modified"]},
+    )
+    assert since.status_code == 304
+
+    update_menu_sqlalchemy(db, menu.id, MenuSQLAlchemyUpdate(price=950))
+    changed = client.get(f"/public/menus?date={serve_date}", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert changed.json()[0]["price"] == 950
+    db.close()
+
+def test_v2_menus_conditional_get(client):
+    serve_date = date(2099, 4, 2)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    product = client.post("/admin/catalog/products", json={"name": "ETag Bowl", "base_price": 1000}, headers=headers).json()
+    client.post("/admin/catalog/daily-menus", json={"serve_date": str(serve_date), "product_id": product["id"]}, headers=headers)
+
+    first = client.get(f"/v2/menus?date={serve_date}")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert client.get(f"/v2/menus?date={serve_date}", headers={"If-None-Match": etag}).status_code == 304
+
+    day = client.get(f"/v2/day-settings?date={serve_date}")
+    assert client.get(f"/v2/day-settings?date={serve_date}", headers={"If-None-Match": day.headers["etag"]}).status_code == 304
+
+    client.put(f"/admin/catalog/products/{product['id']}", json={"name": "ETag Bowl", "base_price": 1100}, headers=headers)
+    changed = client.get(f"/v2/menus?date={serve_date}", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.json()[0]["price"] == 1100
+
+    ranged = client.get(f"/v2/menus-range?start={serve_date}&end={serve_date}")
+    assert client.get(
+        f"/v2/menus-range?start={serve_date}&end={serve_date}",
+        headers={"If-None-Match": ranged.headers["etag"]},
+    ).status_code == 304
+
+def test_v2_menus_statement_count_independent_of_items(client):
+    from app import models
+
+    db = TestingSessionLocal()
+    category = models.Category(name="Bench Category")
+    db.add(category)
+    db.flush()
+    small_day, large_day = date(2099, 5, 1), date(2099, 5, 2)
+    for serve_date, count in ((small_day, 2), (large_day, 12)):
+        for i in range(count):
+            product = models.Product(name=f"Bench {serve_date} {i}", base_price=800, category_id=category.id)
+            db.add(product)
+            db.flush()
+            for g in range(2):
+                group = models.OptionGroup(product_id=product.id, name=f"group {g}", sort_order=1 - g)
+                db.add(group)
+                db.flush()
+                db.add_all([models.Option(option_group_id=group.id, name=f"opt {o}", price_delta=100) for o in range(2)])
+            db.add(models.DailyMenu(serve_date=serve_date, product_id=product.id))
+    db.commit()
+    db.close()
+
+    with QueryCounter() as small:
+        small_items = client.get(f"/v2/menus?date={small_day}").json()
+    with QueryCounter() as large:
+        large_items = client.get(f"/v2/menus?date={large_day}").json()
+    assert len(small_items) == 2
+    assert len(large_items) == 12
+    assert small.count == large.count
+    assert large_items[0]["category"] == "Bench Category"
+    assert [g["name"] for g in large_items[0]["option_groups"]] == ["group 1", "group 0"]
+    assert len(large_items[0]["option_groups"][0]["options"]) == 2
+
+    with QueryCounter() as ranged:
+        days = client.get(f"/v2/menus-range?start={small_day}&end={large_day}").json()["days"]
+    assert len(days[str(large_day)]) == 12
+    assert ranged.count == 2  # 構築済みスナップショット＋在庫カウンタの読み出しのみ
+
+    # 保存済みの品目 JSON をパースせずに、item_index で切り分けて残数を足すだけで返す
+    import json
+    from app.catalog_routes import _render_snapshot
+    db = TestingSessionLocal()
+    row = db.get(models.MenuSnapshot, small_day)
+    stored = {"payload": row.payload, "item_index": row.item_index}
+    db.close()
+    body = client.get(f"/v2/menus?date={small_day}").text
+    assert body == _render_snapshot(stored, {item["daily_menu_id"]: item["remaining_qty"] for item in json.loads(body)})
+    assert f'"{small_day}":{body}' in client.get(f"/v2/menus-range?start={small_day}&end={large_day}").text
+    # 値の中に "remaining_qty" や区切りに見える文字があっても、切り分けは文字数で行う
+    tricky = '{"daily_menu_id":7,"name":"\\"remaining_qty\\":1,9:3","remaining_qty":'
+    rendered = _render_snapshot({"payload": tricky * 2, "item_index": f"7:{len(tricky)},8:{len(tricky)}"}, {7: 0, 8: 4})
+    assert [item["remaining_qty"] for item in json.loads(rendered)] == [0, 4]
+    assert json.loads(rendered)[0]["name"] == '"remaining_qty":1,9:3'
+
+def test_v2_menus_snapshots_are_bounded(client):
+    from app import models
+
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    assert client.get("/v2/menus-range?start=2099-01-01&end=2099-12-31").status_code == 400
+    # 品目の無い日は、匿名の GET で何日分読まれても保存しない
+    assert client.get("/v2/menus-range?start=2098-01-01&end=2098-01-15").json()["days"] == {}
+    assert client.get("/v2/menus?date=2098-02-01").json() == []
+    db = TestingSessionLocal()
+    assert db.query(models.MenuSnapshot).filter(models.MenuSnapshot.serve_date < date(2099, 1, 1)).count() == 0
+    db.close()
+
+    # 商品の編集で再構築するのは今日以降の日付だけ
+    product = client.post("/admin/catalog/products", json={"name": "History Bowl", "base_price": 700}, headers=headers).json()
+    past, future = date(2001, 1, 1), date(2099, 5, 3)
+    db = TestingSessionLocal()
+    db.add_all([models.DailyMenu(serve_date=d, product_id=product["id"]) for d in (past, future)])
+    db.commit()
+    db.close()
+    client.put(f"/admin/catalog/products/{product['id']}", json={"name": "History Bowl 2", "base_price": 700}, headers=headers)
+    db = TestingSessionLocal()
+    assert db.get(models.MenuSnapshot, past) is None
+    assert "History Bowl 2" in db.get(models.MenuSnapshot, future).payload
+    db.close()
+
+
+def test_v2_lazy_snapshot_does_not_overwrite_a_newer_catalog_change(client, monkeypatch):
+    from app import catalog_routes, menu_versions, models
+
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    serve_date = date(2099, 5, 4)
+    product = client.post("/admin/catalog/products", json={"name": "Race Bowl", "base_price": 700}, headers=headers).json()
+    dm = client.post("/admin/catalog/daily-menus", json={"serve_date": str(serve_date), "product_id": product["id"]}, headers=headers).json()
+    db = TestingSessionLocal()
+    db.query(models.MenuSnapshot).filter(models.MenuSnapshot.serve_date == serve_date).delete()
+    db.commit()
+    db.close()
+
+    # 参照側が古い内容を組み立てた直後に、別のリクエストがその日を空にして commit した
+    build = catalog_routes._build_snapshots
+
+    def build_then_catalog_change(session, dates):
+        built = build(session, dates)
+        other = TestingSessionLocal()
+        other.query(models.DailyMenu).filter(models.DailyMenu.id == dm["id"]).delete()
+        menu_versions.bump(other, serve_date)
+        other.commit()
+        other.close()
+        return built
+    monkeypatch.setattr(catalog_routes, "_build_snapshots", build_then_catalog_change)
+    assert len(client.get(f"/v2/menus?date={serve_date}").json()) == 1
+    monkeypatch.undo()
+
+    db = TestingSessionLocal()
+    assert db.get(models.MenuSnapshot, serve_date) is None
+    db.close()
+    assert client.get(f"/v2/menus?date={serve_date}").json() == []
+
+
+def test_v2_menus_served_from_snapshot(client):
+    serve_date = date(2099, 5, 10)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    product = client.post("/admin/catalog/products", json={"name": "Snapshot Curry", "base_price": 900}, headers=headers).json()
+    group = client.post("/admin/catalog/option-groups", json={"product_id": product["id"], "name": "Size"}, headers=headers).json()
+    dm = client.post("/admin/catalog/daily-menus", json={
+        "serve_date": str(serve_date), "product_id": product["id"], "price_override": 850,
+    }, headers=headers).json()
+
+    with QueryCounter() as counter:
+        items = client.get(f"/v2/menus?date={serve_date}").json()
+    assert counter.count == 2  # スナップショット（主キー）＋在庫カウンタ
+    assert items[0]["price"] == 850
+    assert items[0]["option_groups"][0]["options"] == []
+
+    client.post("/admin/catalog/options", json={"option_group_id": group["id"], "name": "Large", "price_delta": 200}, headers=headers)
+    items = client.get(f"/v2/menus?date={serve_date}").json()
+    assert items[0]["option_groups"][0]["options"][0]["name"] == "Large"
+
+    client.put(f"/admin/catalog/daily-menus/{dm['id']}", json={"is_available": False}, headers=headers)
+    assert client.get(f"/v2/menus?date={serve_date}").json() == []
+
+
+def test_v2_guest_order_reserves_stock(client):
+    serve_date = date(2099, 5, 20)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    product = client.post("/admin/catalog/products", json={"name": "Stock Curry", "base_price": 900}, headers=headers).json()
+    dm = client.post("/admin/catalog/daily-menus", json={
+        "serve_date": str(serve_date), "product_id": product["id"], "max_qty": 2,
+    }, headers=headers).json()
+    first = client.get(f"/v2/menus?date={serve_date}")
+    assert first.json()[0]["remaining_qty"] == 2
+
+    order = {
+        "serve_date": str(serve_date), "department": "開発", "name": "在庫 太郎",
+        "items": [{"daily_menu_id": dm["id"], "qty": 2}],
+    }
+    assert client.post("/v2/orders/guest", json=order).status_code == 200
+    sold_out = client.post("/v2/orders/guest", json={**order, "items": [{"daily_menu_id": dm["id"], "qty": 1}]})
+    assert sold_out.status_code == 409
+    assert sold_out.json()["detail"]["code"] == "sold_out"
+    assert client.post("/v2/orders/guest", json={**order, "items": [{"daily_menu_id": dm["id"], "qty": 0}]}).status_code == 422
+
+    after = client.get(f"/v2/menus?date={serve_date}", headers={"If-None-Match": first.headers["etag"]})
+    assert after.status_code == 200
+    assert after.json()[0]["remaining_qty"] == 0
+
+
+def test_v2_guest_order_validates_options_in_batch(client):
+    serve_date = date(2099, 5, 21)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+
+    def product_with_options(name):
+        product = client.post("/admin/catalog/products", json={"name": name, "base_price": 800}, headers=headers).json()
+        group = client.post("/admin/catalog/option-groups", json={
+            "product_id": product["id"], "name": "ご飯の量", "max_select": 1, "is_required": True,
+        }, headers=headers).json()
+        options = [client.post("/admin/catalog/options", json={
+            "option_group_id": group["id"], "name": label, "price_delta": delta,
+        }, headers=headers).json() for label, delta in (("普通", 0), ("大盛", 200))]
+        dm = client.post("/admin/catalog/daily-menus", json={
+            "serve_date": str(serve_date), "product_id": product["id"],
+        }, headers=headers).json()
+        return dm, options
+
+    lines = [product_with_options(f"Batch Bowl {i}") for i in range(3)]
+    order = {"serve_date": str(serve_date), "department": "開発", "name": "一括 太郎"}
+
+    def post(items):
+        return client.post("/v2/orders/guest", json={**order, "items": items})
+
+    assert post([{"daily_menu_id": lines[0][0]["id"], "option_ids": [lines[1][1][0]["id"]]}]).json()["detail"]["code"] == "invalid_option"
+    both = post([{"daily_menu_id": lines[0][0]["id"], "option_ids": [o["id"] for o in lines[0][1]]}])
+    assert both.json()["detail"]["code"] == "invalid_option_selection"
+    assert post([{"daily_menu_id": lines[0][0]["id"]}]).json()["detail"]["code"] == "invalid_option_selection"
+    assert post([{"daily_menu_id": 999999}]).json()["detail"]["daily_menu_ids"] == [999999]
+
+    def items(n):
+        return [{"daily_menu_id": dm["id"], "qty": 2, "option_ids": [options[1]["id"]]} for dm, options in lines[:n]]
+
+    post(items(1))  # ゲストユーザー作成を済ませておく
+    with QueryCounter() as one:
+        assert post(items(1)).json()["total_price"] == 2000
+    with QueryCounter() as three:
+        assert post(items(3)).json()["total_price"] == 6000
+    selects = lambda counter: [st for st in counter.statements if st.startswith("SELECT")]
+    assert len(selects(one)) == len(selects(three))
+
+
+def test_v2_guest_order_rejects_inactive_options_and_products(client):
+    from app import models
+
+    serve_date = date(2099, 5, 23)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    product = client.post("/admin/catalog/products", json={"name": "Retired Bowl", "base_price": 800}, headers=headers).json()
+    group = client.post("/admin/catalog/option-groups", json={
+        "product_id": product["id"], "name": "トッピング", "max_select": 1, "is_required": True,
+    }, headers=headers).json()
+    kept, retired = [client.post("/admin/catalog/options", json={
+        "option_group_id": group["id"], "name": label, "price_delta": 100,
+    }, headers=headers).json() for label in ("卵", "チーズ")]
+    dm = client.post("/admin/catalog/daily-menus", json={
+        "serve_date": str(serve_date), "product_id": product["id"],
+    }, headers=headers).json()
+    db = TestingSessionLocal()
+    db.get(models.Option, retired["id"]).is_active = False
+    db.commit()
+
+    def post(option_ids):
+        return client.post("/v2/orders/guest", json={
+            "serve_date": str(serve_date), "department": "開発", "name": "無効 太郎",
+            "items": [{"daily_menu_id": dm["id"], "option_ids": option_ids}],
+        })
+
+    rejected = post([retired["id"]])
+    assert rejected.status_code == 422
+    assert rejected.json()["detail"] == {
+        "code": "invalid_option", "message": "選択できないオプションが含まれています", "option_id": retired["id"],
+    }
+    assert post([kept["id"]]).status_code == 200
+
+    db.get(models.Product, product["id"]).is_active = False
+    db.commit()
+    db.close()
+    gone = post([kept["id"]])
+    assert gone.status_code == 404
+    assert gone.json()["detail"]["daily_menu_ids"] == [dm["id"]]
+
+
+def test_v2_guest_order_idempotency_key_replays_response(client):
+    serve_date = date(2099, 5, 22)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    product = client.post("/admin/catalog/products", json={"name": "Retry Bowl", "base_price": 900}, headers=headers).json()
+    dm = client.post("/admin/catalog/daily-menus", json={
+        "serve_date": str(serve_date), "product_id": product["id"], "max_qty": 3,
+    }, headers=headers).json()
+    order = {
+        "serve_date": str(serve_date), "department": "開発", "name": "再送 太郎",
+        "items": [{"daily_menu_id": dm["id"], "qty": 1}],
+    }
+
+    first = client.post("/v2/orders/guest", json=order, headers={"Idempotency-Key": "v2-retry"})
+    retry = client.post("/v2/orders/guest", json=order, headers={"Idempotency-Key": "v2-retry"})
+    assert retry.json() == first.json()
+    assert client.get(f"/v2/menus?date={serve_date}").json()[0]["remaining_qty"] == 2
+
+
+
+def test_order_routes_run_on_async_session(client):
+    from sqlalchemy import event
+
+    serve_date = date(2099, 6, 3)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Async Bento", price=700, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+
+    sync_statements = []
+    listener = lambda conn, cursor, statement, *args: sync_statements.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        with QueryCounter() as counter:
+            created = client.post("/orders/guest", json={
+                "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+                "department": "開発", "name": "非同期 花子", "items": [{"menu_id": menu_id, "qty": 1}],
+            })
+            listed = client.get(f"/orders?date={serve_date}", headers={"Authorization": f"Bearer {create_admin_token()}"})
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+    assert created.status_code == 200
+    assert [o["id"] for o in listed.json()] == [created.json()["id"]]
+    assert counter.count > 0
+    assert sync_statements == []
+
+
+def test_order_list_keyset_pagination_and_filters(client):
+    serve_date = date(2099, 6, 4)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Paged Bento", price=600, max_qty=50)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+
+    created = []
+    for i in range(5):
+        response = client.post("/orders/guest", json={
+            "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00" if i % 2 else "12:30",
+            "department": "営業" if i < 2 else "開発", "name": f"頁 {i}", "items": [{"menu_id": menu_id, "qty": 1}],
+        })
+        created.append(response.json()["id"])
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        url = f"/orders?date={serve_date}&limit=2" + (f"&cursor={cursor}" if cursor else "")
+        page = client.get(url, headers=headers)
+        assert page.status_code == 200
+        seen += [o["id"] for o in page.json()]
+        pages += 1
+        cursor = page.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert seen == created
+    assert pages == 3
+
+    filtered = client.get(f"/admin/orders/today?date_filter={serve_date}&department=開発&request_time=12:00", headers=headers)
+    assert [o["id"] for o in filtered.json()] == [created[3]]
+    assert client.get(f"/orders?date={serve_date}&cursor=bogus", headers=headers).status_code == 400
+
+    # created_at が NULL の旧データは末尾に id 順で並び、そこを跨いでもページングできる
+    db = TestingSessionLocal()
+    db.query(Order).filter(Order.id.in_([created[1], created[3]])).update(
+        {Order.created_at: None}, synchronize_session=False)
+    db.commit()
+    db.close()
+    seen, cursor = [], None
+    while True:
+        url = f"/orders?date={serve_date}&limit=2" + (f"&cursor={cursor}" if cursor else "")
+        page = client.get(url, headers=headers)
+        assert page.status_code == 200
+        seen += [o["id"] for o in page.json()]
+        cursor = page.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert seen == [created[0], created[2], created[4], created[1], created[3]]
+    default_page = client.get(f"/orders?date={serve_date}", headers=headers)
+    assert len(default_page.json()) == 5 and "X-Next-Cursor" not in default_page.headers
+
+
+def test_order_export_streams_csv_and_ndjson(client):
+    import csv
+    import io
+    import json as jsonlib
+
+    start, end = date(2099, 6, 10), date(2099, 6, 11)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=start, title="Export Bento", price=650, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+    product = client.post("/admin/catalog/products", json={"name": "Export Bowl", "base_price": 800}, headers=headers).json()
+    group = client.post("/admin/catalog/option-groups", json={"product_id": product["id"], "name": "ご飯の量"}, headers=headers).json()
+    large = client.post("/admin/catalog/options", json={
+        "option_group_id": group["id"], "name": "大盛", "price_delta": 200,
+    }, headers=headers).json()
+    dm = client.post("/admin/catalog/daily-menus", json={"serve_date": str(end), "product_id": product["id"]}, headers=headers).json()
+
+    legacy = client.post("/orders/guest", json={
+        "serve_date": str(start), "delivery_type": "desk", "request_time": "12:00",
+        "department": "開発", "name": "出力 一郎", "items": [{"menu_id": menu_id, "qty": 2}],
+    }).json()
+    v2 = client.post("/v2/orders/guest", json={
+        "serve_date": str(end), "department": "開発", "name": "出力 二郎",
+        "items": [{"daily_menu_id": dm["id"], "qty": 1, "option_ids": [large["id"]]}],
+    }).json()
+
+    response = client.get(f"/admin/orders/export?start={start}&end={end}", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.content.decode("utf-8-sig"))))
+    assert [(r["order_id"], r["item_name"], r["unit_price"], r["qty"], r["options"]) for r in rows] == [
+        (legacy["order_id"], "Export Bento", "650", "2", ""),
+        (v2["order_id"], "Export Bowl", "800", "1", "大盛(+200)"),
+    ]
+
+    ndjson = client.get(f"/admin/orders/export?start={start}&end={end}&format=ndjson", headers=headers)
+    orders = [jsonlib.loads(line) for line in ndjson.text.splitlines()]
+    assert [o["id"] for o in orders] == [legacy["id"], v2["id"]]
+    assert orders[1]["items"][0]["options"] == [{"option_id": large["id"], "name": "大盛", "price_delta": 200}]
+    assert client.get(f"/admin/orders/export?start={end}&end={start}", headers=headers).status_code == 422
+
+
+def test_order_export_csv_neutralizes_formulas(client):
+    import csv
+    import io
+    import json as jsonlib
+
+    serve_date = date(2099, 6, 9)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="@Formula Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+    client.post("/orders/guest", json={
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": '=HYPERLINK("http://evil.example","x")', "name": "+1+1", "note": "-2+3",
+        "items": [{"menu_id": menu_id, "qty": 1}],
+    })
+
+    response = client.get(f"/admin/orders/export?start={serve_date}&end={serve_date}", headers=headers)
+    row = next(csv.DictReader(io.StringIO(response.content.decode("utf-8-sig"))))
+    assert row["department"] == '\'=HYPERLINK("http://evil.example","x")'
+    assert (row["customer_name"], row["note"], row["item_name"]) == ("'+1+1", "'-2+3", "'@Formula Bento")
+    assert row["total_price"] == "500"
+    # NDJSON は表計算ソフトで開く前提ではないので、値はそのまま
+    ndjson = client.get(f"/admin/orders/export?start={serve_date}&end={serve_date}&format=ndjson", headers=headers)
+    assert jsonlib.loads(ndjson.text)["customer_name"] == "+1+1"
+
+
+def test_websocket_broadcast_drops_slow_consumer_without_blocking():
+    import asyncio
+    from app.realtime import ConnectionManager
+
+    class Socket:
+        def __init__(self, stalled):
+            self.stalled = stalled
+            self.sent = []
+            self.closed_with = None
+
+        async def accept(self):
+            pass
+
+        async def send_text(self, message):
+            if self.stalled:
+                await asyncio.Event().wait()
+            self.sent.append(message)
+
+        async def close(self, code=1000):
+            self.closed_with = code
+
+    async def scenario():
+        manager = ConnectionManager(queue_size=2, send_timeout=5)
+        fast, slow = Socket(stalled=False), Socket(stalled=True)
+        await manager.connect(fast)
+        await manager.connect(slow)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i in range(5):
+            await manager.broadcast(f"event {i}")
+            await asyncio.sleep(0.01)  # 別リクエストからの配信の間に writer が動く
+        elapsed = loop.time() - started
+        await asyncio.sleep(0.05)
+        return manager, fast, slow, elapsed
+
+    manager, fast, slow, elapsed = asyncio.run(scenario())
+    assert elapsed < 0.5  # 止まった端末への送信を待たない
+    assert fast.sent == [f"event {i}" for i in range(5)]
+    assert slow.closed_with == 1013
+    assert list(manager.active_connections) == [fast]
+    assert manager.stats()["dropped"] == 1
+
+
+def test_websocket_receives_order_broadcast(client):
+    serve_date = date(2099, 6, 12)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Live Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+
+    with client.websocket_connect("/ws/orders") as ws:
+        ws.send_json({"type": "subscribe", "topics": [f"board:{serve_date}"], "token": create_admin_token()})
+        subscribed = ws.receive_json()
+        assert (subscribed["type"], subscribed["topics"], subscribed["rejected"]) == ("subscribed", [f"board:{serve_date}"], [])
+        created = client.post("/orders/guest", json={
+            "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+            "department": "開発", "name": "配信 三郎", "items": [{"menu_id": menu_id, "qty": 1}],
+        }).json()
+        event = ws.receive_json()
+    assert event["type"] == "order_created"
+    assert event["order_id"] == created["id"]
+
+
+def test_board_events_carry_order_delta(client):
+    serve_date = date(2099, 6, 15)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    product = client.post("/admin/catalog/products", json={"name": "Delta Bowl", "base_price": 800}, headers=headers).json()
+    group = client.post("/admin/catalog/option-groups", json={"product_id": product["id"], "name": "量"}, headers=headers).json()
+    large = client.post("/admin/catalog/options", json={
+        "option_group_id": group["id"], "name": "大盛", "price_delta": 200,
+    }, headers=headers).json()
+    dm = client.post("/admin/catalog/daily-menus", json={
+        "serve_date": str(serve_date), "product_id": product["id"],
+    }, headers=headers).json()
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Delta Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+
+    with client.websocket_connect("/ws/orders") as ws:
+        ws.send_json({"type": "subscribe", "topics": [f"board:{serve_date}"], "token": create_admin_token()})
+        ws.receive_json()
+        client.post("/v2/orders/guest", json={
+            "serve_date": str(serve_date), "department": "開発", "name": "差分 五郎",
+            "items": [{"daily_menu_id": dm["id"], "qty": 2, "option_ids": [large["id"]]}],
+        })
+        event = ws.receive_json()
+        listed = client.get(f"/admin/orders/today?date_filter={serve_date}", headers=headers).json()
+        created = client.post("/orders/guest", json={
+            "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+            "department": "開発", "name": "差分 六郎", "items": [{"menu_id": menu_id, "qty": 1}],
+        }).json()
+        legacy = ws.receive_json()
+        client.patch(f"/admin/orders/{created['id']}/delivery-completion", headers=headers)
+        delivered = ws.receive_json()
+
+    # 一覧の1件と同じ形に、品名・単価・オプションが足してある
+    order = event["order"]
+    item = order["order_items"][0]
+    assert (item["name"], item["unit_price"], item["qty"]) == ("Delta Bowl", 800, 2)
+    assert item["options"] == [{"option_id": large["id"], "name": "大盛", "price_delta": 200}]
+    for field in ("name", "unit_price", "options"):
+        del item[field]
+    assert [order] == listed
+    assert legacy["order"]["order_items"][0]["name"] == "Delta Bento"
+    assert delivered["type"] == "delivery_completed"
+    assert (delivered["order_id"], delivered["status"]) == (created["id"], "delivered")
+    assert delivered["delivered_at"] is not None
+
+
+def test_websocket_topics_deliver_only_to_subscribers(client):
+    serve_date = date(2099, 6, 13)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Topic Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+    response = client.post("/orders/guest", json={
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "開発", "name": "購読 四郎", "items": [{"menu_id": menu_id, "qty": 1}],
+    })
+    created, order_token = response.json(), response.headers["X-Order-Token"]
+
+    with client.websocket_connect("/ws/orders") as customer, client.websocket_connect("/ws/orders") as other:
+        customer.send_json({"type": "subscribe", "topics": [f"order:{created['id']}", f"board:{serve_date}"],
+                            "token": order_token})
+        subscribed = customer.receive_json()
+        assert (subscribed["topics"], subscribed["rejected"]) == ([f"order:{created['id']}"], [f"board:{serve_date}"])
+        # 連番の ID を推測しても、注文トークンが無ければ購読できない
+        other.send_json({"type": "subscribe", "topics": [f"order:{created['id']}"], "token": "0" * 32})
+        assert other.receive_json()["rejected"] == [f"order:{created['id']}"]
+
+        client.patch(f"/orders/{created['id']}/status", json={"status": "paid"}, headers=headers)
+        event = customer.receive_json()
+        assert event == {"type": "status_updated", "order_id": created["id"], "status": "paid", "delivered_at": None,
+                         "seq": event["seq"]}
+        assert event["seq"] > subscribed["seq"]
+        other.send_text("ping")
+        assert other.receive_text() == "Message received: ping"  # status_updated は届いていない
+
+
+def test_stock_changes_are_coalesced_per_date(client):
+    serve_date = date(2099, 6, 16)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Stock Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+    order = {
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "開発", "name": "在庫 七郎", "items": [{"menu_id": menu_id, "qty": 1}],
+    }
+    interval, stock_publisher.interval = stock_publisher.interval, 0.5
+    try:
+        with client.websocket_connect("/ws/orders") as ws:
+            ws.send_json({"type": "subscribe", "topics": [f"stock:{serve_date}"]})
+            ws.receive_json()
+            for _ in range(3):
+                assert client.post("/orders/guest", json=order).status_code == 200
+            events = [ws.receive_json()]
+            while events[-1]["menus"][str(menu_id)] != 7:
+                events.append(ws.receive_json())
+    finally:
+        stock_publisher.interval = interval
+
+    # 1件目はすぐ送り、間隔内の残りはまとめて1回（残数は送る直前の値）
+    assert len(events) < 3
+    assert events[-1]["type"] == "stock_changed"
+    assert events[-1]["serve_date"] == str(serve_date)
+    assert events[-1]["daily_menus"] == {}
+
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    with client.websocket_connect("/ws/orders") as ws:
+        ws.send_json({"type": "subscribe", "topics": [f"stock:{serve_date}"]})
+        ws.receive_json()
+        client.put(f"/menus/{menu_id}", data={"max_qty": "20"}, headers=headers)
+        assert ws.receive_json()["menus"] == {str(menu_id): 17}
+
+
+def test_stock_events_from_many_workers_are_coalesced_per_topic():
+    import asyncio
+    import json
+    from app.auth import order_token
+    from app.realtime import ConnectionManager
+
+    async def scenario():
+        manager = ConnectionManager(coalesce_interval=0.05)
+        connection = manager.open_stream()
+        manager.subscribe(connection.key, ["stock:2099-06-20", "order:1"], order_token(1))
+        # 3つのワーカーがほぼ同時に同じ日の残数を publish した
+        for seq, remaining in ((1, 9), (2, 8), (4, 7)):
+            await manager.deliver(seq, ["stock:2099-06-20"], json.dumps({"type": "stock_changed", "menus": {"1": remaining}, "seq": seq}))
+        await manager.deliver(3, ["order:1"], '{"type": "status_updated", "seq": 3}')
+        received = [connection.queue.get_nowait() for _ in range(connection.queue.qsize())]
+        await asyncio.sleep(0.1)
+        received += [connection.queue.get_nowait() for _ in range(connection.queue.qsize())]
+        manager.disconnect(connection.key)
+        return manager, received
+
+    manager, received = asyncio.run(scenario())
+    # 1件目はすぐ、間隔内の残りは最新の1件だけ。他のトピックはまとめない
+    assert [json.loads(m)["seq"] for m in received] == [1, 3, 4]
+    assert json.loads(received[-1])["menus"] == {"1": 7}
+    assert [seq for seq, _, _ in manager._replay] == [1, 2, 4, 3]
+
+
+def test_event_bus_fans_out_to_every_worker():
+    import asyncio
+    from app.event_bus import InMemoryEventBus
+
+    bus = InMemoryEventBus()  # 本番は Postgres の LISTEN/NOTIFY。ワーカーごとに subscribe する
+    received = {"worker_a": [], "worker_b": []}
+    for worker, events in received.items():
+        async def handler(seq, topics, message, events=events):
+            events.append((seq, topics, message))
+        bus.subscribe(handler)
+
+    asyncio.run(bus.publish(["board:2099-06-14"], {"type": "order_created"}))
+    assert received["worker_a"] == received["worker_b"] == [(1, ["board:2099-06-14"], '{"type": "order_created", "seq": 1}')]
+
+
+def test_postgres_event_bus_notify_payload():
+    import asyncio
+    import json
+    from app.event_bus import MAX_NOTIFY_PAYLOAD, PostgresEventBus
+
+    class FakeResult:
+        def __init__(self, value):
+            self.value = value
+
+        def scalar_one(self):
+            return self.value
+
+    class FakeConnection:
+        """バス専用エンジンの connect() の代わり。実行した文と pg_notify の引数を記録する"""
+        def __init__(self):
+            self.notified = []
+            self.commits = 0
+            self.seq = 0
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def execute(self, statement):
+            sql = str(statement)
+            if "nextval" in sql:
+                self.seq += 1
+                return FakeResult(self.seq)
+            if "pg_notify" in sql:
+                channel, payload = statement.compile().params.values()
+                self.notified.append(json.loads(payload))
+            return FakeResult(None)
+
+        async def commit(self):
+            self.commits += 1
+
+    conn = FakeConnection()
+    bus = PostgresEventBus("postgresql+psycopg://u:p@localhost/db",
+                           engine=type("FakeEngine", (), {"connect": lambda self: conn})())
+    local = []
+
+    async def handler(seq, topics, message):
+        local.append((seq, topics, json.loads(message)))
+    bus.subscribe(handler)
+
+    async def run():
+        await bus.publish(["order:1"], {"type": "status_updated", "status": "paid"})
+        # 大きすぎる差分は外して NOTIFY する（受け取った管理画面が一覧を取り直す）
+        await bus.publish(["board:2099-06-14"], {"type": "order_created", "order_id": 2, "order": {"note": "x" * MAX_NOTIFY_PAYLOAD}})
+        # 外せるものが無ければ、このプロセスの接続にだけ配る
+        await bus.publish(["board:2099-06-14"], {"type": "note", "text": "x" * MAX_NOTIFY_PAYLOAD})
+    asyncio.run(run())
+
+    assert [(n["seq"], n["topics"]) for n in conn.notified] == [(1, ["order:1"]), (2, ["board:2099-06-14"])]
+    assert json.loads(conn.notified[0]["message"]) == {"type": "status_updated", "status": "paid", "seq": 1}
+    assert json.loads(conn.notified[1]["message"]) == {"type": "order_created", "order_id": 2, "seq": 2}
+    assert all(len(json.dumps(n, ensure_ascii=False).encode()) <= MAX_NOTIFY_PAYLOAD for n in conn.notified)
+    assert [(seq, topics, event["type"]) for seq, topics, event in local] == [(3, ["board:2099-06-14"], "note")]
+
+
+def test_postgres_event_bus_fails_startup_when_listen_gets_nothing():
+    import asyncio
+    from app.event_bus import PostgresEventBus
+
+    class FakeNotify:
+        def __init__(self, payload):
+            self.payload = payload
+
+    class FakeListenConnection:
+        """LISTEN 済みの psycopg 接続の代わり。pooled=True なら（transaction pooling のように）何も届かない"""
+        def __init__(self, pooled):
+            self.pooled = pooled
+            self.queue = asyncio.Queue()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def notifies(self):
+            while True:
+                yield FakeNotify(await self.queue.get())
+
+    class FakeNotifyConnection:
+        def __init__(self, listener):
+            self.listener = listener
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def execute(self, statement):
+            channel, payload = statement.compile().params.values()
+            if not self.listener.pooled:
+                self.listener.queue.put_nowait(payload)
+
+        async def commit(self):
+            pass
+
+    def make_bus(pooled):
+        listener = FakeListenConnection(pooled)
+        bus = PostgresEventBus("postgres://u:p@localhost/db",
+                               engine=type("FakeEngine", (), {"connect": lambda self: FakeNotifyConnection(listener)})())
+
+        async def listen_connection():
+            return listener
+        bus._listen_connection = listen_connection
+        return bus
+
+    async def run():
+        direct = make_bus(pooled=False)
+        await direct.start(timeout=1)
+        assert direct._listener is not None and not direct._listener.done()
+        await direct.stop()
+
+        pooled = make_bus(pooled=True)
+        with pytest.raises(RuntimeError, match="EVENT_BUS_DATABASE_URL"):
+            await pooled.start(timeout=0.05)
+        assert pooled._listener is None
+    asyncio.run(run())
+
+
+@pytest.mark.skipif(not os.getenv("TEST_POSTGRES_URL"), reason="TEST_POSTGRES_URL（直結の Postgres）が必要")
+def test_postgres_event_bus_round_trip():
+    import asyncio
+    import json
+    from app.event_bus import PostgresEventBus
+
+    url = os.environ["TEST_POSTGRES_URL"]
+
+    async def run():
+        publisher, receiver = PostgresEventBus(url, channel="crowdlunch_test"), PostgresEventBus(url, channel="crowdlunch_test")
+        async with publisher.engine.connect() as conn:
+            await conn.exec_driver_sql("CREATE SEQUENCE IF NOT EXISTS realtime_event_seq")
+            await conn.commit()
+        received = asyncio.Queue()
+
+        async def handler(seq, topics, message):
+            received.put_nowait((seq, topics, json.loads(message)))
+        receiver.subscribe(handler)
+        await receiver.start()
+        try:
+            # 別プロセスの publish が LISTEN 側に seq 順で届く
+            await publisher.publish(["order:1"], {"type": "status_updated", "status": "paid"})
+            await publisher.publish(["order:1"], {"type": "status_updated", "status": "ready"})
+            first = await asyncio.wait_for(received.get(), 5)
+            second = await asyncio.wait_for(received.get(), 5)
+        finally:
+            await receiver.stop()
+            await publisher.engine.dispose()
+            await receiver.engine.dispose()
+        assert first[1] == ["order:1"] and first[2]["status"] == "paid"
+        assert second[0] == first[0] + 1 and second[2]["status"] == "ready"
+    asyncio.run(run())
+    assert conn.commits == 3
+
+
+def test_order_succeeds_when_event_publish_fails(client, monkeypatch):
+    from app.event_bus import event_bus
+    serve_date = date(2099, 6, 17)
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Bus Down Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+
+    async def fail(topics, event):
+        raise TimeoutError("QueuePool limit reached")
+    monkeypatch.setattr(event_bus, "publish", fail)
+
+    response = client.post("/orders/guest", json={
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "開発", "name": "障害 八郎", "items": [{"menu_id": menu_id, "qty": 1}],
+    })
+    assert response.status_code == 200  # 保存済みの注文は、通知に失敗しても成功として返す
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    patched = client.patch(f"/orders/{response.json()['id']}/status", json={"status": "paid"}, headers=headers)
+    assert patched.status_code == 200
+
+
+def test_websocket_resumes_from_last_seq(client):
+    serve_date = date(2099, 6, 15)
+    headers = {"Authorization": f"Bearer {create_admin_token()}"}
+    db = TestingSessionLocal()
+    menu = Menu(serve_date=serve_date, title="Resume Bento", price=500, max_qty=10)
+    db.add(menu)
+    db.commit()
+    menu_id = menu.id
+    db.close()
+    created = client.post("/orders/guest", json={
+        "serve_date": str(serve_date), "delivery_type": "desk", "request_time": "12:00",
+        "department": "開発", "name": "再開 五郎", "items": [{"menu_id": menu_id, "qty": 1}],
+    })
+    created, order_token = created.json(), created.headers["X-Order-Token"]
+    topic = f"order:{created['id']}"
+
+    with client.websocket_connect("/ws/orders") as ws:
+        ws.send_json({"type": "subscribe", "topics": [topic], "token": order_token})
+        last_seq = ws.receive_json()["seq"]
+    # 切断中の2件の状態変化
+    for new_status in ("paid", "preparing"):
+        client.patch(f"/orders/{created['id']}/status", json={"status": new_status}, headers=headers)
+
+    with client.websocket_connect("/ws/orders") as ws:
+        ws.send_json({"type": "subscribe", "topics": [topic], "token": order_token, "last_seq": last_seq})
+        ws.receive_json()
+        missed = [ws.receive_json(), ws.receive_json()]
+    assert [e["status"] for e in missed] == ["paid", "preparing"]
+    assert missed[0]["seq"] < missed[1]["seq"]
+
+    with client.websocket_connect("/ws/orders") as ws:
+        ws.send_json({"type": "subscribe", "topics": [topic], "token": order_token, "last_seq": missed[1]["seq"] + 100})
+        ws.receive_json()
+        assert ws.receive_json()["type"] == "resync_required"
+
+
+def test_sse_stream_sends_keepalive_events_and_resumes():
+    import asyncio
+    from app.auth import order_token
+    from app.realtime import ConnectionManager, sse_events
+
+    async def scenario():
+        manager = ConnectionManager()
+        await manager.deliver(1, ["order:7"], '{"type": "status_updated", "status": "paid", "seq": 1}')
+        await manager.deliver(2, ["order:8"], '{"type": "status_updated", "status": "paid", "seq": 2}')
+        connection = manager.open_stream()
+        manager.subscribe(connection.key, ["order:7"], order_token(7))
+        manager.resume(connection.key, 0)  # Last-Event-ID: 0
+        stream = sse_events(connection, manager, keepalive=0.01)
+        frames = [await stream.__anext__() for _ in range(3)]
+        await manager.deliver(3, ["order:7"], '{"type": "delivery_completed", "seq": 3}')
+        frames.append(await stream.__anext__())
+        await stream.aclose()
+        return manager, frames
+
+    manager, frames = asyncio.run(scenario())
+    assert frames == [
+        "retry: 3000\n\n",
+        'id: 1\ndata: {"type": "status_updated", "status": "paid", "seq": 1}\n\n',
+        ": keep-alive\n\n",
+        'id: 3\ndata: {"type": "delivery_completed", "seq": 3}\n\n',
+    ]
+    assert manager.active_connections == {}
+
+
+def test_sse_stream_stops_on_disconnect_before_keepalive():
+    import asyncio
+    import time
+    from app.auth import order_token
+    from app.realtime import ConnectionManager, sse_events
+
+    async def scenario():
+        manager = ConnectionManager()
+        connection = manager.open_stream()
+        manager.subscribe(connection.key, ["order:7"], order_token(7))
+        checks = []
+
+        async def is_disconnected():
+            checks.append(time.monotonic())
+            return len(checks) > 2
+
+        started = time.monotonic()
+        frames = [frame async for frame in sse_events(connection, manager, keepalive=60, is_disconnected=is_disconnected, poll=0.01)]
+        return manager, frames, time.monotonic() - started
+
+    manager, frames, elapsed = asyncio.run(scenario())
+    assert frames == ["retry: 3000\n\n"]
+    assert elapsed < 5
+    assert manager.active_connections == {}
+
+
+def test_sse_order_stream_rejection_names_the_order_token(client, monkeypatch):
+    from app.auth import order_token
+    from app.realtime import manager
+
+    # ルートの検証を通った後に購読側で弾かれた場合も、注文トークンの誤りとして返す
+    monkeypatch.setattr(manager, "subscribe", lambda key, topics, token: ([], list(topics)))
+    rejected = client.get(f"/events/orders/7?token={order_token(7)}")
+    assert rejected.status_code == 401
+    assert rejected.json()["detail"] == {"code": "invalid_token", "message": "注文トークンが必要です"}
+
+
+def test_sse_board_requires_admin_token(client):
+    from app.realtime import manager
+
+    assert client.get("/admin/events/board?date_filter=2099-06-16").status_code == 401
+    # 管理者トークンは URL に載せられない（アクセスログに残る）
+    admin_token = create_admin_token()
+    assert client.get(f"/admin/events/board?date_filter=2099-06-16&token={admin_token}").status_code == 401
+    assert client.post("/admin/events/board/token?date_filter=2099-06-16").status_code in (401, 403)
+
+    issued = client.post("/admin/events/board/token?date_filter=2099-06-16",
+                         headers={"Authorization": f"Bearer {admin_token}"}).json()
+    assert issued["expires_in"] > 0
+    assert client.get(f"/admin/events/board?date_filter=2099-06-17&token={issued['token']}").status_code == 401
+    # ストリームトークンはそのボードの購読にだけ使える（管理 API の認証には使えない）
+    connection = manager.open_stream()
+    try:
+        accepted, rejected = manager.subscribe(
+            connection.key, ["board:2099-06-16", "board:2099-06-17", "order:1"], issued["token"])
+    finally:
+        manager.disconnect(connection.key)
+    assert (accepted, rejected) == (["board:2099-06-16"], ["board:2099-06-17", "order:1"])
+    assert client.get("/admin/realtime", headers={"Authorization": f"Bearer {issued['token']}"}).status_code == 401
+
+
+def test_sse_order_events_require_order_token(client):
+    assert client.get("/events/orders/1").status_code == 401
+    assert client.get("/events/orders/1?token=" + "0" * 32).status_code == 401
@@ -12,7 +12,7 @@ function sanitizeApiUrl(url: string): string {
 }
 
 const RAW_API_BASE_URL = (import.meta.env as { VITE_API_BASE_URL?: string }).VITE_API_BASE_URL || 'https://crowd-lunch.fly.dev';
-const API_BASE_URL = sanitizeApiUrl(RAW_API_BASE_URL);
+export const API_BASE_URL = sanitizeApiUrl(RAW_API_BASE_URL);
 
 const DIAGNOSTIC_INFO = {
   API_BASE_URL: API_BASE_URL,
@@ -149,7 +149,7 @@ class ApiClient {
     return token;
   }
 
-  private async request<T>(endpoint: string, options: RequestInit = {}): Promise<T> {
+  private async request<T>(endpoint: string, options: RequestInit = {}, onHeaders?: (headers: Headers) => void): Promise<T> {
     const url = `${API_BASE_URL}${endpoint}`;
     const isServerTime = endpoint === '/server-time';
     const headers: HeadersInit = {
@@ -201,9 +201,23 @@ class ApiClient {
       throw error;
     }
 
+    onHeaders?.(response.headers);
     return response.json();
   }
 
+  // 注文確認画面で order:<id> の SSE を購読するためのトークン（注文作成時に X-Order-Token で返る）
+  private orderTokenHandler(): { onHeaders: (headers: Headers) => void; save: (orderId: number) => void } {
+    let token: string | null = null;
+    return {
+      onHeaders: (headers) => { token = headers.get('X-Order-Token'); },
+      save: (orderId) => { if (token) sessionStorage.setItem(`orderToken:${orderId}`, token); },
+    };
+  }
+
+  getOrderToken(orderId: number): string | null {
+    return sessionStorage.getItem(`orderToken:${orderId}`);
+  }
+
   async login(email: string): Promise<{ access_token: string; user: User }> {
     return this.request('/auth/login', {
       method: 'POST',
@@ -250,11 +264,15 @@ class ApiClient {
     items: OrderItem[];
     pickup_at?: string;
     note?: string;
-  }): Promise<Order> {
-    return this.request('/orders/guest', {
+  }, idempotencyKey?: string): Promise<Order> {
+    const orderToken = this.orderTokenHandler();
+    const created = await this.request<Order>('/orders/guest', {
       method: 'POST',
       body: JSON.stringify(order),
-    });
+      headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : undefined,
+    }, orderToken.onHeaders);
+    orderToken.save(created.id);
+    return created;
   }
 
   async getOrder(orderId: number): Promise<Order> {
@@ -275,7 +293,22 @@ class ApiClient {
   }
 
   async getTodayOrders(): Promise<Order[]> {
-    return this.request('/admin/orders/today');
+    return this.requestAllPages<Order>('/admin/orders/today');
+  }
+
+  // 注文一覧はページ単位（X-Next-Cursor）で返るので、続きが無くなるまで順に取り寄せて1つの配列にする
+  private async requestAllPages<T>(endpoint: string): Promise<T[]> {
+    const separator = endpoint.includes('?') ? '&' : '?';
+    const items: T[] = [];
+    let cursor: string | null = null;
+    do {
+      const url: string = cursor ? `${endpoint}${separator}cursor=${encodeURIComponent(cursor)}` : endpoint;
+      let next = null as string | null;
+      const page = await this.request<T[]>(url, {}, (headers) => { next = headers.get('X-Next-Cursor'); });
+      items.push(...page);
+      cursor = next;
+    } while (cursor);
+    return items;
   }
 
   async getMenus(dateFilter?: string): Promise<MenuResponse[]> {
@@ -345,7 +378,7 @@ class ApiClient {
 
   async getOrdersByDate(date: string, status?: string): Promise<Order[]> {
     const params = status ? `?date=${date}&status=${status}` : `?date=${date}`;
-    return this.request(`/orders${params}`);
+    return this.requestAllPages<Order>(`/orders${params}`);
   }
 
   async getMenusSQLAlchemy(date?: string): Promise<MenuSQLAlchemy[]> {
@@ -617,8 +650,14 @@ class ApiClient {
     serve_date: string; delivery_type: 'pickup' | 'desk'; request_time?: string;
     department: string; name: string; delivery_location?: string; note?: string;
     items: Array<{ daily_menu_id: number; qty: number; option_ids: number[] }>;
-  }): Promise<{ id: number; order_id: string; total_price: number; status: string }> {
-    return this.request('/v2/orders/guest', { method: 'POST', body: JSON.stringify(body) });
+  }, idempotencyKey?: string): Promise<{ id: number; order_id: string; total_price: number; status: string }> {
+    const orderToken = this.orderTokenHandler();
+    const created = await this.request<{ id: number; order_id: string; total_price: number; status: string }>('/v2/orders/guest', {
+      method: 'POST', body: JSON.stringify(body),
+      headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : undefined,
+    }, orderToken.onHeaders);
+    orderToken.save(created.id);
+    return created;
   }
   async catSetDaySetting(date: string, hero_image_id: number | null): Promise<CatDaySetting> {
     return this.request(`/admin/catalog/day-settings?date=${date}`, { method: 'PUT', body: JSON.stringify({ hero_image_id }) });
@@ -634,6 +673,7 @@ export interface MenuSQLAlchemy {
   img_url?: string;
   cafe_time_available: boolean;
   created_at: string;
+  remaining_qty?: number; // stock:<date> の push で当てた残数
 }
 
 // ===== Phase 1/2: 新カタログモデル =====
@@ -728,6 +768,7 @@ export interface CatV2MenuItem {
   price: number;
   image_url?: string | null;
   max_qty: number;
+  remaining_qty?: number;
   cafe_time_available: boolean;
   category?: string | null;
   option_groups: CatOptionGroup[];
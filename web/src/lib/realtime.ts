@@ -0,0 +1,114 @@
+// /ws/orders のトピック購読。接続が開いたら subscribe を送り、切れたら少し待って再接続する。
+// topics: 'order:<id>'（注文トークンか管理者トークン必須）| 'board:<YYYY-MM-DD>'（管理者トークン必須）| 'stock:<YYYY-MM-DD>'
+// stock は残数そのものが届くので、一覧を取り直さずに applyStock で当てればよい。
+// 再接続時は最後に受け取った seq を送り、切断中のイベントだけ再送してもらう。
+// サーバー側で追えない場合は { type: 'resync_required' } が onEvent に届くので、一覧を取り直すこと。
+// WebSocket が通らない環境向けに、同じイベントを SSE（EventSource）でも受けられる（streamEvents）。
+
+import { API_BASE_URL } from './api';
+
+export type RealtimeEvent = { type: string; [key: string]: unknown };
+
+type SubscribeOptions = {
+  token?: string | null;
+  onEvent: (event: RealtimeEvent) => void;
+  onStatusChange?: (connected: boolean) => void;
+};
+
+const RECONNECT_DELAY_MS = 3000;
+
+export function wsBaseUrl(): string {
+  return (import.meta.env?.VITE_API_URL || 'https://crowd-lunch.fly.dev').replace(/^http/, 'ws');
+}
+
+export function subscribeTopics(topics: string[], { token, onEvent, onStatusChange }: SubscribeOptions): () => void {
+  let ws: WebSocket | null = null;
+  let retry: ReturnType<typeof setTimeout> | null = null;
+  let closed = false;
+  let lastSeq: number | null = null;
+
+  const connect = () => {
+    ws = new WebSocket(`${wsBaseUrl()}/ws/orders`);
+    ws.onopen = () => {
+      ws?.send(JSON.stringify({ type: 'subscribe', topics, token: token ?? undefined, last_seq: lastSeq ?? undefined }));
+      onStatusChange?.(true);
+    };
+    ws.onmessage = (message) => {
+      try {
+        const data = JSON.parse(message.data);
+        if (!data || typeof data.type !== 'string') return;
+        if (data.type === 'subscribed') {
+          if (lastSeq === null) lastSeq = data.seq;
+          return;
+        }
+        if (data.type === 'resync_required') {
+          lastSeq = data.seq;
+        } else if (data.type === 'stock_changed') {
+          // stock はトピックごとにまとめて遅れて届くため、seq が前後する。毎回全量なのでそのまま当てる
+          if (typeof data.seq === 'number') lastSeq = Math.max(lastSeq ?? 0, data.seq);
+        } else if (typeof data.seq === 'number') {
+          if (lastSeq !== null && data.seq <= lastSeq) return; // 再送と重複した分
+          lastSeq = data.seq;
+        }
+        onEvent(data as RealtimeEvent);
+      } catch (error) {
+        console.error('WebSocket message parsing error:', error);
+      }
+    };
+    ws.onclose = () => {
+      onStatusChange?.(false);
+      if (!closed) {
+        retry = setTimeout(connect, RECONNECT_DELAY_MS);
+      }
+    };
+  };
+
+  connect();
+  return () => {
+    closed = true;
+    if (retry) clearTimeout(retry);
+    ws?.close();
+  };
+}
+
+// stock:<YYYY-MM-DD> に届く、その日の残数（id → 残数。旧メニューは menus、v2 は daily_menus）。
+// 日付ごとに、ワーカー数によらず1秒に1回程度にまとめて届く。
+export type StockEvent = {
+  type: 'stock_changed';
+  serve_date: string;
+  menus: Record<string, number>;
+  daily_menus: Record<string, number>;
+};
+
+// 日付ごとのメニュー一覧（/public/menus-range・/v2/menus-range の days）の残数を置き換える
+export function applyStock<T extends { remaining_qty?: number }>(
+  days: Record<string, T[]>,
+  serveDate: string,
+  remaining: Record<string, number>,
+  idOf: (item: T) => number,
+): Record<string, T[]> {
+  const items = days[serveDate];
+  if (!items) return days;
+  return {
+    ...days,
+    [serveDate]: items.map((item) => {
+      const qty = remaining[String(idOf(item))];
+      return qty === undefined ? item : { ...item, remaining_qty: qty };
+    }),
+  };
+}
+
+// SSE 版。再接続と Last-Event-ID による続きの再送は EventSource が自動で行う。
+export function streamEvents(path: string, { onEvent, onStatusChange }: Omit<SubscribeOptions, 'token'>): () => void {
+  const source = new EventSource(`${API_BASE_URL}${path}`);
+  source.onopen = () => onStatusChange?.(true);
+  source.onerror = () => onStatusChange?.(false);
+  source.onmessage = (message) => {
+    try {
+      onEvent(JSON.parse(message.data) as RealtimeEvent);
+    } catch (error) {
+      console.error('SSE message parsing error:', error);
+    }
+  };
+  return () => source.close();
+}
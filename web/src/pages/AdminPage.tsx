@@ -2,6 +2,7 @@ import { useState, useRef, useEffect } from 'react'
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query'
 import { useMemo } from 'react'
 import { apiClient, type MenuSQLAlchemy, apiFetch } from '../lib/api'
+import { subscribeTopics } from '../lib/realtime'
 import { DiagnosticInfo } from '../components/DiagnosticInfo'
 import { formatJst } from '../utils/datetime'
 import { JstTime } from '../components/admin/JstTime'
@@ -95,11 +96,28 @@ interface Order {
 
 interface OrderItem {
   id: number
-  menu: { title: string; price: number }
+  menu: { title: string; price: number } | null
   qty: number
   menu_item_name?: string
+  // board イベントで届いた注文だけが持つ（v2 注文は menu が無い）
+  name?: string | null
+  unit_price?: number | null
+  options?: { option_id: number | null; name: string; price_delta: number }[]
 }
 
+const itemName = (item: OrderItem) => item.name ?? item.menu?.title ?? ''
+
+// board イベントの差分を一覧のキャッシュに当てる（一覧を取り直さない）
+const applyOrderCreated = (orders: Order[] | undefined, order: Order): Order[] | undefined => {
+  if (!orders || orders.some(o => o.id === order.id)) return orders
+  return [...orders, order]
+}
+
+const applyOrderChange = (orders: Order[] | undefined, change: { order_id: number; status: string; delivered_at: string | null }) =>
+  orders?.map(o => o.id === change.order_id
+    ? { ...o, status: change.status, delivered_at: change.delivered_at ?? undefined }
+    : o)
+
 const clampToWindow = (key: string, windowKeys: string[]) => {
   const first = windowKeys[0], last = windowKeys[windowKeys.length - 1];
   if (key < first) return first;
@@ -399,24 +417,32 @@ export default function AdminPage() {
   useEffect(() => {
     if (!token) return
     
-    const wsUrl = (import.meta.env?.VITE_API_URL || 'https://crowd-lunch.fly.dev').replace(/^http/, 'ws')
-    const ws = new WebSocket(`${wsUrl}/ws/orders`)
-    
-    ws.onmessage = (event) => {
-      try {
-        const data = JSON.parse(event.data)
-        if (data.type === 'order_created' && isNotificationEnabled && audioElement) {
-          audioElement.play().catch(console.error)
-          queryClient.invalidateQueries({ queryKey: createOrdersQueryKey(serveDateKey), exact: true });
+    // 表示中の日付の注文だけを受け取る（board トピックは管理者トークンで購読）
+    return subscribeTopics([`board:${serveDateKey}`], {
+      token: apiClient.getAdminToken(),
+      onEvent: (data) => {
+        const ordersKey = createOrdersQueryKey(serveDateKey)
+        if (data.type === 'resync_required') {
+          // 切断中のイベントを再送できなかったときだけ一覧を取り直す
+          queryClient.invalidateQueries({ queryKey: ordersKey, exact: true });
+        } else if (data.type === 'order_created') {
+          if (isNotificationEnabled && audioElement) {
+            audioElement.play().catch(console.error)
+          }
+          if (data.order) {
+            queryClient.setQueryData<Order[]>(ordersKey, orders => applyOrderCreated(orders, data.order as Order))
+          } else {
+            // 大きすぎて差分が載らなかった注文
+            queryClient.invalidateQueries({ queryKey: ordersKey, exact: true });
+          }
+        } else if (data.type === 'status_updated' || data.type === 'delivery_completed') {
+          const change = data as unknown as { order_id: number; status: string; delivered_at: string | null }
+          queryClient.setQueryData<Order[]>(ordersKey, orders => applyOrderChange(orders, change))
+          // 確定済みの絞り込み一覧は、表示中のときだけ取り直される
+          queryClient.invalidateQueries({ queryKey: [...ordersKey, 'confirmed'], exact: true });
         }
-      } catch (error) {
-        console.error('WebSocket message parsing error:', error)
-      }
-    }
-    
-    return () => {
-      ws.close()
-    }
+      },
+    })
   }, [user, isNotificationEnabled, audioElement, queryClient, serveDateKey])
 
   const adminToken = apiClient.getAdminToken();
@@ -600,7 +626,7 @@ export default function AdminPage() {
         order.department || '',
         order.customer_name || order.user?.name || '',
         order.note || '',
-        order.order_items.map(item => item.menu.title).join('、'),
+        order.order_items.map(itemName).join('、'),
         order.total_price.toString(),
         order.delivery_location || '',
         order.request_time || '',
@@ -941,7 +967,7 @@ export default function AdminPage() {
                       <tr key={order.id} className="border-b">
                         <td className="p-2">{order.order_id || `#${order.id.toString().padStart(7, '0')}`}</td>
                         <td className="p-2"><JstTime value={order.created_at} /></td>
-                        <td className="p-2">{order.order_items.map(item => item.menu.title).join('、')}</td>
+                        <td className="p-2">{order.order_items.map(itemName).join('、')}</td>
                         <td className="p-2">{order.total_price.toLocaleString()}円</td>
                         <td className="p-2">{order.user.name}</td>
                         <td className="p-2 whitespace-pre-wrap break-words max-w-[16rem]">{order.note || '-'}</td>
@@ -1,8 +1,9 @@
 import { useEffect, useState } from 'react'
 import { useParams, useNavigate } from 'react-router-dom'
-import { useQuery } from '@tanstack/react-query'
+import { useQuery, useQueryClient } from '@tanstack/react-query'
 import QRCode from 'qrcode'
 import { apiClient } from '../lib/api'
+import { streamEvents } from '../lib/realtime'
 import { Button } from '../components/ui/button'
 import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card'
 import { Badge } from '../components/ui/badge'
@@ -12,14 +13,30 @@ export default function ConfirmPage() {
   const { orderId } = useParams<{ orderId: string }>()
   const navigate = useNavigate()
   const [qrCodeUrl, setQrCodeUrl] = useState<string>('')
+  const [live, setLive] = useState(false)
+  const queryClient = useQueryClient()
 
   const { data: order, isLoading } = useQuery({
     queryKey: ['order', orderId],
     queryFn: () => apiClient.getOrder(Number(orderId)),
     enabled: !!orderId,
-    refetchInterval: 5000, // Poll every 5 seconds for status updates
+    // 状態変化は SSE で受け取る（社内プロキシで WebSocket が通らない端末向け）。つながらない間だけ 5 秒ごとのポーリングに戻す
+    refetchInterval: live ? false : 5000,
   })
 
+  useEffect(() => {
+    if (!orderId) return
+    // 購読には注文時に受け取った注文トークンが要る。無い（別の端末で開いた）ときはポーリングのまま
+    const orderToken = apiClient.getOrderToken(Number(orderId))
+    if (!orderToken) return
+    return streamEvents(`/events/orders/${orderId}?token=${encodeURIComponent(orderToken)}`, {
+      onEvent: () => {
+        queryClient.invalidateQueries({ queryKey: ['order', orderId], exact: true })
+      },
+      onStatusChange: setLive,
+    })
+  }, [orderId, queryClient])
+
   useEffect(() => {
     if (order) {
       const qrData = JSON.stringify({
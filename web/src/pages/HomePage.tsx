@@ -1,4 +1,4 @@
-import { useState, useEffect, useMemo } from 'react'
+import { useState, useEffect, useMemo, useRef } from 'react'
 import { useQuery, useQueryClient } from '@tanstack/react-query'
 import { toast } from 'sonner'
 import { format } from 'date-fns'
@@ -10,6 +10,7 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '.
 import { User } from 'lucide-react'
 import { useAuth } from '../lib/auth'
 import { toServeDateKey, rangeContains } from '../lib/dateUtils'
+import { subscribeTopics, applyStock, type StockEvent } from '../lib/realtime'
 import { makeTodayWindow, todayJST } from '../lib/dateWindow'
 import { getAvailableTimeSlots, isCutoffTimeExpired, convertToPickupAt } from '../utils/timeUtils'
 import CafeIcon from '../components/icons/CafeIcon'
@@ -27,11 +28,14 @@ interface MenuSQLAlchemy {
   title: string;
   price: number;
   max_qty: number;
+  remaining_qty?: number; // 在庫の push を受け取ってから入る
   cafe_time_available: boolean;
   serve_date: string;
   img_url?: string;
 }
 
+const remainingOf = (menu: MenuSQLAlchemy) => menu.remaining_qty ?? menu.max_qty ?? 0
+
 interface TodayOrderData {
   date: string;
   department: string;
@@ -117,6 +121,8 @@ export default function HomePage() {
   const startKey = toServeDateKey(windowDates[0]);
   const endKey = toServeDateKey(windowDates[6]);
 
+  const [stockLive, setStockLive] = useState(false)
+
   const { data: weeklyMenusData, isLoading } = useQuery({
     queryKey: ['weeklyMenus', startKey, endKey] as const,
     queryFn: () => apiClient.getPublicMenusRange(startKey, endKey),
@@ -124,10 +130,28 @@ export default function HomePage() {
     refetchOnMount: 'always',
     refetchOnReconnect: true,
     refetchOnWindowFocus: true,
-    refetchInterval: 15000,
+    // 在庫は push で届くので、つながっている間のポーリングはメニュー自体の変更を拾う程度でよい
+    refetchInterval: stockLive ? 60000 : 15000,
     enabled: Boolean(startKey && endKey),
   })
 
+  useEffect(() => {
+    if (!startKey || !endKey) return
+    const queryKey = ['weeklyMenus', startKey, endKey] as const
+    return subscribeTopics(windowDates.map(d => `stock:${toServeDateKey(d)}`), {
+      onEvent: (data) => {
+        if (data.type === 'resync_required') {
+          queryClient.invalidateQueries({ queryKey, exact: true })
+        } else if (data.type === 'stock_changed') {
+          const event = data as unknown as StockEvent
+          queryClient.setQueryData<Awaited<ReturnType<typeof apiClient.getPublicMenusRange>>>(queryKey, prev =>
+            prev && { ...prev, days: applyStock(prev.days, event.serve_date, event.menus, m => m.id) })
+        }
+      },
+      onStatusChange: setStockLive,
+    })
+  }, [windowDates, startKey, endKey, queryClient])
+
   useEffect(() => {
     const fetchServerTime = async () => {
       try {
@@ -298,6 +322,9 @@ export default function HomePage() {
   }
 
 
+  // 通信エラーで再送しても二重注文にならないよう、同じ注文には同じ Idempotency-Key を使う
+  const submitKey = useRef<string | null>(null)
+
   const handleSubmitOrder = async () => {
     if (!department.trim() || !customerName.trim() || !deliveryTime || !deliveryLocation) return
     
@@ -346,7 +373,9 @@ export default function HomePage() {
       };
       
       
-      await apiClient.createGuestOrder(orderPayload)
+      submitKey.current ??= crypto.randomUUID()
+      await apiClient.createGuestOrder(orderPayload, submitKey.current)
+      submitKey.current = null
 
       const selectedMenus = getSelectedMenus();
       const orderData: TodayOrderData = {
@@ -386,6 +415,8 @@ export default function HomePage() {
       toast.success('注文が正常に送信されました')
     } catch (error) {
       console.error('Order submission failed:', error)
+      // サーバーが応答した失敗は注文が作られていないので、次の送信は新しいキーにする
+      if (!(error instanceof TypeError)) submitKey.current = null
       const errorWithCode = error as Error & { code?: string }
       
       if (errorWithCode.code === 'cafe_time_closed') {
@@ -558,11 +589,11 @@ export default function HomePage() {
                       <button
                         key={menu.id}
                         onClick={() => addToCart(menu.id, dateKey)}
-                        disabled={(menu.max_qty || 0) <= 0}
+                        disabled={remainingOf(menu) <= 0}
                         className={`px-3 py-[6px] md:px-4 md:py-[10px] rounded-full text-white font-semibold transition-colors inline-flex mx-3 md:mx-4 backdrop-blur-sm ring-[0.66px] md:ring-[0.75px] ring-gray-300/70 relative z-10 leading-tight w-full ${
                           cart[menu.id] > 0 
                             ? 'bg-primary' 
-                            : (menu.max_qty || 0) <= 0 
+                            : remainingOf(menu) <= 0 
                               ? 'bg-gray-500 cursor-not-allowed' 
                               : 'bg-black/50 hover:bg-black/70'
                         }`}
@@ -570,7 +601,7 @@ export default function HomePage() {
                         <div className="flex justify-between items-center w-full">
                           <div className="flex items-center gap-2">
                             <span className="text-lg whitespace-nowrap truncate max-w-[65vw] md:max-w-[480px]">{menu.title}</span>
-                            <span className="text-sm whitespace-nowrap">({menu.max_qty})</span>
+                            <span className="text-sm whitespace-nowrap">({remainingOf(menu)})</span>
                           </div>
                           <div className="flex items-center gap-2 md:gap-2.5 leading-none">
                             {menu.cafe_time_available && (
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { useLocation, useNavigate } from 'react-router-dom'
 import { useMutation, useQuery } from '@tanstack/react-query'
 import { toServeDateKey } from '../lib/dateUtils'
@@ -31,6 +31,9 @@ export default function OrderPage() {
     queryFn: () => apiClient.getWeeklyMenus(),
   })
 
+  // 通信エラーで再送しても二重注文にならないよう、同じ注文には同じ Idempotency-Key を使う
+  const submitKey = useRef<string | null>(null)
+
   const createOrderMutation = useMutation({
     mutationFn: (orderData: {
       serve_date: string;
@@ -39,10 +42,18 @@ export default function OrderPage() {
       department: string;
       name: string;
       items: Array<{ menu_id: number; qty: number }>;
-    }) => apiClient.createGuestOrder(orderData),
+    }) => {
+      submitKey.current ??= crypto.randomUUID()
+      return apiClient.createGuestOrder(orderData, submitKey.current)
+    },
     onSuccess: (order) => {
+      submitKey.current = null
       navigate(`/order/confirm/${order.id}`)
     },
+    onError: (error) => {
+      // サーバーが応答した失敗は注文が作られていないので、次の送信は新しいキーにする
+      if (!(error instanceof TypeError)) submitKey.current = null
+    },
   })
 
   useEffect(() => {
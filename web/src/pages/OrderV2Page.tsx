@@ -1,5 +1,5 @@
-import { useState, useMemo } from 'react'
-import { useQuery } from '@tanstack/react-query'
+import { useState, useMemo, useRef, useEffect } from 'react'
+import { useQuery, useQueryClient } from '@tanstack/react-query'
 import { toast } from 'sonner'
 import { format } from 'date-fns'
 import { apiClient, mediaUrl, type CatV2MenuItem } from '../lib/api'
@@ -8,6 +8,7 @@ import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogFooter } from '
 import { Input } from '../components/ui/input'
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '../components/ui/select'
 import { toServeDateKey } from '../lib/dateUtils'
+import { subscribeTopics, applyStock, type StockEvent } from '../lib/realtime'
 import { makeTodayWindow, todayJST } from '../lib/dateWindow'
 import { getAvailableTimeSlots, isCutoffTimeExpired } from '../utils/timeUtils'
 import CafeIcon from '../components/icons/CafeIcon'
@@ -52,12 +53,32 @@ export default function OrderV2Page() {
   const startKey = toServeDateKey(windowDates[0])
   const endKey = toServeDateKey(windowDates[6])
 
+  const queryClient = useQueryClient()
+  const [stockLive, setStockLive] = useState(false)
+
   const { data, isLoading } = useQuery({
     queryKey: ['v2Range', startKey, endKey] as const,
     queryFn: () => apiClient.getV2MenusRange(startKey, endKey),
-    refetchInterval: 15000,
+    // 残数は push で届く。つながっている間のポーリングはメニュー自体の変更を拾う程度
+    refetchInterval: stockLive ? 60000 : 15000,
   })
 
+  useEffect(() => {
+    const queryKey = ['v2Range', startKey, endKey] as const
+    return subscribeTopics(windowDates.map((d) => `stock:${toServeDateKey(d)}`), {
+      onEvent: (event) => {
+        if (event.type === 'resync_required') {
+          queryClient.invalidateQueries({ queryKey, exact: true })
+        } else if (event.type === 'stock_changed') {
+          const stock = event as unknown as StockEvent
+          queryClient.setQueryData<Awaited<ReturnType<typeof apiClient.getV2MenusRange>>>(queryKey, (prev) =>
+            prev && { ...prev, days: applyStock(prev.days, stock.serve_date, stock.daily_menus, (m) => m.daily_menu_id) })
+        }
+      },
+      onStatusChange: setStockLive,
+    })
+  }, [windowDates, startKey, endKey, queryClient])
+
   const bgFor = (dateKey: string, items: CatV2MenuItem[]) => {
     const img = items.find((m) => m.image_url)?.image_url
     if (img) return mediaUrl(img)!
@@ -117,23 +138,31 @@ export default function OrderV2Page() {
 
   const removeLine = (key: string) => setLines((prev) => prev.filter((l) => l.key !== key))
 
+  // 通信エラーで再送しても二重注文にならないよう、同じ注文には同じ Idempotency-Key を使う
+  const submitKey = useRef<string | null>(null)
+
   const submit = async () => {
     if (!department.trim() || !customerName.trim() || !deliveryTime || !deliveryLocation) return
     if (isCutoffTimeExpired()) { toast.error('18:14以降の注文受付は終了しております。'); return }
     setIsSubmitting(true)
+    submitKey.current ??= crypto.randomUUID()
     try {
       await apiClient.createV2GuestOrder({
         serve_date: selectedDateKey, delivery_type: 'desk', request_time: deliveryTime,
         department, name: customerName, delivery_location: deliveryLocation, note: note.trim() || undefined,
         items: lines.map((l) => ({ daily_menu_id: l.dailyMenuId, qty: l.qty, option_ids: l.optionIds })),
-      })
+      }, submitKey.current)
+      submitKey.current = null
       setShowOrderModal(false); setShowThankYou(true)
       setLines([]); setDepartment(''); setCustomerName(''); setNote(''); setDeliveryTime(''); setDeliveryLocation('')
     } catch (e) {
+      // サーバーが応答した失敗は注文が作られていないので、次の送信は新しいキーにする
+      if (!(e instanceof TypeError)) submitKey.current = null
       const err = e as Error & { code?: string }
       const map: Record<string, string> = {
         cafe_time_closed: '本日のカフェタイム受付は終了しました', menu_not_available: 'このメニューはカフェタイムでは注文できません',
-        invalid_timeslot: '選択した時間が有効範囲外です',
+        invalid_timeslot: '選択した時間が有効範囲外です', sold_out: '売り切れのメニューが含まれています',
+        invalid_option: '選択できないオプションが含まれています', invalid_option_selection: 'オプションの選択数が正しくありません',
       }
       toast.error(map[err.code || ''] || '注文の送信に失敗しました。')
     } finally { setIsSubmitting(false) }
@@ -186,13 +215,14 @@ export default function OrderV2Page() {
                     {items.length === 0 && <div className="text-center text-white/80 py-10">この日のメニューはまだありません</div>}
                     {items.map((m) => {
                       const selected = lines.some((l) => l.dailyMenuId === m.daily_menu_id)
+                      const remaining = m.remaining_qty ?? m.max_qty ?? 0
                       return (
-                        <button key={m.daily_menu_id} onClick={() => onTapMenu(m)} disabled={(m.max_qty || 0) <= 0}
-                          className={`px-3 py-[6px] md:px-4 md:py-[10px] rounded-full text-white font-semibold transition-colors inline-flex mx-3 backdrop-blur-sm ring-[0.66px] ring-gray-300/70 relative z-10 leading-tight w-full ${selected ? 'bg-primary' : (m.max_qty || 0) <= 0 ? 'bg-gray-500 cursor-not-allowed' : 'bg-black/50 hover:bg-black/70'}`}>
+                        <button key={m.daily_menu_id} onClick={() => onTapMenu(m)} disabled={remaining <= 0}
+                          className={`px-3 py-[6px] md:px-4 md:py-[10px] rounded-full text-white font-semibold transition-colors inline-flex mx-3 backdrop-blur-sm ring-[0.66px] ring-gray-300/70 relative z-10 leading-tight w-full ${selected ? 'bg-primary' : remaining <= 0 ? 'bg-gray-500 cursor-not-allowed' : 'bg-black/50 hover:bg-black/70'}`}>
                           <div className="flex justify-between items-center w-full">
                             <div className="flex items-center gap-2">
                               <span className="text-lg whitespace-nowrap truncate max-w-[65vw] md:max-w-[480px]">{m.name}</span>
-                              <span className="text-sm whitespace-nowrap">({m.max_qty})</span>
+                              <span className="text-sm whitespace-nowrap">({remaining})</span>
                               {m.option_groups.length > 0 && <span className="text-xs bg-white/20 rounded px-1.5 py-0.5">＋オプション</span>}
                             </div>
                             <div className="flex items-center gap-2 leading-none">